@@ -0,0 +1,104 @@
+"""
+Group fan-out latency and throughput of the channel layer backends by room size.
+Every room member is a channel of the layer receiving in this process, the sender publishes to the room group.
+
+    python -m benchmarks.channel_layer_latency --backends core pubsub --sizes 2 10 100 1000 5000
+"""
+from benchmarks.utils import redis_servers, report, summarize
+from channels_redis.pubsub import RedisPubSubChannelLayer
+from chats.layers import ShardedRedisChannelLayer
+import argparse
+import asyncio
+import time
+
+BACKENDS = {
+    'core': ShardedRedisChannelLayer,
+    'pubsub': RedisPubSubChannelLayer,
+}
+
+
+async def run(backend: str, size: int, address: str, args) -> dict:
+    """
+    Send the messages to a room of the given size and measure every delivery.
+    """
+    layer = BACKENDS[backend](hosts=[{'address': address}], capacity=max(100, args.messages * 2))
+    group = f'bench-{backend}-{size}'
+    channels = [await layer.new_channel() for _ in range(size)]
+    for channel in channels:
+        await layer.group_add(group, channel)
+
+    latencies = []
+    expected = size * args.messages
+    done = asyncio.Event()
+
+    async def receive(channel: str) -> None:
+        for _ in range(args.messages):
+            message = await layer.receive(channel)
+            latencies.append((time.perf_counter() - message['sent']) * 1000)
+            if len(latencies) == expected:
+                done.set()
+
+    receivers = [asyncio.create_task(receive(channel)) for channel in channels]
+    # Let every receiver subscribe before the first message
+    await asyncio.sleep(args.warmup)
+
+    started = time.perf_counter()
+    for _ in range(args.messages):
+        await layer.group_send(group, {'type': 'bench.message', 'sent': time.perf_counter()})
+        await asyncio.sleep(args.interval)
+    publish = time.perf_counter() - started
+
+    try:
+        await asyncio.wait_for(done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - started
+
+    for task in receivers:
+        task.cancel()
+    for channel in channels:
+        await layer.group_discard(group, channel)
+    await layer.flush()
+
+    return {
+        'backend': backend,
+        'room_size': size,
+        'delivered': len(latencies),
+        'lost': expected - len(latencies),
+        'publish_ms_per_message': round(publish / args.messages * 1000, 3),
+        'latency_ms': summarize(latencies),
+        'deliveries_per_second': round(len(latencies) / elapsed),
+    }
+
+
+async def run_all(address: str, args) -> list:
+    results = []
+    for size in args.sizes:
+        for backend in args.backends:
+            results.append(await run(backend, size, address, args))
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', nargs='+', choices=list(BACKENDS), default=list(BACKENDS))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2, 10, 100, 1000, 5000])
+    parser.add_argument('--messages', type=int, default=50)
+    parser.add_argument('--interval', type=float, default=0.01, help='seconds between messages')
+    parser.add_argument('--warmup', type=float, default=0.5)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--redis', help='address of a running Redis, a local one is started otherwise')
+    parser.add_argument('--base-port', type=int, default=6400)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    if args.redis:
+        results = asyncio.run(run_all(args.redis, args))
+    else:
+        with redis_servers(1, args.base_port) as ports:
+            results = asyncio.run(run_all(f'redis://127.0.0.1:{ports[0]}', args))
+    report('channel_layer_latency', results, vars(args), args.output)
+
+
+if __name__ == '__main__':
+    main()
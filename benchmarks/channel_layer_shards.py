@@ -0,0 +1,100 @@
+"""
+Fan-out throughput of the sharded channel layer as Redis shards are added.
+Every shard is a local redis-server process, workers are separate processes sending and receiving group messages.
+
+    python -m benchmarks.channel_layer_shards --shards 1 2 4 --workers 4
+"""
+from benchmarks.utils import redis_servers, report
+from chats.layers import ShardedRedisChannelLayer
+import multiprocessing
+import argparse
+import asyncio
+import random
+import time
+
+
+async def run_worker(ports: list, worker: int, args, barrier) -> dict:
+    """
+    Join the worker channels to the groups, then send to random groups and receive for the duration.
+    """
+    layer = ShardedRedisChannelLayer(
+        hosts=[{'address': f'redis://127.0.0.1:{port}'} for port in ports],
+        capacity=args.capacity,
+    )
+    groups = [f'bench-{index}' for index in range(args.groups)]
+    channels = [await layer.new_channel() for _ in range(args.channels)]
+    for index, channel in enumerate(channels):
+        await layer.group_add(groups[(worker * args.channels + index) % args.groups], channel)
+
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+    deadline = time.monotonic() + args.duration
+    received = 0
+    sent = 0
+
+    async def receive(channel: str) -> None:
+        nonlocal received
+        while (timeout := deadline - time.monotonic()) > 0:
+            try:
+                await asyncio.wait_for(layer.receive(channel), timeout)
+                received += 1
+            except asyncio.TimeoutError:
+                return
+
+    async def send() -> None:
+        nonlocal sent
+        while time.monotonic() < deadline:
+            await layer.group_send(random.choice(groups), {'type': 'bench.message', 'sent': time.time()})
+            sent += 1
+
+    await asyncio.gather(*(receive(channel) for channel in channels), *(send() for _ in range(args.senders)))
+    await layer.flush()
+    return {'sent': sent, 'received': received}
+
+
+def worker_main(ports: list, worker: int, args, barrier, results) -> None:
+    results.put(asyncio.run(run_worker(ports, worker, args, barrier)))
+
+
+def run(shards: int, args) -> dict:
+    """
+    Run all workers against the given number of shards.
+    """
+    with redis_servers(shards, args.base_port) as ports:
+        barrier = multiprocessing.Barrier(args.workers)
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=worker_main, args=(ports, worker, args, barrier, results))
+                     for worker in range(args.workers)]
+        for process in processes:
+            process.start()
+        counts = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+    sent = sum(count['sent'] for count in counts)
+    received = sum(count['received'] for count in counts)
+    return {
+        'shards': shards,
+        'group_sends_per_second': round(sent / args.duration),
+        'deliveries_per_second': round(received / args.duration),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--senders', type=int, default=20, help='concurrent senders per worker')
+    parser.add_argument('--channels', type=int, default=250, help='receiving channels per worker')
+    parser.add_argument('--groups', type=int, default=100)
+    parser.add_argument('--capacity', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--base-port', type=int, default=6400)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    results = [run(shards, args) for shards in args.shards]
+    report('channel_layer_shards', results, vars(args), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+Memory of idle websocket connections, measured with tracemalloc through `config.asgi.application`.
+Clients connect with stubbed auth backend calls against a fresh test database, wait for the initial frames and stay
+idle. Reports bytes per connection of both consumers with the lines allocating the most, and exits with status 1
+when a consumer uses more than its limit, or more than `--tolerance` above a previous `--output` given as `--baseline`.
+
+    python -m benchmarks.connection_memory --clients 1000
+"""
+from benchmarks.websocket_load import create_data, connect_client, stub_receive_user
+from benchmarks.utils import report
+from dotenv import load_dotenv
+from unittest import mock
+import tracemalloc
+import argparse
+import asyncio
+import django
+import json
+import sys
+import gc
+import os
+
+load_dotenv()
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', os.getenv('DJANGO_SETTINGS_MODULE', 'config.settings'))
+
+
+async def open_connection(application, username: str) -> object:
+    """
+    Connect the client to the connection consumer and read the frames up to the chat list.
+    """
+    communicator = await connect_client(application, username, f'/ws/{username}')
+    while '"chats"' not in await communicator.receive_from(timeout=60):
+        pass
+    return communicator
+
+
+async def open_chat(application, username: str, room_uuid: str) -> object:
+    """
+    Connect the client to the chat consumer and read the messages.
+    """
+    communicator = await connect_client(application, username, f'/ws/chat/{room_uuid}')
+    await communicator.receive_from(timeout=60)
+    return communicator
+
+
+async def measure(name: str, open_clients, args) -> dict:
+    """
+    Open the clients after a warm-up round and get the memory they keep while idle.
+    """
+    warmup = await open_clients(args.warmup)
+    for communicator in warmup:
+        await communicator.disconnect()
+    gc.collect()
+
+    before = tracemalloc.take_snapshot()
+    current = tracemalloc.get_traced_memory()[0]
+    communicators = await open_clients(args.clients)
+    await asyncio.sleep(0.1)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - current
+    top = tracemalloc.take_snapshot().compare_to(before, 'lineno')[:args.top]
+
+    for communicator in communicators:
+        await communicator.disconnect()
+    return {
+        'consumer': name,
+        'connections': len(communicators),
+        'bytes_per_connection': round(used / len(communicators)),
+        'top': [{
+            'line': str(stat.traceback[0]),
+            'bytes_per_connection': round(stat.size_diff / len(communicators)),
+        } for stat in top],
+    }
+
+
+async def run(args, rooms: list) -> list:
+    from config.asgi import application
+
+    members = [(username, room_uuid) for room_uuid, usernames in rooms for username in usernames]
+
+    async def open_connections(count: int) -> list:
+        return await asyncio.gather(*(open_connection(application, f'bench{index}') for index in range(count)))
+
+    async def open_chats(count: int) -> list:
+        return await asyncio.gather(*(
+            open_chat(application, username, room_uuid) for username, room_uuid in members[:count]
+        ))
+
+    return [
+        await measure('ConnectionConsumer', open_connections, args),
+        await measure('ChatConsumer', open_chats, args),
+    ]
+
+
+def check(results: list, args) -> list:
+    """
+    Get the consumers using more memory than their limit or the baseline.
+    """
+    limits = {'ConnectionConsumer': args.max_connection_bytes, 'ChatConsumer': args.max_chat_bytes}
+    if args.baseline:
+        with open(args.baseline) as file:
+            for result in json.load(file)['results']:
+                limits[result['consumer']] = min(
+                    limits[result['consumer']], result['bytes_per_connection'] * (1 + args.tolerance),
+                )
+    return [
+        f"{result['consumer']} uses {result['bytes_per_connection']} bytes per connection, "
+        f"limit {round(limits[result['consumer']])}"
+        for result in results if result['bytes_per_connection'] > limits[result['consumer']]
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--room-size', type=int, default=10)
+    parser.add_argument('--top', type=int, default=10, help='allocating lines to report')
+    parser.add_argument('--max-connection-bytes', type=int, default=23500,
+                        help='limit of the connection consumer, measured with the memory layer')
+    parser.add_argument('--max-chat-bytes', type=int, default=23500, help='limit of the chat consumer')
+    parser.add_argument('--baseline', help='previous output to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed growth over the baseline')
+    parser.add_argument('--layer', choices=['redis', 'memory'], default='memory')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+    args.rooms_per_user, args.history = 1, 0
+
+    django.setup()
+    from django.db import connection
+    from django.conf import settings
+
+    if args.layer == 'memory':
+        settings.CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+    test_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        rooms = create_data(args)
+        tracemalloc.start()
+        with mock.patch('middlewares.websocket_auth.receive_user', stub_receive_user):
+            results = asyncio.run(run(args, rooms))
+        tracemalloc.stop()
+    finally:
+        connection.creation.destroy_test_db(test_name, verbosity=0)
+    params = {key: value for key, value in vars(args).items() if key not in ('rooms_per_user', 'history')}
+    report('connection_memory', results, params, args.output)
+
+    regressions = check(results, args)
+    for regression in regressions:
+        print(regression, file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
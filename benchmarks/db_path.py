@@ -0,0 +1,168 @@
+"""
+Database path of the consumers under concurrency: the previous `database_sync_to_async` helpers against
+the async ORM calls and the database executor now used by the chat.
+Every operation runs `--operations` times with `--concurrency` in flight, against a fresh test database.
+Each path gets its own room, so the history read by `get_messages` does not grow with the messages saved before.
+With psycopg2 every async ORM call is still its own `sync_to_async` hop to the thread-sensitive thread, the async
+path differs by fewer queries per helper and by the writes running in the database executor.
+
+    python -m benchmarks.db_path --concurrency 200 --operations 2000
+"""
+from benchmarks.utils import report, summarize
+from dotenv import load_dotenv
+import argparse
+import asyncio
+import django
+import time
+import os
+
+load_dotenv()
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', os.getenv('DJANGO_SETTINGS_MODULE', 'config.settings'))
+
+
+def create_data(args, paths: tuple) -> tuple:
+    """
+    Create the users and a room with history per path, return the room uuids by path and the usernames.
+    """
+    from chats.models import User, Room, Message, Status
+
+    users = User.objects.bulk_create([
+        User(username=f'bench{index}', email=f'bench{index}@bench.local') for index in range(args.users)
+    ])
+    Status.objects.bulk_create([Status(user=user) for user in users])
+    room_names = {}
+    for path in paths:
+        room = Room.objects.create(description=f'bench room {path}')
+        room.users.add(*users)
+        Message.objects.bulk_create([
+            Message(room_uuid=room.uuid, seq=seq, sender=users[seq % len(users)], content=f'message {seq}')
+            for seq in range(1, args.history + 1)
+        ])
+        room_names[path] = str(room.uuid)
+    return room_names, [user.username for user in users]
+
+
+def legacy_operations() -> dict:
+    """
+    The helpers as they were before the async ORM, every call hops to the single thread-sensitive thread.
+    """
+    from channels.db import database_sync_to_async
+    from chats.models import Message, Room, Status, User
+    from chats.utils import save_message
+    from django.utils import timezone
+
+    @database_sync_to_async
+    def get_messages(room_name: str, username: str) -> int:
+        return len(list(Message.objects.filter(room_uuid=room_name).select_related('sender').order_by('seq', 'id')))
+
+    @database_sync_to_async
+    def get_members(room_name: str, username: str) -> int:
+        return len(dict(Room.users.through.objects.filter(room__uuid=room_name).values_list(
+            'user_id', 'user__username')))
+
+    @database_sync_to_async
+    def set_status(room_name: str, username: str) -> None:
+        user = User.objects.get(username=username)
+        status, _ = Status.objects.get_or_create(user=user)
+        status.last_seen = timezone.now()
+        status.online = False
+        status.save()
+
+    legacy_save_message = database_sync_to_async(save_message.database_func)
+
+    async def send_message(room_name: str, username: str) -> None:
+        await legacy_save_message(room_name, {'sender': username, 'content': f'{username} {time.perf_counter()}'})
+
+    return {
+        'get_messages': get_messages,
+        'get_members': get_members,
+        'set_status': set_status,
+        'save_message': send_message,
+    }
+
+
+def async_operations() -> dict:
+    """
+    The helpers used by the consumers.
+    """
+    from chats.models import Message
+    from chats.membership import get_members_from_db
+    from chats.utils import set_status_async, save_message
+
+    async def get_messages(room_name: str, username: str) -> int:
+        queryset = Message.objects.filter(room_uuid=room_name).select_related('sender').order_by('seq', 'id')
+        return len([message async for message in queryset])
+
+    async def get_members(room_name: str, username: str) -> int:
+        return len(await get_members_from_db(room_name))
+
+    async def set_status(room_name: str, username: str) -> None:
+        await set_status_async(username, False)
+
+    async def send_message(room_name: str, username: str) -> None:
+        await save_message(room_name, {'sender': username, 'content': f'{username} {time.perf_counter()}'})
+
+    return {
+        'get_messages': get_messages,
+        'get_members': get_members,
+        'set_status': set_status,
+        'save_message': send_message,
+    }
+
+
+async def run_operation(operation, room_name: str, usernames: list, args) -> dict:
+    """
+    Run the operation concurrently and measure the latency of every call.
+    """
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async def call(index: int) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            await operation(room_name, usernames[index % len(usernames)])
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(call(index) for index in range(args.operations)))
+    elapsed = time.perf_counter() - started
+    return {'operations_per_second': round(args.operations / elapsed), 'latency_ms': summarize(latencies)}
+
+
+async def run(args, room_names: dict, usernames: list) -> dict:
+    from asgiref.sync import sync_to_async
+    from django.db import connections
+
+    results = {}
+    for path, operations in (('legacy', legacy_operations()), ('async', async_operations())):
+        results[path] = {}
+        for name, operation in operations.items():
+            results[path][name] = await run_operation(operation, room_names[path], usernames, args)
+    # The async ORM thread keeps its connection, close it before the test database is dropped
+    await sync_to_async(connections.close_all)()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--history', type=int, default=100, help='messages in the room')
+    parser.add_argument('--operations', type=int, default=1000, help='calls per operation')
+    parser.add_argument('--concurrency', type=int, default=100, help='calls in flight')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    django.setup()
+    from django.db import connection
+
+    test_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        room_names, usernames = create_data(args, ('legacy', 'async'))
+        results = asyncio.run(run(args, room_names, usernames))
+    finally:
+        connection.creation.destroy_test_db(test_name, verbosity=0)
+    report('db_path', results, vars(args), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+Publish cost and end-to-end latency of a large room, flat group fan-out against fan-out through worker nodes.
+Workers are simulated in this process, each with its own channel layer connection.
+
+    python -m benchmarks.large_room_fanout --members 10000 --workers 8 --backend core
+"""
+from benchmarks.utils import redis_servers, report, summarize
+from channels_redis.pubsub import RedisPubSubChannelLayer
+from chats.layers import ShardedRedisChannelLayer
+from channels.layers import InMemoryChannelLayer
+from django.conf import settings
+import argparse
+import asyncio
+import time
+
+if not settings.configured:
+    settings.configure(FANOUT_GROUP_REFRESH=3600)
+
+from chats.fanout import Node, node_group  # noqa: E402
+
+
+class Member:
+    """
+    Stand-in for a chat consumer connected to a worker.
+    """
+
+    def __init__(self, deliveries: list):
+        self.channel_name = 'member'
+        self.deliveries = deliveries
+
+    async def dispatch(self, message: dict) -> None:
+        self.deliveries.append((time.perf_counter() - message['sent']) * 1000)
+
+
+def make_layers(backend: str, address: str, count: int, capacity: int) -> list:
+    """
+    Create the channel layer of every worker, the in-memory layer can only be shared.
+    """
+    if backend == 'memory':
+        return [InMemoryChannelLayer(capacity=capacity)] * count
+    layer_class = ShardedRedisChannelLayer if backend == 'core' else RedisPubSubChannelLayer
+    return [layer_class(hosts=[{'address': address}], capacity=capacity, channel_capacity={'node.*': capacity})
+            for _ in range(count)]
+
+
+async def publish(layer, group: str, deliveries: list, expected: int, args) -> dict:
+    """
+    Publish the messages to the group and wait for all deliveries.
+    """
+    await asyncio.sleep(args.warmup)
+    publish_times = []
+    started = time.perf_counter()
+    for _ in range(args.messages):
+        sent = time.perf_counter()
+        await layer.group_send(group, {'type': 'bench.message', 'room': 'bench', 'sent': sent})
+        publish_times.append((time.perf_counter() - sent) * 1000)
+        await asyncio.sleep(args.interval)
+
+    deadline = time.perf_counter() + args.timeout
+    while len(deliveries) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    return {
+        'publish_ms': summarize(publish_times),
+        'latency_ms': summarize(deliveries),
+        'delivered': len(deliveries),
+        'lost': expected - len(deliveries),
+        'deliveries_per_second': round(len(deliveries) / (time.perf_counter() - started)),
+    }
+
+
+async def run_flat(args, address: str) -> dict:
+    """
+    Every member channel is in the room group.
+    """
+    layers = make_layers(args.backend, address, args.workers + 1, args.messages * 2)
+    deliveries = []
+    channels = []
+    for index in range(args.members):
+        layer = layers[index % args.workers]
+        channel = await layer.new_channel()
+        await layer.group_add('bench', channel)
+        channels.append((layer, channel))
+
+    async def receive(layer, channel: str) -> None:
+        while True:
+            message = await layer.receive(channel)
+            deliveries.append((time.perf_counter() - message['sent']) * 1000)
+
+    receivers = [asyncio.create_task(receive(layer, channel)) for layer, channel in channels]
+    result = await publish(layers[-1], 'bench', deliveries, args.members * args.messages, args)
+    for task in receivers:
+        task.cancel()
+    for layer, channel in channels:
+        await layer.group_discard('bench', channel)
+    return {'mode': 'flat', **result}
+
+
+async def run_nodes(args, address: str) -> dict:
+    """
+    Every worker joins the room once with its node channel and expands messages to its own members.
+    """
+    layers = make_layers(args.backend, address, args.workers + 1, args.messages * 2)
+    deliveries = []
+    nodes = [Node(layer) for layer in layers[:-1]]
+    for index in range(args.members):
+        await nodes[index % args.workers].join('bench', Member(deliveries))
+
+    result = await publish(layers[-1], node_group('bench'), deliveries, args.members * args.messages, args)
+    for node in nodes:
+        node.stop()
+        await node.channel_layer.group_discard(node_group('bench'), node.channel_name)
+    return {'mode': 'nodes', **result}
+
+
+async def run_all(args, address: str) -> list:
+    return [await run_flat(args, address), await run_nodes(args, address)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', choices=['core', 'pubsub', 'memory'], default='core')
+    parser.add_argument('--members', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--messages', type=int, default=20)
+    parser.add_argument('--interval', type=float, default=0.05, help='seconds between messages')
+    parser.add_argument('--warmup', type=float, default=1)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--redis', help='address of a running Redis, a local one is started otherwise')
+    parser.add_argument('--base-port', type=int, default=6400)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    if args.backend == 'memory' or args.redis:
+        results = asyncio.run(run_all(args, args.redis))
+    else:
+        with redis_servers(1, args.base_port) as ports:
+            results = asyncio.run(run_all(args, f'redis://127.0.0.1:{ports[0]}'))
+    report('large_room_fanout', results, vars(args), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+from contextlib import contextmanager
+import subprocess
+import platform
+import socket
+import json
+import time
+import sys
+import os
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values: list, q: float) -> float | None:
+    """
+    Get the q-th percentile of the values, nearest rank.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))]
+
+
+def summarize(values: list) -> dict:
+    """
+    Summarize latencies in milliseconds.
+    """
+    if not values:
+        return {'count': 0, 'p50': None, 'p99': None, 'max': None}
+    return {
+        'count': len(values),
+        'p50': round(percentile(values, 50), 3),
+        'p99': round(percentile(values, 99), 3),
+        'max': round(max(values), 3),
+    }
+
+
+def get_commit() -> str | None:
+    """
+    Get the commit of the working tree, so results can be compared between commits.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BASE_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(name: str, results, params: dict, output: str | None = None) -> dict:
+    """
+    Print the results as JSON and write them to the output file if given.
+    """
+    data = {
+        'benchmark': name,
+        'commit': get_commit(),
+        'python': sys.version.split()[0],
+        'machine': platform.machine(),
+        'params': params,
+        'results': results,
+    }
+    text = json.dumps(data, indent=2)
+    print(text)
+    if output:
+        with open(output, 'w') as file:
+            file.write(text + '\n')
+    return data
+
+
+def wait_for_port(port: int, timeout: float = 10) -> None:
+    """
+    Wait until the local port accepts connections.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+@contextmanager
+def redis_servers(count: int, base_port: int = 6400):
+    """
+    Start local Redis processes without persistence and yield their ports.
+    """
+    ports = [base_port + index for index in range(count)]
+    processes = [subprocess.Popen(
+        ['redis-server', '--port', str(port), '--save', '', '--appendonly', 'no'],
+        stdout=subprocess.DEVNULL,
+    ) for port in ports]
+    try:
+        for port in ports:
+            wait_for_port(port)
+        yield ports
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
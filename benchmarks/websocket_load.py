@@ -0,0 +1,237 @@
+"""
+Load test of the websocket application with thousands of simulated clients.
+Clients connect through `config.asgi.application` with stubbed auth backend calls, against a fresh test database.
+Reports connect latency, chat list size and time, message fan-out latency and database queries per event.
+
+    python -m benchmarks.websocket_load --clients 2000 --layer memory
+"""
+from benchmarks.utils import report, summarize
+from dotenv import load_dotenv
+from unittest import mock
+import argparse
+import asyncio
+import django
+import json
+import time
+import os
+
+load_dotenv()
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', os.getenv('DJANGO_SETTINGS_MODULE', 'config.settings'))
+
+
+class QueryCounter:
+    """
+    Count the queries of every database connection, including the ones of the database threads.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, connection, **kwargs) -> None:
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+class StubResponse:
+    """
+    Response of the auth backend, the access token is the username of the simulated client.
+    """
+    status_code = 200
+
+    def __init__(self, username: str):
+        self.username = username
+
+    def json(self) -> dict:
+        return {
+            'user': {'email': f'{self.username}@bench.local'},
+            'access': self.username,
+            'refresh': self.username,
+        }
+
+
+def stub_receive_user(host: str, token: dict) -> StubResponse:
+    return StubResponse(token['access'])
+
+
+def create_data(args) -> list:
+    """
+    Create the users, rooms and history, return the rooms with the usernames of their members.
+    """
+    from chats.summaries import update_last_message
+    from chats.models import User, Room, Message
+
+    users = User.objects.bulk_create([
+        User(username=f'bench{index}', email=f'bench{index}@bench.local') for index in range(args.clients)
+    ])
+    rooms = []
+    for index in range(max(1, args.clients * args.rooms_per_user // args.room_size)):
+        room = Room.objects.create(description=f'bench room {index}')
+        members = [users[(index * args.room_size + offset) % len(users)] for offset in range(args.room_size)]
+        room.users.add(*members)
+        messages = Message.objects.bulk_create([
+            Message(room_uuid=room.uuid, seq=seq, sender=members[seq % len(members)], content=f'message {seq}')
+            for seq in range(1, args.history + 1)
+        ])
+        if messages:
+            update_last_message(room.uuid, messages[-1])
+        rooms.append((str(room.uuid), [member.username for member in members]))
+    return rooms
+
+
+async def connect_client(application, username: str, path: str):
+    """
+    Open a websocket of the simulated client.
+    """
+    from channels.testing import WebsocketCommunicator
+
+    communicator = WebsocketCommunicator(application, path, headers=[
+        (b'cookie', f'access={username}; refresh={username}'.encode()),
+    ])
+    connected, _ = await communicator.connect(timeout=60)
+    if not connected:
+        raise RuntimeError(f'{username} could not connect to {path}')
+    return communicator
+
+
+async def run_connections(application, args, counter: QueryCounter) -> tuple:
+    """
+    Connect every client to the connection consumer and wait for the chat list.
+    """
+    semaphore = asyncio.Semaphore(args.concurrency)
+    handshakes, bootstraps, sizes, chats = [], [], [], []
+
+    async def client(index: int):
+        async with semaphore:
+            started = time.perf_counter()
+            communicator = await connect_client(application, f'bench{index}', f'/ws/bench{index}')
+            handshakes.append((time.perf_counter() - started) * 1000)
+            while True:
+                frame = await communicator.receive_from(timeout=60)
+                if '"chats"' in frame:
+                    break
+            bootstraps.append((time.perf_counter() - started) * 1000)
+            sizes.append(len(frame))
+            chats.append(len(json.loads(frame)['chats']))
+            return communicator
+
+    queries = counter.count
+    started = time.perf_counter()
+    communicators = await asyncio.gather(*(client(index) for index in range(args.clients)))
+    elapsed = time.perf_counter() - started
+    result = {
+        'clients': args.clients,
+        'connections_per_second': round(args.clients / elapsed),
+        'handshake_ms': summarize(handshakes),
+        'chat_list_ms': summarize(bootstraps),
+        'chat_list_bytes': summarize(sizes),
+        'chats_per_client': summarize(chats),
+        'queries_per_connection': round((counter.count - queries) / args.clients, 2),
+    }
+    return result, communicators
+
+
+async def run_fanout(application, rooms: list, args, counter: QueryCounter) -> tuple:
+    """
+    Connect every member of the rooms to the chat consumer and send messages from the first member.
+    """
+    rooms = rooms[:args.fanout_rooms]
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def member(room_uuid: str, username: str):
+        async with semaphore:
+            communicator = await connect_client(application, username, f'/ws/chat/{room_uuid}')
+            await communicator.receive_from(timeout=60)
+            return communicator
+
+    queries = counter.count
+    members = await asyncio.gather(*(
+        asyncio.gather(*(member(room_uuid, username) for username in usernames)) for room_uuid, usernames in rooms
+    ))
+    queries_per_join = (counter.count - queries) / max(1, sum(len(usernames) for _, usernames in rooms))
+
+    latencies = []
+
+    async def receive(communicator) -> None:
+        received = 0
+        while received < args.messages:
+            frame = json.loads(await communicator.receive_from(timeout=60))
+            # Pings of the heartbeat and other frames
+            if frame.get('type') != 'chat.content':
+                continue
+            latencies.append((time.perf_counter() - float(frame['content'])) * 1000)
+            received += 1
+
+    receivers = [asyncio.create_task(receive(communicator)) for communicators in members for communicator in
+                 communicators]
+    queries = counter.count
+    for _ in range(args.messages):
+        for communicators in members:
+            await communicators[0].send_to(text_data=json.dumps({
+                'type': 'chat.content',
+                'content': repr(time.perf_counter()),
+            }))
+        await asyncio.sleep(args.interval)
+    await asyncio.gather(*receivers)
+
+    result = {
+        'rooms': len(rooms),
+        'room_size': args.room_size,
+        'queries_per_join': round(queries_per_join, 2),
+        'queries_per_message': round((counter.count - queries) / (args.messages * len(rooms)), 2),
+        'fanout_ms': summarize(latencies),
+    }
+    return result, [communicator for communicators in members for communicator in communicators]
+
+
+async def run(args, rooms: list, counter: QueryCounter) -> dict:
+    from config.asgi import application
+
+    connections, communicators = await run_connections(application, args, counter)
+    fanout, chat_communicators = await run_fanout(application, rooms, args, counter)
+    for communicator in communicators + chat_communicators:
+        await communicator.disconnect()
+    return {'connections': connections, 'fanout': fanout}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--room-size', type=int, default=10)
+    parser.add_argument('--rooms-per-user', type=int, default=5)
+    parser.add_argument('--history', type=int, default=50, help='messages per room')
+    parser.add_argument('--fanout-rooms', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=10, help='messages per fan-out room')
+    parser.add_argument('--interval', type=float, default=0.05, help='seconds between messages')
+    parser.add_argument('--concurrency', type=int, default=200, help='concurrent handshakes')
+    parser.add_argument('--layer', choices=['redis', 'memory'], default='memory')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    django.setup()
+    from django.db.backends.signals import connection_created
+    from django.db import connection, connections
+    from django.conf import settings
+
+    if args.layer == 'memory':
+        settings.CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+    counter = QueryCounter()
+    connection_created.connect(counter.install)
+    test_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        for alias in connections:
+            counter.install(connections[alias])
+        rooms = create_data(args)
+        with mock.patch('middlewares.websocket_auth.receive_user', stub_receive_user):
+            results = asyncio.run(run(args, rooms, counter))
+    finally:
+        connection.creation.destroy_test_db(test_name, verbosity=0)
+    report('websocket_load', results, vars(args), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class ChatsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chats'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from chats.profiling import install
+        import chats.signals  # noqa: F401
+
+        connection_created.connect(install)
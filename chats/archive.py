@@ -0,0 +1,95 @@
+"""
+Archived messages, one gzip compressed NDJSON file per room and month in `MESSAGE_ARCHIVE_DIR`.
+"""
+from chats.models import Message, MessageArchive
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from datetime import datetime
+import gzip
+import json
+import os
+
+
+def archive_path(room_uuid, month: datetime) -> str:
+    """
+    Get the path of the archive file relative to `MESSAGE_ARCHIVE_DIR`.
+    """
+    return os.path.join(f'{month:%Y-%m}', f'{room_uuid}.ndjson.gz')
+
+
+def write_archive(path: str, rows: list) -> None:
+    """
+    Write the message rows to the archive file, replacing it only when it is complete.
+    """
+    full_path = os.path.join(settings.MESSAGE_ARCHIVE_DIR, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with gzip.open(f'{full_path}.tmp', 'wt', encoding='utf-8') as file:
+        for row in rows:
+            file.write(json.dumps(row) + '\n')
+    os.replace(f'{full_path}.tmp', full_path)
+
+
+def read_archive(path: str) -> list:
+    """
+    Read the message rows from the archive file.
+    """
+    with gzip.open(os.path.join(settings.MESSAGE_ARCHIVE_DIR, path), 'rt', encoding='utf-8') as file:
+        return [json.loads(line) for line in file]
+
+
+def merge_archive(path: str, rows: list) -> list:
+    """
+    Merge the message rows into the rows of the existing archive file, ordered by sequence number.
+    Rows are the same message by sequence number, or by id without one, so archiving them again is harmless.
+    """
+    if not os.path.exists(os.path.join(settings.MESSAGE_ARCHIVE_DIR, path)):
+        return rows
+    merged = {}
+    for row in read_archive(path) + rows:
+        merged.setdefault(('seq', row['seq']) if row['seq'] is not None else ('id', row['id']), row)
+    return sorted(merged.values(), key=lambda row: (row['seq'] is None, row['seq'] or 0, row['id']))
+
+
+def message_row(message: Message) -> dict:
+    """
+    Convert the message to the archived row.
+    """
+    return {
+        'id': message.id,
+        'room_uuid': str(message.room_uuid),
+        'seq': message.seq,
+        'file': message.file.name or None,
+        'timestamp': message.timestamp.isoformat(),
+        'sender_id': message.sender_id,
+        'sender': message.sender.username,
+        'content': message.content,
+    }
+
+
+def row_data(row: dict) -> dict:
+    """
+    Convert the archived row to the message sent to the frontend, like `ChatConsumer.get_messages`.
+    """
+    message_data = {'seq': row['seq']}
+    if row['file']:
+        message_data['file'] = Message._meta.get_field('file').storage.url(row['file'])
+        message_data['file_name'] = row['file']
+    if row['content']:
+        message_data['content'] = row['content']
+    message_data['timestamp'] = datetime.fromisoformat(row['timestamp']).astimezone().strftime('%Y-%m-%d %H:%M:%S')
+    message_data['sender'] = row['sender']
+    return message_data
+
+
+async def get_archived_messages(room_uuid: str, before_seq: int, limit: int) -> list:
+    """
+    Get up to `limit` archived messages of the room before `before_seq`, oldest first.
+    """
+    messages = []
+    archives = MessageArchive.objects.filter(room_uuid=room_uuid, first_seq__lt=before_seq).order_by('-last_seq')
+    async for archive in archives:
+        rows = await sync_to_async(read_archive, thread_sensitive=False)(archive.path)
+        messages = [row_data(row) for row in rows if (row['seq'] or 0) < before_seq] + messages
+        if len(messages) >= limit:
+            break
+    return messages[-limit:]
@@ -1,14 +1,48 @@
-from chats.utils import set_status_async, filter_users, create_or_get_room, save_message, set_username_async
+from chats.utils import set_status_async, filter_users, create_or_get_room, save_message, set_username_async, \
+    mark_read, get_last_seq_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from channels.db import database_sync_to_async
+from chats.images import thumbnail_url, is_image
+from chats.membership import is_member, get_members
+from chats.fanout import FanoutMixin
 from django.contrib.auth import get_user_model
-from chats.models import Room, Message
+from django.db.models import BigIntegerField, F, FilteredRelation, Q
+from django.db.models.functions import Coalesce, Greatest
+from chats.models import Message, RoomSummary
+from chats.metrics import MetricsMixin, QUERY_SECONDS, SAVE_MESSAGE_SECONDS, GROUP_SEND_SECONDS
+from chats.profiling import ProfilingMixin
+from chats.db import DatabaseMixin
+from chats.drain import DrainMixin, in_flight
+from chats.heartbeat import HeartbeatMixin
+from chats.tokens import TokenRefreshMixin
+from chats.archive import get_archived_messages
+from chats.search import search_messages
+from chats import inbox, tracing
+from chats.routers import read_from_replica, replica_enabled, pin_primary
+from urllib.parse import parse_qs
+from django.conf import settings
+import asyncio
+import logging
 import json
+import sys
+
+logger = logging.getLogger(__name__)
 
 User = get_user_model()
 
+# Scope keys only needed during the handshake, dropped so idle connections do not keep the headers and tokens
+HANDSHAKE_SCOPE_KEYS = ('cookies', 'headers', 'session')
+
+
+def release_handshake(scope: dict) -> None:
+    """
+    Remove the handshake data from the scope of the consumer.
+    """
+    for key in HANDSHAKE_SCOPE_KEYS:
+        scope.pop(key, None)
+
 
-class ConnectionConsumer(AsyncJsonWebsocketConsumer):
+class ConnectionConsumer(ProfilingMixin, MetricsMixin, DrainMixin, DatabaseMixin, HeartbeatMixin, TokenRefreshMixin,
+                         AsyncJsonWebsocketConsumer):
     """
     Consumer for handling connection and disconnection of users.
     Check tokens and send them to the frontend.
@@ -16,10 +50,9 @@ class ConnectionConsumer(AsyncJsonWebsocketConsumer):
     Send the list of chats to the frontend.
     By disconnecting, set the user status to offline.
     """
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(args, kwargs)
-        self.username = None
+    frame_types = ('search_query', 'chat')
+    tracks_presence = True
+    username = None
 
     async def connect(self) -> None:
         """
@@ -28,7 +61,7 @@ class ConnectionConsumer(AsyncJsonWebsocketConsumer):
         """
         await self.accept()
 
-        self.username = self.scope['user'].username
+        self.username = sys.intern(self.scope['user'].username)
         await self.send_json({'username': self.username})
 
         if not self.username is None:
@@ -39,24 +72,29 @@ class ConnectionConsumer(AsyncJsonWebsocketConsumer):
             )
 
             await set_status_async(self.username, True)
-            chats = await self.get_chats(self.scope['user'])
+            with QUERY_SECONDS.time('get_chats'), read_from_replica():
+                chats = await self.get_chats(self.scope['user'])
 
             await self.send_tokens()
-            await self.send(text_data=json.dumps({
+            release_handshake(self.scope)
+            await self.send_json({
                 'username': self.username
-            }))
-            await self.send(text_data=json.dumps({
+            })
+            await self.send_json({
                 'chats': chats
-            }))
+            })
+            await self.send_inbox()
         else:
             await self.send_json({'error': 'No username'})
 
     async def disconnect(self, close_code: int) -> None:
         """
         Disconnect from the websocket.
-        Set status to offline and remove the user from the own group.
+        Set status to offline and remove the user from the own group, unless the drain already did.
         """
-        await set_status_async(self.username, False)
+        self.cancel_refresh()
+        if not self.presence_saved:
+            await set_status_async(self.username, False)
         await self.channel_layer.group_discard(self.username, self.channel_name)
 
     async def receive(self, text_data: str) -> None:
@@ -65,167 +103,406 @@ class ConnectionConsumer(AsyncJsonWebsocketConsumer):
         Check if the message is a search query to find users or a chat to create a new chat.
         """
         data = json.loads(text_data)
+        self.count_frame_in(data)
         search_query = data.get('search_query', None)
         username = data.get('chat', None)
 
         if search_query:
-            users = await filter_users(search_query)
-            await self.send(text_data=json.dumps({
+            with read_from_replica():
+                users = await filter_users(search_query)
+            await self.send_json({
                 'users': users
-            }))
+            })
         elif username:
             room = await create_or_get_room(username)
             await create_or_get_room(self.scope['user'])
-            await self.send(text_data=json.dumps({
+            pin_primary()
+            await self.send_json({
                 'room_uuid': str(room.uuid)
-            }))
+            })
 
-    @database_sync_to_async
-    def get_chats(self, user: User) -> list:
+    async def get_chats(self, user: User) -> list:
         """
-        Get the list of chats for the user.
+        Get the list of chats for the user with the avatars resized for the chat list.
+        """
+        chats = await self.get_chats_from_db(user)
+        members = [member for chat in chats for member in chat.get('users', [])]
+        avatars = await asyncio.gather(*(thumbnail_url(member['avatar'], 'small') for member in members))
+        for member, avatar in zip(members, avatars):
+            member['avatar'] = avatar
+        return chats
+
+    async def get_chats_from_db(self, user: User) -> list:
+        """
+        Get the list of chats for the user from the room summaries, the last active first.
         """
         chats = []
-        for chat in Room.objects.filter(users=user.id):
+        summaries = RoomSummary.objects.filter(room__users=user.id).annotate(
+            cursor=FilteredRelation('room__read_cursors', condition=Q(room__read_cursors__user=user.id)),
+        ).values(
+            'room__uuid', 'room__description', 'last_message', 'last_seq', 'last_activity', 'members',
+            unread=Coalesce(Greatest(
+                F('last_seq') - F('cursor__last_read_seq') - F('cursor__own_count'), 0, output_field=BigIntegerField(),
+            ), 0),
+        ).order_by('-last_activity')
+        async for summary in summaries:
             chat_data = {}
-            chat_data['uuid'] = str(chat.uuid)
-            chat_data['description'] = chat.description
-            users = []
-            for user in chat.users.all():
-                if user != self.scope['user']:
-                    users.append({
-                        'id': user.id,
-                        'username': user.username,
-                        'avatar': user.avatar.url if user.avatar else None
-                    })
-                chat_data['users'] = users
-            message = Message.objects.filter(room_uuid=chat.uuid).last()
-            if message:
-                chat_data['last_message'] = message.content
-                chat_data['timestamp'] = message.timestamp.astimezone().strftime('%Y-%m-%d %H:%M:%S')
+            chat_data['uuid'] = str(summary['room__uuid'])
+            chat_data['description'] = summary['room__description']
+            chat_data['unread'] = summary['unread']
+            if summary['members']:
+                chat_data['users'] = [member for member in summary['members'] if member['id'] != user.id]
+            if summary['last_seq'] is not None:
+                chat_data['last_message'] = summary['last_message']
+                chat_data['timestamp'] = summary['last_activity'].astimezone().strftime('%Y-%m-%d %H:%M:%S')
             chats.append(chat_data)
         return chats
 
+    async def send_inbox(self) -> None:
+        """
+        Send the messages received while the user had no chat of their rooms open, in one frame.
+        """
+        entries = await inbox.drop_read(self.scope['user'], await inbox.drain(self.username))
+        if entries:
+            await self.send_json({
+                'type': 'inbox',
+                'messages': entries,
+            })
+
+    async def chat_activity(self, event) -> None:
+        """
+        Send the coalesced new messages of the rooms without an open chat to the frontend.
+        """
+        await self.send_json({
+            'type': 'chat.activity',
+            'rooms': event['rooms'],
+        })
+
     async def send_tokens(self) -> None:
         """
-        Send tokens to the frontend.
+        Send tokens to the frontend and schedule their refresh before the access token expires.
         """
-        await self.send(text_data=json.dumps({
+        tokens = {
             'access': self.scope['cookies']['access'],
             'refresh': self.scope['cookies']['refresh'],
-        }))
+        }
+        await self.send_json(tokens)
+        self.schedule_refresh(tokens)
 
 
-class ChatConsumer(AsyncJsonWebsocketConsumer):
+class ChatConsumer(ProfilingMixin, MetricsMixin, DrainMixin, DatabaseMixin, HeartbeatMixin, FanoutMixin,
+                   AsyncJsonWebsocketConsumer):
     """
     Consumer for handling chat messages and statuses.
     Connect to the chat room, send messages to the frontend, and save them to the database.
     """
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(args, kwargs)
-        self.room_group_name = None
+    frame_types = ('chat.content', 'chat.status', 'chat.read', 'chat.history', 'chat.search')
+    # Defaults of the connection state, instances only store what they change
+    room_group_name = None
+    read_seq = None
+    read_flush = None
+    in_room = None
 
     async def connect(self) -> None:
         """
         Connect to the chat room, send messages to the frontend, and save them to the database.
+        A reconnecting client passes the last sequence number it has as `since_seq` and gets only the missing messages.
+        The group is joined before reading the history, so a message is never lost between both,
+        the frontend drops duplicates by `seq`.
+        Users who are not members of the room are rejected.
+        In a large room the consumer joins the worker node instead of the room group, see `chats.fanout`.
         """
-        self.room_group_name = self.scope['path'].split('/')[-1]
+        self.room_group_name = sys.intern(self.scope['path'].split('/')[-1])
+        release_handshake(self.scope)
+
+        if not await is_member(self.scope.get('user'), self.room_group_name):
+            await self.close(code=4403)
+            return
 
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        await self.join_fanout(self.room_group_name, len(await get_members(self.room_group_name)))
 
-        messages = await self.get_messages()
+        with QUERY_SECONDS.time('get_messages'):
+            messages = await self.load_messages(self.get_since_seq())
+        await self.attach_thumbnails(messages)
 
         await self.accept()
+        self.in_room = await inbox.enter_room(self.room_group_name, self.scope['user'].username)
 
         await self.send_messages(messages)
 
     async def disconnect(self, close_code: int) -> None:
         """
         Disconnect from the chat room.
+        Write the pending read marker.
         """
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        if self.in_room is not None:
+            await inbox.leave_room(self.room_group_name, self.scope['user'].username, self.in_room)
+        if self.read_flush is not None:
+            self.read_flush.cancel()
+            await self.flush_read()
+        await self.leave_fanout(self.room_group_name)
 
     async def receive(self, text_data: str) -> None:
         """
         Receive the message from the frontend.
         Check the message type and send the message or status to the frontend.
+        Membership is checked again against the cache, so removed users can not keep writing.
         """
+        if not await is_member(self.scope['user'], self.room_group_name):
+            await self.close(code=4403)
+            return
+
         data = await self.decode_json(text_data)
+        self.count_frame_in(data)
+        data['sender'] = self.scope['user'].username
         message_type = data.get('type', None)
         if message_type == 'chat.content':
-            await save_message(self.room_group_name, data)
-            await self.send_message(data)
+            trace = tracing.start_trace()
+            async with in_flight():
+                with SAVE_MESSAGE_SECONDS.time():
+                    message, _ = await save_message(self.room_group_name, data)
+                tracing.mark(trace, 'persisted')
+                pin_primary()
+                data['seq'] = message.seq
+                await self.send_message(data, trace)
+            await self.notify_members(message)
         elif message_type == 'chat.status':
             await self.send_status(data)
+        elif message_type == 'chat.read':
+            self.mark_read(data.get('seq'))
+        elif message_type == 'chat.history':
+            await self.send_history(data.get('before_seq'))
+        elif message_type == 'chat.search':
+            await self.send_search(data)
+
+    def mark_read(self, seq) -> None:
+        """
+        Remember the read marker from the frontend.
+        Markers are coalesced, only the highest one is written after `READ_MARKER_DELAY`.
+        """
+        if not isinstance(seq, int):
+            return
+        self.read_seq = max(self.read_seq or 0, seq)
+        if self.read_flush is None:
+            self.read_flush = asyncio.create_task(self.flush_read_later())
 
-    async def send_message(self, data) -> None:
+    async def flush_read_later(self) -> None:
         """
-        Send the message to the chat room.
+        Write the read marker after the delay.
+        Nothing awaits the task, so a failed write is logged here.
         """
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_content',
-                'content': data.get('content'),
-                'sender': data.get('sender'),
-            }
-        )
+        await asyncio.sleep(settings.READ_MARKER_DELAY)
+        self.read_flush = None
+        try:
+            await self.flush_read()
+        except Exception:
+            logger.exception('Could not write the read marker of %s in %s',
+                             self.scope['user'].username, self.room_group_name)
+
+    async def flush_read(self) -> None:
+        """
+        Write the pending read marker to the database.
+        """
+        seq, self.read_seq, self.read_flush = self.read_seq, None, None
+        if seq is not None:
+            await mark_read(self.scope['user'], self.room_group_name, seq)
+
+    async def group_send(self, event: dict) -> None:
+        """
+        Send the event to the chat room, once per worker node in a large room.
+        """
+        member_count = len(await get_members(self.room_group_name))
+        with GROUP_SEND_SECONDS.time(event['type']):
+            await self.publish(self.room_group_name, member_count, event)
+
+    async def send_message(self, data, trace: dict | None = None) -> None:
+        """
+        Send the message to the chat room, with the trace of a sampled message.
+        """
+        event = {
+            'type': 'chat_content',
+            'room': self.room_group_name,
+            'seq': data.get('seq'),
+            'content': data.get('content'),
+            'sender': data.get('sender'),
+        }
+        if trace is None:
+            return await self.group_send(event)
+        tracing.mark(trace, 'published')
+        event['trace'] = trace
+        await self.group_send(event)
+        tracing.export(trace, 'publish', event)
+
+    async def notify_members(self, message: Message) -> None:
+        """
+        Notify the members without an open chat of the room about the message, except in large rooms.
+        """
+        members = await get_members(self.room_group_name)
+        if len(members) >= settings.FANOUT_LARGE_ROOM_SIZE:
+            return
+        await inbox.notify_members(self.channel_layer, self.room_group_name, members, {
+            'seq': message.seq,
+            'content': message.content,
+            'sender': self.scope['user'].username,
+            'timestamp': message.timestamp.astimezone().strftime('%Y-%m-%d %H:%M:%S'),
+        })
 
     async def chat_content(self, event) -> None:
         """
         Send the message to the frontend.
         """
-        await self.send(text_data=json.dumps({
+        await self.send_json({
             'type': 'chat.content',
+            'seq': event['seq'],
             'content': event['content'],
             'sender': event['sender'],
-        }))
+        })
+        if 'trace' in event:
+            tracing.export(event['trace'], 'deliver', event, recipient=self.scope['user'].username)
 
     async def send_status(self, data: dict) -> None:
         """
         Send the status to the chat room.
         """
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_status',
-                'status': data.get('status'),
-                'sender': data.get('sender'),
-            }
-        )
+        await self.group_send({
+            'type': 'chat_status',
+            'room': self.room_group_name,
+            'status': data.get('status'),
+            'sender': data.get('sender'),
+        })
 
     async def chat_status(self, event) -> None:
         """
         Send the status to the frontend.
         """
-        await self.send(text_data=json.dumps({
+        await self.send_json({
             'type': 'chat.status',
             'status': event['status'],
             'sender': event['sender'],
-        }))
+        })
+
+    def get_since_seq(self) -> int | None:
+        """
+        Get the last sequence number the frontend already has from the query string.
+        """
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            return int(query['since_seq'][0])
+        except (KeyError, ValueError):
+            return None
 
-    @database_sync_to_async
-    def get_messages(self) -> list:
+    async def load_messages(self, since_seq: int | None = None) -> list:
         """
-        Get the list of messages from the database.
+        Get the list of messages from the replica, with the messages it has not replicated yet from the primary.
+        """
+        if not replica_enabled():
+            return await self.get_messages(since_seq)
+
+        with read_from_replica():
+            messages = await self.get_messages(since_seq)
+        last_seq = messages[-1]['seq'] if messages else since_seq or 0
+        if await get_last_seq_async(self.room_group_name) > last_seq:
+            messages += await self.get_messages(last_seq)
+        return messages
+
+    async def send_history(self, before_seq) -> None:
+        """
+        Send the page of messages before `before_seq` to the frontend.
+        """
+        if not isinstance(before_seq, int):
+            return
+        messages = await self.get_older_messages(before_seq)
+        await self.attach_thumbnails(messages)
+        await self.send_json({
+            'messages': messages,
+            'before_seq': before_seq,
+        })
+
+    async def send_search(self, data: dict) -> None:
+        """
+        Search the messages of the room, or of all rooms of the user with `all_rooms`, and send a page of results.
+        Results are sent in frames as they are read, the last one has `done` and the `cursor` of the next page,
+        which is None when there are no more results.
+        """
+        text = data.get('query')
+        if not isinstance(text, str) or not text.strip():
+            return
+        room_name = None if data.get('all_rooms') else self.room_group_name
+        results, count = None, 0
+        with QUERY_SECONDS.time('search_messages'), read_from_replica():
+            async for chunk in search_messages(self.scope['user'], text, room_name, data.get('cursor')):
+                if results is not None:
+                    await self.send_search_results(text, results)
+                results, count = chunk, count + len(chunk)
+        cursor = results[-1]['cursor'] if results and count == settings.MESSAGE_SEARCH_PAGE_SIZE else None
+        await self.send_search_results(text, results or [], done=True, cursor=cursor)
+
+    async def send_search_results(self, text: str, results: list, done: bool = False, cursor: str | None = None):
+        frame = {
+            'type': 'chat.search',
+            'query': text,
+            'results': results,
+            'done': done,
+        }
+        if done:
+            frame['cursor'] = cursor
+        await self.send_json(frame)
+
+    async def get_older_messages(self, before_seq: int) -> list:
+        """
+        Get the page of messages before `before_seq`, continued from the archive when the database has no more.
+        """
+        with QUERY_SECONDS.time('get_older_messages'), read_from_replica():
+            messages = await self.get_messages(before_seq=before_seq, limit=settings.MESSAGE_PAGE_SIZE)
+        if len(messages) < settings.MESSAGE_PAGE_SIZE:
+            oldest_seq = messages[0]['seq'] if messages else before_seq
+            messages = await get_archived_messages(
+                self.room_group_name, oldest_seq, settings.MESSAGE_PAGE_SIZE - len(messages),
+            ) + messages
+        return messages
+
+    async def get_messages(self, since_seq: int | None = None, before_seq: int | None = None,
+                           limit: int | None = None) -> list:
+        """
+        Get the list of messages from the database, only the ones after `since_seq` and before `before_seq` if given.
+        With `limit` only the last messages are returned.
         """
         messages = []
-        for message in Message.objects.filter(room_uuid=self.room_group_name):
-            message_data = {}
+        queryset = Message.objects.filter(room_uuid=self.room_group_name).select_related('sender')
+        if since_seq is not None:
+            queryset = queryset.filter(seq__gt=since_seq)
+        if before_seq is not None:
+            queryset = queryset.filter(seq__lt=before_seq)
+        if limit is None:
+            queryset = queryset.order_by('seq', 'id')
+        else:
+            queryset = queryset.order_by('-seq', '-id')[:limit]
+        async for message in queryset:
+            message_data = {'seq': message.seq}
             if message.file:
                 message_data['file'] = message.file.url
+                message_data['file_name'] = message.file.name
             if message.content:
                 message_data['content'] = message.content
             message_data['timestamp'] = message.timestamp.astimezone().strftime('%Y-%m-%d %H:%M:%S')
             message_data['sender'] = message.sender.username
             messages.append(message_data)
+        if limit is not None:
+            messages.reverse()
         return messages
 
+    async def attach_thumbnails(self, messages: list) -> None:
+        """
+        Add the preview url to the messages with an image attachment.
+        """
+        attachments = [message for message in messages if is_image(message.get('file_name'))]
+        thumbnails = await asyncio.gather(*(thumbnail_url(message['file_name'], 'medium') for message in attachments))
+        for message, thumbnail in zip(attachments, thumbnails):
+            message['thumbnail'] = thumbnail
+        for message in messages:
+            message.pop('file_name', None)
+
     async def send_messages(self, messages: list) -> None:
-        await self.send(text_data=json.dumps({
+        await self.send_json({
             'messages': messages,
-        }))
+        })
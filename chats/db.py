@@ -0,0 +1,112 @@
+"""
+Database access for the consumers.
+Django keeps one connection per thread, so the threads are the connection pool: the executor threads plus the
+thread-sensitive thread of the async ORM, `DB_EXECUTOR_WORKERS + 1` persistent connections per worker process.
+"""
+from django.db import close_old_connections, connections, DatabaseError
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import SyncToAsync, sync_to_async
+from chats.metrics import DB_EXECUTOR_WAIT_SECONDS
+from django.conf import settings
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def connect() -> None:
+    """
+    Open the connections of the executor thread up front, so the first calls do not pay for the setup.
+    """
+    for connection in connections.all():
+        try:
+            connection.ensure_connection()
+        except DatabaseError:
+            logger.warning('Could not open the %s database connection', connection.alias, exc_info=True)
+
+
+# Sized executor for the database work that can not use the async ORM, every thread keeps its own connection
+executor = ThreadPoolExecutor(
+    max_workers=settings.DB_EXECUTOR_WORKERS, thread_name_prefix='db', initializer=connect,
+)
+
+_warm = threading.Lock()
+_warmed = False
+
+
+def warm_up() -> None:
+    """
+    Start every executor thread with its connection.
+    Done on the first call and not on import, so management commands and tests connect to the right database.
+    """
+    global _warmed
+    with _warm:
+        if _warmed:
+            return
+        _warmed = True
+    # Threads are only started when the others are busy, the barrier keeps them busy until all are started
+    barrier = threading.Barrier(settings.DB_EXECUTOR_WORKERS)
+
+    def wait() -> None:
+        try:
+            barrier.wait(timeout=5)
+        except threading.BrokenBarrierError:
+            pass
+
+    for _ in range(settings.DB_EXECUTOR_WORKERS):
+        executor.submit(wait)
+
+
+class DatabaseExecutorSyncToAsync(SyncToAsync):
+    """
+    SyncToAsync running in the database executor instead of the shared thread-sensitive one.
+    Closes obsolete and broken connections around the call like `database_sync_to_async`,
+    healthy connections are kept for `CONN_MAX_AGE`.
+    """
+
+    def __init__(self, func):
+        super().__init__(self.timed, thread_sensitive=False, executor=executor)
+        self.database_func = func
+
+    def timed(self, started: list, *args, **kwargs):
+        started.append(time.perf_counter())
+        return self.database_func(*args, **kwargs)
+
+    async def __call__(self, *args, **kwargs):
+        warm_up()
+        submitted = time.perf_counter()
+        started = []
+        try:
+            return await super().__call__(started, *args, **kwargs)
+        finally:
+            if started:
+                DB_EXECUTOR_WAIT_SECONDS.observe(started[0] - submitted)
+
+    def thread_handler(self, loop, *args, **kwargs):
+        close_old_connections()
+        try:
+            return super().thread_handler(loop, *args, **kwargs)
+        finally:
+            close_old_connections()
+
+
+def db_sync_to_async(func):
+    """
+    Run the sync database function in the database executor.
+    Use it for transactions and other work with several statements.
+    """
+    return DatabaseExecutorSyncToAsync(func)
+
+
+class DatabaseMixin:
+    """
+    Close the connection of the async ORM thread when it is obsolete or broken, after the websocket is closed.
+    The async ORM does not do it around its queries, so without it a broken connection would be kept.
+    """
+
+    async def websocket_disconnect(self, message) -> None:
+        try:
+            await super().websocket_disconnect(message)
+        finally:
+            await sync_to_async(close_old_connections)()
@@ -0,0 +1,128 @@
+"""
+Drain mode for rolling restarts, started with `DRAIN_SIGNAL` (SIGUSR1 by default) before the worker is stopped.
+New sockets are told to reconnect, in-flight messages are saved, the presence of the connected users is written
+in one query and every client gets a reconnect frame with a random delay, so the reconnects are spread out.
+"""
+from chats.metrics import DRAINED_CONNECTIONS
+from channels.exceptions import StopConsumer
+from django.utils import timezone
+from contextlib import asynccontextmanager
+from chats.models import Status
+from django.conf import settings
+import asyncio
+import logging
+import signal
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+# Close code telling the client the server is restarting
+SERVICE_RESTART = 1012
+
+# Open consumers of the worker
+_consumers = set()
+_draining = False
+_in_flight = 0
+_signal_loops = set()
+
+
+def is_draining() -> bool:
+    return _draining
+
+
+def install_signal_handler() -> None:
+    """
+    Start the drain on `DRAIN_SIGNAL` in the running event loop, only possible in the main thread.
+    """
+    loop = asyncio.get_running_loop()
+    if loop in _signal_loops:
+        return
+    _signal_loops.add(loop)
+    try:
+        loop.add_signal_handler(getattr(signal, settings.DRAIN_SIGNAL), lambda: asyncio.ensure_future(drain()))
+    except (ValueError, RuntimeError, NotImplementedError, AttributeError):
+        logger.debug('Drain signal handler not installed in this event loop')
+
+
+@asynccontextmanager
+async def in_flight():
+    """
+    Mark the block as a write the drain waits for.
+    """
+    global _in_flight
+    _in_flight += 1
+    try:
+        yield
+    finally:
+        _in_flight -= 1
+
+
+def reconnect_delay() -> float:
+    """
+    Get the seconds the client waits before reconnecting, spread over `DRAIN_RECONNECT_SPREAD`.
+    """
+    return round(random.uniform(0, settings.DRAIN_RECONNECT_SPREAD), 1)
+
+
+async def send_reconnect(consumer) -> None:
+    """
+    Tell the client to reconnect after a delay and close the socket.
+    """
+    await consumer.send_json({'type': 'reconnect', 'retry_after': reconnect_delay()})
+    await consumer.close(code=SERVICE_RESTART)
+
+
+async def drain() -> None:
+    """
+    Stop accepting sockets, wait for the messages being saved, write the presence and close the open sockets.
+    """
+    global _draining
+    if _draining:
+        return
+    _draining = True
+    logger.info('Draining %d connections', len(_consumers))
+
+    deadline = time.monotonic() + settings.DRAIN_SAVE_TIMEOUT
+    while _in_flight and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+
+    consumers = list(_consumers)
+    usernames = {consumer.username for consumer in consumers if consumer.tracks_presence and consumer.username}
+    if usernames:
+        await Status.objects.filter(user__username__in=usernames).aupdate(online=False, last_seen=timezone.now())
+        for consumer in consumers:
+            consumer.presence_saved = True
+
+    results = await asyncio.gather(*(send_reconnect(consumer) for consumer in consumers), return_exceptions=True)
+    for consumer, result in zip(consumers, results):
+        if isinstance(result, Exception):
+            logger.warning('Could not close %s while draining', consumer, exc_info=result)
+    DRAINED_CONNECTIONS.inc(amount=len(consumers))
+
+
+class DrainMixin:
+    """
+    Register the open consumers of the worker and turn new sockets away while draining.
+    Consumers with `tracks_presence` have their `username` marked offline by the drain,
+    their disconnect handler skips it when `presence_saved` is set.
+    """
+    tracks_presence = False
+    presence_saved = False
+    turned_away = False
+
+    async def websocket_connect(self, message) -> None:
+        install_signal_handler()
+        if _draining:
+            self.turned_away = True
+            await self.accept()
+            await send_reconnect(self)
+            return
+        _consumers.add(self)
+        await super().websocket_connect(message)
+
+    async def websocket_disconnect(self, message) -> None:
+        _consumers.discard(self)
+        if self.turned_away:
+            raise StopConsumer()
+        await super().websocket_disconnect(message)
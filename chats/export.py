@@ -0,0 +1,126 @@
+"""
+Streaming NDJSON export and import of the chat data, used by the `export_chats` and `import_chats` commands.
+Every line is one record with its `model`: users first, then rooms with the usernames of their members,
+then messages with the username of their sender, so an import never needs a record from later in the file.
+Messages have the fields of the archived rows, see `chats.archive.message_row`.
+"""
+from chats.models import User, Room, Message
+from django.db.models import F
+from itertools import groupby
+import gzip
+import time
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+USER_FIELDS = ('username', 'email', 'bio', 'avatar', 'created_at', 'is_superuser')
+
+
+def open_export(path: str, compress: bool):
+    """
+    Open the export file for writing, compressed with gzip if asked.
+    """
+    if compress:
+        return gzip.open(path, 'wt', encoding='utf-8')
+    return open(path, 'w', encoding='utf-8')
+
+
+def open_import(path: str):
+    """
+    Open the export file for reading, gzip compressed files are detected by their content.
+    """
+    with open(path, 'rb') as file:
+        compressed = file.read(2) == GZIP_MAGIC
+    if compressed:
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+
+def isoformat(value) -> str | None:
+    return value.isoformat() if value is not None else None
+
+
+def user_records(chunk_size: int):
+    """
+    Yield the users in the order of their ids, read with a server-side cursor where the database has one.
+    """
+    for user in User.objects.order_by('id').values(*USER_FIELDS).iterator(chunk_size=chunk_size):
+        yield {
+            'model': 'user',
+            **user,
+            'avatar': user['avatar'] or None,
+            'created_at': isoformat(user['created_at']),
+        }
+
+
+def room_records(chunk_size: int):
+    """
+    Yield the rooms with their members, the memberships are read in room order next to the rooms.
+    """
+    memberships = groupby(
+        Room.users.through.objects.order_by('room_id', 'user_id').values_list(
+            'room_id', F('user__username'),
+        ).iterator(chunk_size=chunk_size),
+        key=lambda membership: membership[0],
+    )
+    room_id, members = next(memberships, (None, ()))
+    rooms = Room.objects.order_by('id').values('id', 'uuid', 'description', 'created_at').iterator(
+        chunk_size=chunk_size,
+    )
+    for room in rooms:
+        while room_id is not None and room_id < room['id']:
+            room_id, members = next(memberships, (None, ()))
+        yield {
+            'model': 'room',
+            'uuid': str(room['uuid']),
+            'description': room['description'],
+            'created_at': isoformat(room['created_at']),
+            'members': [username for _, username in members] if room_id == room['id'] else [],
+        }
+
+
+def message_records(chunk_size: int):
+    """
+    Yield the messages of every room in sequence order, along the index of the rooms and sequence numbers.
+    """
+    messages = Message.objects.order_by('room_uuid', 'seq', 'id').values(
+        'id', 'room_uuid', 'seq', 'file', 'timestamp', 'sender_id', 'content', sender_username=F('sender__username'),
+    ).iterator(chunk_size=chunk_size)
+    for message in messages:
+        yield {
+            'model': 'message',
+            'id': message['id'],
+            'room_uuid': str(message['room_uuid']),
+            'seq': message['seq'],
+            'file': message['file'] or None,
+            'timestamp': isoformat(message['timestamp']),
+            'sender_id': message['sender_id'],
+            'sender': message['sender_username'],
+            'content': message['content'],
+        }
+
+
+class Throughput:
+    """
+    Count the rows per model and report the rate every `interval` seconds and at the end.
+    """
+
+    def __init__(self, write, interval: float = 10):
+        self.write = write
+        self.interval = interval
+        self.counts = {}
+        self.started = self.reported = time.monotonic()
+
+    def add(self, model: str, count: int = 1) -> None:
+        self.counts[model] = self.counts.get(model, 0) + count
+        now = time.monotonic()
+        if now - self.reported >= self.interval:
+            self.reported = now
+            self.report()
+
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+    def report(self, prefix: str = '') -> None:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        counts = ', '.join(f'{count} {model}s' for model, count in self.counts.items()) or 'no rows'
+        self.write(f'{prefix}{counts} in {elapsed:.1f}s, {self.total() / elapsed:.0f} rows/s')
@@ -0,0 +1,292 @@
+"""
+Fan-out of large rooms through one node channel per worker.
+The mode of a room is shared between the workers in Redis: the first worker seeing `FANOUT_LARGE_ROOM_SIZE` members
+sets the flag of the room and tells the connected consumers to move to their worker node. The flag never goes back,
+a room which shrinks stays large. For `FANOUT_SWITCH_GRACE` seconds after the switch the messages are published to
+both groups and the consumers stay in both, so workers which did not see the switch yet lose nothing. Consumers get
+an event only once, the events published twice carry a `fanout_id`.
+While Redis is unavailable the mode of a room is unknown: consumers join both groups and messages are published to
+the room group, or to both groups if the worker counts enough members.
+"""
+from chats.redis_client import get_redis, mark_down, RedisError
+from collections import defaultdict, deque
+from django.conf import settings
+import asyncio
+import weakref
+import logging
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Modes of a room
+SMALL, SWITCHING, LARGE, UNKNOWN = 'small', 'switching', 'large', 'unknown'
+
+# Seconds before a failed node channel receives again
+RESTART_DELAY = 1
+
+# Events remembered per consumer in both groups to drop the second copy
+SEEN_SIZE = 256
+
+# Nodes are bound to the event loop of the worker
+_nodes = weakref.WeakKeyDictionary()
+
+# Rooms known to be large: room -> time of the switch, the switch never goes back
+_large_rooms = {}
+# Rooms seen small: room -> monotonic time until the mode is read again
+_small_rooms = {}
+
+
+def node_group(room_name: str) -> str:
+    """
+    Get the group of the large room, its members are the node channels of the workers.
+    """
+    return f'{room_name}.nodes'
+
+
+def large_room_key(room_name: str) -> str:
+    return f'fanout-large:{room_name}'
+
+
+def switch_mode(switched_at: float) -> str:
+    return SWITCHING if time.time() < switched_at + settings.FANOUT_SWITCH_GRACE else LARGE
+
+
+def switch_remaining(room_name: str) -> float:
+    """
+    Get the seconds until the switch of the room to the worker nodes is over.
+    """
+    return max(0.0, _large_rooms.get(room_name, 0) + settings.FANOUT_SWITCH_GRACE - time.time())
+
+
+async def room_mode(channel_layer, room_name: str, member_count: int, cached: bool = True) -> str:
+    """
+    Get the mode of the room from Redis, switch it to the worker nodes if it has enough members.
+    Small rooms are read again after `FANOUT_MODE_TTL` seconds, `cached=False` always reads it.
+    """
+    switched_at = _large_rooms.get(room_name)
+    if switched_at is not None:
+        return switch_mode(switched_at)
+    large = member_count >= settings.FANOUT_LARGE_ROOM_SIZE
+    if cached and not large and _small_rooms.get(room_name, 0) > time.monotonic():
+        return SMALL
+
+    redis = get_redis()
+    if redis is None:
+        return UNKNOWN
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            if large:
+                pipe.set(large_room_key(room_name), time.time(), nx=True)
+            pipe.get(large_room_key(room_name))
+            *created, value = await pipe.execute()
+    except RedisError:
+        mark_down()
+        return UNKNOWN
+
+    if value is None:
+        if len(_small_rooms) >= settings.MEMBERSHIP_CACHE_SIZE:
+            _small_rooms.clear()
+        _small_rooms[room_name] = time.monotonic() + settings.FANOUT_MODE_TTL
+        return SMALL
+    _small_rooms.pop(room_name, None)
+    switched_at = _large_rooms[room_name] = float(value)
+    if created and created[0]:
+        # Consumers which joined the room group before the switch move to their worker node
+        await channel_layer.group_send(room_name, {'type': 'fanout_switch', 'room': room_name, 'at': switched_at})
+    return switch_mode(switched_at)
+
+
+def publish_groups(room_name: str, mode: str, member_count: int) -> tuple:
+    """
+    Get the groups a message of the room is published to.
+    """
+    if mode == SMALL or mode == UNKNOWN and member_count < settings.FANOUT_LARGE_ROOM_SIZE:
+        return (room_name,)
+    if mode == LARGE:
+        return (node_group(room_name),)
+    return room_name, node_group(room_name)
+
+
+class Node:
+    """
+    Fan-out of large rooms inside one worker.
+    The worker joins the room with a single node channel, so a message is published once per worker
+    and expanded here to the consumers of the room connected to this worker.
+    """
+
+    def __init__(self, channel_layer):
+        self.channel_layer = channel_layer
+        self.channel_name = None
+        self.task = None
+        self.renew_task = None
+        self.lock = asyncio.Lock()
+        self.rooms = defaultdict(set)
+
+    async def join(self, room_name: str, consumer) -> None:
+        """
+        Add the consumer to the room, join the room group with the node channel if needed.
+        """
+        async with self.lock:
+            if self.channel_name is None:
+                self.channel_name = await self.channel_layer.new_channel('node.')
+                self.task = asyncio.create_task(self.run())
+                self.renew_task = asyncio.create_task(self.renew())
+            if room_name not in self.rooms:
+                await self.channel_layer.group_add(node_group(room_name), self.channel_name)
+            self.rooms[room_name].add(consumer)
+
+    async def leave(self, room_name: str, consumer) -> None:
+        """
+        Remove the consumer from the room, leave the room group with the last consumer.
+        """
+        async with self.lock:
+            consumers = self.rooms.get(room_name)
+            if consumers is None:
+                return
+            consumers.discard(consumer)
+            if not consumers:
+                del self.rooms[room_name]
+                await self.channel_layer.group_discard(node_group(room_name), self.channel_name)
+
+    def stop(self) -> None:
+        for task in (self.task, self.renew_task):
+            if task is not None:
+                task.cancel()
+
+    async def run(self) -> None:
+        """
+        Receive the room messages on the node channel, receiving again after a failure of the channel layer.
+        """
+        while True:
+            try:
+                await self.receive()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Node %s failed to receive, restarting', self.channel_name)
+                await asyncio.sleep(RESTART_DELAY)
+
+    async def receive(self) -> None:
+        """
+        Dispatch the room messages to the local consumers.
+        """
+        while True:
+            message = await self.channel_layer.receive(self.channel_name)
+            for consumer in list(self.rooms.get(message.get('room'), ())):
+                try:
+                    await consumer.dispatch(message)
+                except Exception:
+                    logger.exception('Failed to dispatch %s to %s', message.get('type'), consumer.channel_name)
+
+    async def renew(self) -> None:
+        """
+        Renew the membership in the room groups every `FANOUT_GROUP_REFRESH` seconds, before the channel layer
+        expires it, also in rooms no consumer joined since.
+        """
+        while True:
+            await asyncio.sleep(settings.FANOUT_GROUP_REFRESH)
+            for room_name in list(self.rooms):
+                try:
+                    await self.channel_layer.group_add(node_group(room_name), self.channel_name)
+                except Exception:
+                    logger.exception('Node %s failed to renew %s', self.channel_name, room_name)
+
+
+def get_node(channel_layer) -> Node:
+    """
+    Get the node of the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    node = _nodes.get(loop)
+    if node is None:
+        node = _nodes[loop] = Node(channel_layer)
+    return node
+
+
+class FanoutMixin:
+    """
+    Join a chat room in its fan-out mode and publish to it, see the module.
+    The consumer calls `join_fanout` after the membership check, `leave_fanout` on disconnect
+    and sends its events with `publish`.
+    """
+    in_group = False
+    in_node = False
+    group_leave = None
+    seen_ids = None
+
+    async def join_fanout(self, room_name: str, member_count: int) -> None:
+        """
+        Join the room group first, so a switch after reading the mode reaches the consumer.
+        """
+        await self.channel_layer.group_add(room_name, self.channel_name)
+        self.in_group = True
+        mode = await room_mode(self.channel_layer, room_name, member_count, cached=False)
+        if mode == LARGE:
+            await get_node(self.channel_layer).join(room_name, self)
+            self.in_node = True
+            await self.channel_layer.group_discard(room_name, self.channel_name)
+            self.in_group = False
+        elif mode != SMALL:
+            await self.join_node(room_name, leave_group=mode == SWITCHING)
+
+    async def join_node(self, room_name: str, leave_group: bool) -> None:
+        """
+        Join the worker node while staying in the room group, until the switch is over if `leave_group`.
+        """
+        self.seen_ids = deque(maxlen=SEEN_SIZE)
+        await get_node(self.channel_layer).join(room_name, self)
+        self.in_node = True
+        if leave_group:
+            self.group_leave = asyncio.create_task(self.leave_group_later(room_name, switch_remaining(room_name)))
+
+    async def leave_group_later(self, room_name: str, delay: float) -> None:
+        await asyncio.sleep(delay)
+        self.group_leave = None
+        try:
+            await self.channel_layer.group_discard(room_name, self.channel_name)
+        except Exception:
+            logger.exception('Failed to leave the group of %s', room_name)
+            return
+        self.in_group = False
+        self.seen_ids = None
+
+    async def leave_fanout(self, room_name: str) -> None:
+        if self.group_leave is not None:
+            self.group_leave.cancel()
+            self.group_leave = None
+        if self.in_node:
+            await get_node(self.channel_layer).leave(room_name, self)
+        if self.in_group:
+            await self.channel_layer.group_discard(room_name, self.channel_name)
+
+    async def publish(self, room_name: str, member_count: int, event: dict) -> None:
+        """
+        Publish the event to the groups of the room mode.
+        """
+        groups = publish_groups(room_name, await room_mode(self.channel_layer, room_name, member_count), member_count)
+        if len(groups) > 1:
+            event['fanout_id'] = uuid.uuid4().hex
+        for group in groups:
+            await self.channel_layer.group_send(group, event)
+
+    async def fanout_switch(self, event) -> None:
+        """
+        Move to the worker node after the room switched.
+        """
+        room_name = event['room']
+        _large_rooms.setdefault(room_name, event['at'])
+        _small_rooms.pop(room_name, None)
+        if not self.in_node:
+            await self.join_node(room_name, leave_group=True)
+
+    async def dispatch(self, message) -> None:
+        """
+        Drop the second copy of an event published to both groups.
+        """
+        fanout_id = message.get('fanout_id')
+        if fanout_id is not None and self.seen_ids is not None:
+            if fanout_id in self.seen_ids:
+                return
+            self.seen_ids.append(fanout_id)
+        await super().dispatch(message)
@@ -0,0 +1,144 @@
+"""
+Application-level heartbeat of the websockets.
+One loop per worker sends `{"type": "ping"}` every `HEARTBEAT_INTERVAL` seconds, the client answers with
+`{"type": "pong"}`, any frame from the client counts as an answer. Connections without a frame for
+`HEARTBEAT_MISSES` intervals are reaped: their presence is written in one query and the socket is closed with
+code 4408, the disconnect from the server then runs the disconnect handler in the consumer, after the handler it may
+still be in. A `HEARTBEAT_INTERVAL` of 0 turns the heartbeat off.
+"""
+from chats.metrics import REAPED_CONNECTIONS
+from chats import inbox
+from django.utils import timezone
+from chats.models import Status
+from django.conf import settings
+import asyncio
+import logging
+import weakref
+import json
+import time
+
+logger = logging.getLogger(__name__)
+
+# Close code telling the client it missed the heartbeats
+HEARTBEAT_TIMEOUT = 4408
+
+PING = json.dumps({'type': 'ping'})
+
+
+def is_pong(text: str | None) -> bool:
+    """
+    Check if the frame is the answer to a ping, only short frames are parsed.
+    """
+    if text is None or len(text) > 64 or 'pong' not in text:
+        return False
+    try:
+        return json.loads(text).get('type') == 'pong'
+    except (ValueError, AttributeError):
+        return False
+
+
+class Heartbeat:
+    """
+    Open consumers of the event loop and the loop pinging and reaping them, running while there are consumers.
+    """
+
+    def __init__(self):
+        # Consumers closed without a disconnect, like the ones turned away by the drain, are dropped with them
+        self.consumers = weakref.WeakSet()
+        self.task = None
+
+    def add(self, consumer) -> None:
+        if settings.HEARTBEAT_INTERVAL <= 0:
+            return
+        consumer.heartbeat_at = time.monotonic()
+        self.consumers.add(consumer)
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def discard(self, consumer) -> None:
+        self.consumers.discard(consumer)
+
+    async def run(self) -> None:
+        while self.consumers:
+            await asyncio.sleep(settings.HEARTBEAT_INTERVAL)
+            try:
+                await self.beat()
+            except Exception:
+                logger.exception('Heartbeat failed')
+        self.task = None
+
+    async def beat(self) -> None:
+        """
+        Reap the consumers without a frame for `HEARTBEAT_MISSES` intervals, ping the others and renew their open chats.
+        """
+        deadline = time.monotonic() - settings.HEARTBEAT_INTERVAL * settings.HEARTBEAT_MISSES
+        consumers = list(self.consumers)
+        dead = [consumer for consumer in consumers if consumer.heartbeat_at < deadline]
+        if dead:
+            await self.reap(dead)
+        alive = [consumer for consumer in consumers if not consumer.reaped]
+        await asyncio.gather(*(consumer.send(text_data=PING) for consumer in alive), return_exceptions=True)
+        open_chats = [(consumer.room_group_name, consumer.scope['user'].username)
+                      for consumer in alive if getattr(consumer, 'in_room', False)]
+        if open_chats:
+            await inbox.renew_rooms(open_chats)
+
+    async def reap(self, consumers: list) -> None:
+        """
+        Write the presence of the consumers in one query and close them.
+        """
+        for consumer in consumers:
+            consumer.reaped = True
+            self.consumers.discard(consumer)
+
+        usernames = {consumer.username for consumer in consumers
+                     if consumer.tracks_presence and consumer.username and not consumer.presence_saved}
+        if usernames:
+            await Status.objects.filter(user__username__in=usernames).aupdate(online=False, last_seen=timezone.now())
+        for consumer in consumers:
+            consumer.presence_saved = True
+
+        results = await asyncio.gather(*(
+            consumer.close(code=HEARTBEAT_TIMEOUT) for consumer in consumers
+        ), return_exceptions=True)
+        for consumer, result in zip(consumers, results):
+            if isinstance(result, Exception):
+                logger.warning('Could not reap %s', consumer, exc_info=result)
+            REAPED_CONNECTIONS.inc(type(consumer).__name__)
+        logger.info('Reaped %d connections', len(consumers))
+
+
+# Heartbeats are bound to the event loop of the worker
+_heartbeats = weakref.WeakKeyDictionary()
+
+
+def get_heartbeat() -> Heartbeat:
+    loop = asyncio.get_running_loop()
+    heartbeat = _heartbeats.get(loop)
+    if heartbeat is None:
+        heartbeat = _heartbeats[loop] = Heartbeat()
+    return heartbeat
+
+
+class HeartbeatMixin:
+    """
+    Register the accepted consumers with the heartbeat of the worker and answer nothing to pongs.
+    Consumers with `tracks_presence` have their `username` marked offline when reaped, like with the drain,
+    consumers with an open chat counted in Redis (`in_room`) have it renewed with every beat.
+    """
+    heartbeat_at = 0.0
+    reaped = False
+
+    async def accept(self, subprotocol=None) -> None:
+        await super().accept(subprotocol)
+        get_heartbeat().add(self)
+
+    async def websocket_receive(self, message) -> None:
+        self.heartbeat_at = time.monotonic()
+        if is_pong(message.get('text')):
+            return
+        await super().websocket_receive(message)
+
+    async def websocket_disconnect(self, message) -> None:
+        get_heartbeat().discard(self)
+        await super().websocket_disconnect(message)
@@ -0,0 +1,127 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from django.core.files.storage import default_storage
+from django.conf import settings
+from PIL import Image, ImageOps
+import multiprocessing
+import asyncio
+import hashlib
+import os
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
+
+_executor = None
+# (name, size) -> variant name, so repeated lookups skip the process pool, at most `THUMBNAIL_CACHE_SIZE`
+_variants = {}
+# (name, size) -> renders in flight, at most `THUMBNAIL_MAX_PENDING`
+_pending = {}
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """
+    Get the process pool used to render thumbnails.
+    The workers are started by a fork server, or spawned where there is none, forking the ASGI worker could copy
+    locks held by its threads.
+    """
+    global _executor
+    if _executor is None:
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.THUMBNAIL_WORKERS, mp_context=multiprocessing.get_context(method),
+        )
+    return _executor
+
+
+def discard_executor(executor: ProcessPoolExecutor) -> None:
+    """
+    Drop the broken process pool, so the next render starts a new one.
+    """
+    global _executor
+    if _executor is executor:
+        _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def is_image(name: str) -> bool:
+    """
+    Check by extension if the stored file is an image.
+    """
+    return bool(name) and name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def render_thumbnail(path: str, size: int) -> str:
+    """
+    Render a thumbnail next to the original image and return its path.
+    The variant name contains the content hash, so an existing file is reused instead of rendered again.
+    Runs inside the process pool, it must not touch Django.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(64 * 1024), b''):
+            digest.update(chunk)
+
+    variant_path = f'{os.path.splitext(path)[0]}.{digest.hexdigest()[:16]}.{size}.webp'
+    if os.path.exists(variant_path):
+        return variant_path
+
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image)
+        image = ImageOps.fit(image.convert('RGBA'), (size, size), Image.LANCZOS)
+        tmp_path = f'{variant_path}.tmp'
+        image.save(tmp_path, 'WEBP', quality=85)
+        os.replace(tmp_path, variant_path)
+    return variant_path
+
+
+async def get_thumbnail(name: str, size: str) -> str | None:
+    """
+    Get the storage name of the thumbnail variant, rendering it in the process pool when needed.
+    Returns None while `THUMBNAIL_MAX_PENDING` renders are in flight.
+    """
+    key = (name, size)
+    if key in _variants:
+        return _variants[key]
+
+    if key not in _pending:
+        if len(_pending) >= settings.THUMBNAIL_MAX_PENDING:
+            return None
+        root = default_storage.path('')
+        path = default_storage.path(name)
+        loop = asyncio.get_running_loop()
+        executor = get_executor()
+        try:
+            future = loop.run_in_executor(executor, render_thumbnail, path, settings.THUMBNAIL_SIZES[size])
+        except BrokenProcessPool:
+            discard_executor(executor)
+            raise
+        _pending[key] = (root, executor, future)
+
+    root, executor, future = _pending[key]
+    try:
+        variant_path = await asyncio.shield(future)
+    except BrokenProcessPool:
+        # A worker process died, the pool refuses all renders from now on
+        discard_executor(executor)
+        raise
+    finally:
+        _pending.pop(key, None)
+
+    variant = os.path.relpath(variant_path, root).replace(os.sep, '/')
+    if len(_variants) >= settings.THUMBNAIL_CACHE_SIZE:
+        _variants.clear()
+    _variants[key] = variant
+    return variant
+
+
+async def thumbnail_url(name: str | None, size: str) -> str | None:
+    """
+    Get the url of the thumbnail for the stored image.
+    Falls back to the original url if the thumbnail can not be rendered.
+    """
+    if not name:
+        return None
+    try:
+        variant = await get_thumbnail(name, size)
+    except (OSError, ValueError, NotImplementedError, BrokenProcessPool):
+        variant = None
+    return default_storage.url(variant or name)
@@ -0,0 +1,218 @@
+"""
+Offline inbox of the users.
+Members of a room without an open chat of it get the new messages in a bounded inbox, drained in one frame when
+they connect, and coalesced activity events on their personal group if they are connected.
+The inbox and the open chats are kept in Redis, with a store in the worker while Redis is unavailable.
+Entries the user read in the meantime, e.g. on another device, are dropped when the inbox is sent.
+"""
+from chats.redis_client import get_redis, mark_down, RedisError
+from chats.models import ReadCursor
+from collections import defaultdict, deque, Counter
+from django.conf import settings
+import asyncio
+import weakref
+import json
+
+# Local store used while Redis is unavailable: username -> entries, room -> open chats per username
+_local_inboxes = defaultdict(lambda: deque(maxlen=settings.INBOX_SIZE))
+_local_in_room = defaultdict(Counter)
+
+# Coalescers are bound to the event loop of the worker
+_coalescers = weakref.WeakKeyDictionary()
+
+
+def inbox_key(username: str) -> str:
+    return f'inbox:{username}'
+
+
+def in_room_key(room_name: str, username: str) -> str:
+    return f'in-room:{room_name}:{username}'
+
+
+# Uncount an open chat, the counter is removed with the last one
+LEAVE_ROOM = """
+local count = redis.call('decr', KEYS[1])
+if count <= 0 then
+    redis.call('del', KEYS[1])
+end
+return count
+"""
+
+
+async def enter_room(room_name: str, username: str) -> bool:
+    """
+    Count the open chat of the user in the room.
+    Every user has a counter per room expiring after `INBOX_IN_ROOM_TTL`, renewed by the heartbeat while the chat
+    is open, so the chats of a worker which died are forgotten even while the room stays active.
+    Returns True if the chat was counted in Redis, pass it to `leave_room`.
+    """
+    redis = get_redis()
+    if redis is not None:
+        try:
+            async with redis.pipeline(transaction=False) as pipe:
+                pipe.incr(in_room_key(room_name, username))
+                pipe.expire(in_room_key(room_name, username), int(settings.INBOX_IN_ROOM_TTL))
+                await pipe.execute()
+            return True
+        except RedisError:
+            mark_down()
+    _local_in_room[room_name][username] += 1
+    return False
+
+
+async def leave_room(room_name: str, username: str, in_redis: bool) -> None:
+    """
+    Uncount the open chat of the user in the room.
+    """
+    if not in_redis:
+        _local_in_room[room_name][username] -= 1
+        if not +_local_in_room[room_name]:
+            del _local_in_room[room_name]
+        return
+    redis = get_redis()
+    if redis is None:
+        return
+    try:
+        await redis.eval(LEAVE_ROOM, 1, in_room_key(room_name, username))
+    except RedisError:
+        mark_down()
+
+
+async def renew_rooms(open_chats: list) -> None:
+    """
+    Renew the expiry of the open chats counted in Redis, given as (room, username).
+    """
+    redis = get_redis()
+    if redis is None:
+        return
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            for room_name, username in open_chats:
+                pipe.expire(in_room_key(room_name, username), int(settings.INBOX_IN_ROOM_TTL))
+            await pipe.execute()
+    except RedisError:
+        mark_down()
+
+
+async def get_in_room(room_name: str, usernames: list) -> set:
+    """
+    Get the users among `usernames` with an open chat of the room.
+    """
+    local = _local_in_room.get(room_name, {})
+    in_room = {username for username in usernames if local.get(username, 0) > 0}
+    redis = get_redis()
+    if redis is None or not usernames:
+        return in_room
+    try:
+        counts = await redis.mget([in_room_key(room_name, username) for username in usernames])
+    except RedisError:
+        mark_down()
+        return in_room
+    return in_room | {username for username, count in zip(usernames, counts) if count is not None and int(count) > 0}
+
+
+async def push(usernames: list, entry: dict) -> None:
+    """
+    Append the entry to the inboxes of the users, keeping the last `INBOX_SIZE` entries for `INBOX_TTL` seconds.
+    """
+    redis = get_redis()
+    if redis is not None:
+        data = json.dumps(entry)
+        try:
+            async with redis.pipeline(transaction=False) as pipe:
+                for username in usernames:
+                    pipe.rpush(inbox_key(username), data)
+                    pipe.ltrim(inbox_key(username), -settings.INBOX_SIZE, -1)
+                    pipe.expire(inbox_key(username), int(settings.INBOX_TTL))
+                await pipe.execute()
+            return
+        except RedisError:
+            mark_down()
+    for username in usernames:
+        _local_inboxes[username].append(entry)
+
+
+async def drain(username: str) -> list:
+    """
+    Take all entries of the inbox of the user, oldest first.
+    """
+    entries = list(_local_inboxes.pop(username, ()))
+    redis = get_redis()
+    if redis is None:
+        return entries
+    try:
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.lrange(inbox_key(username), 0, -1)
+            pipe.delete(inbox_key(username))
+            stored, _ = await pipe.execute()
+    except RedisError:
+        mark_down()
+        return entries
+    return [json.loads(data) for data in stored] + entries
+
+
+async def drop_read(user, entries: list) -> list:
+    """
+    Drop the entries at or below the read cursor of the user in their room, read in the meantime.
+    """
+    if not entries:
+        return entries
+    cursors = ReadCursor.objects.filter(user=user, room__uuid__in={entry['room'] for entry in entries})
+    read = {str(room_uuid): seq async for room_uuid, seq in cursors.values_list('room__uuid', 'last_read_seq')}
+    return [entry for entry in entries if entry.get('seq') is None or entry['seq'] > read.get(entry['room'], 0)]
+
+
+class ActivityCoalescer:
+    """
+    Collect the new messages per user and send one `chat_activity` event per user every `INBOX_ACTIVITY_DELAY`.
+    """
+
+    def __init__(self, channel_layer):
+        self.channel_layer = channel_layer
+        # username -> room -> {'count': new messages, 'last_seq': last sequence number}
+        self.pending = defaultdict(dict)
+        self.flush_task = None
+
+    def add(self, usernames: list, room_name: str, seq: int | None) -> None:
+        for username in usernames:
+            room = self.pending[username].setdefault(room_name, {'count': 0, 'last_seq': None})
+            room['count'] += 1
+            room['last_seq'] = seq
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self) -> None:
+        await asyncio.sleep(settings.INBOX_ACTIVITY_DELAY)
+        pending, self.pending, self.flush_task = self.pending, defaultdict(dict), None
+        await asyncio.gather(*(
+            self.channel_layer.group_send(username, {'type': 'chat_activity', 'rooms': rooms})
+            for username, rooms in pending.items()
+        ), return_exceptions=True)
+
+
+def get_coalescer(channel_layer) -> ActivityCoalescer:
+    loop = asyncio.get_running_loop()
+    coalescer = _coalescers.get(loop)
+    if coalescer is None:
+        coalescer = _coalescers[loop] = ActivityCoalescer(channel_layer)
+    return coalescer
+
+
+async def notify_members(channel_layer, room_name: str, members: dict, message: dict) -> None:
+    """
+    Put the message into the inboxes of the room members without an open chat of the room, except the sender,
+    and schedule their activity events.
+    """
+    usernames = [username for username in members.values() if username != message['sender']]
+    in_room = await get_in_room(room_name, usernames)
+    usernames = [username for username in usernames if username not in in_room]
+    if not usernames:
+        return
+    await push(usernames, {
+        'room': room_name,
+        'seq': message.get('seq'),
+        'sender': message['sender'],
+        'preview': (message.get('content') or '')[:settings.SUMMARY_PREVIEW_LENGTH],
+        'timestamp': message.get('timestamp'),
+    })
+    get_coalescer(channel_layer).add(usernames, room_name, message.get('seq'))
@@ -0,0 +1,30 @@
+from channels_redis.core import RedisChannelLayer
+import hashlib
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """
+    Jump consistent hash, maps the key to one of the buckets.
+    Growing from n to n + 1 buckets only moves 1 / (n + 1) of the keys.
+    """
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """
+    Redis channel layer sharding channels and groups over the hosts with a jump consistent hash.
+    The default layer splits the CRC range evenly, so adding a host moves most groups to another host.
+    """
+
+    def consistent_hash(self, value) -> int:
+        if self.ring_size == 1:
+            return 0
+        if isinstance(value, str):
+            value = value.encode('utf8')
+        key = int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), 'little')
+        return jump_hash(key, self.ring_size)
@@ -0,0 +1,94 @@
+from chats.partitions import month_start, add_months, is_partitioned, create_partitions, partition_exists, \
+    drop_partition, partition_name
+from chats.archive import archive_path, merge_archive, write_archive, message_row
+from django.core.management.base import BaseCommand
+from chats.models import Message, MessageArchive
+from django.db import connection, transaction
+from django.db.models import Min
+from django.utils import timezone
+from django.conf import settings
+from itertools import groupby
+from datetime import timedelta
+
+# Messages deleted per query
+DELETE_CHUNK_SIZE = 2000
+
+
+class Command(BaseCommand):
+    help = 'Move the messages older than the archive age to compressed files and create the upcoming partitions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.MESSAGE_ARCHIVE_AFTER_DAYS,
+                            help='archive the months ended more than this many days ago')
+
+    def handle(self, *args, **options):
+        partitioned = is_partitioned(connection)
+        if partitioned:
+            create_partitions(connection, timezone.now(), settings.MESSAGE_PARTITIONS_AHEAD)
+
+        first = Message.objects.aggregate(Min('timestamp'))['timestamp__min']
+        if first is None:
+            return
+        cutoff = month_start(timezone.now() - timedelta(days=options['days']))
+        month = month_start(first)
+        while month < cutoff:
+            self.archive_month(month, partitioned)
+            month = add_months(month, 1)
+
+    def archive_month(self, month, partitioned: bool) -> None:
+        """
+        Merge the messages of the month into one file per room, then drop the partition of the month.
+        The partition is locked against writes until it is dropped, without one only the archived ids are deleted,
+        so messages written meanwhile stay for the next run. Months which got messages again after they were
+        archived, e.g. by `import_chats`, are merged into their files.
+        """
+        messages = Message.objects.filter(timestamp__gte=month, timestamp__lt=add_months(month, 1))
+        with transaction.atomic():
+            drop = partitioned and partition_exists(connection, month)
+            if drop:
+                with connection.cursor() as cursor:
+                    cursor.execute(f'LOCK TABLE {partition_name(month)} IN SHARE MODE')
+            archives, ids = self.write_month(messages, month)
+            for archive in archives:
+                MessageArchive.objects.update_or_create(
+                    room_uuid=archive.room_uuid, month=archive.month, defaults={
+                        'first_seq': archive.first_seq,
+                        'last_seq': archive.last_seq,
+                        'count': archive.count,
+                        'path': archive.path,
+                    },
+                )
+            if drop:
+                drop_partition(connection, month)
+            else:
+                # Rows of the month in the default partition, or all of them without partitions
+                for start in range(0, len(ids), DELETE_CHUNK_SIZE):
+                    messages.filter(id__in=ids[start:start + DELETE_CHUNK_SIZE]).delete()
+
+        if archives:
+            self.stdout.write(f'Archived {len(ids)} messages of {month:%Y-%m} in {len(archives)} rooms')
+
+    def write_month(self, messages, month) -> tuple:
+        """
+        Merge the messages into the archive files of their rooms.
+        Returns the archives and the ids of the archived messages.
+        """
+        archives, ids = [], []
+        rows = (message_row(message) for message in
+                messages.select_related('sender').order_by('room_uuid', 'seq', 'id').iterator(chunk_size=2000))
+        for room_uuid, room_rows in groupby(rows, key=lambda row: row['room_uuid']):
+            room_rows = list(room_rows)
+            ids.extend(row['id'] for row in room_rows)
+            path = archive_path(room_uuid, month)
+            room_rows = merge_archive(path, room_rows)
+            write_archive(path, room_rows)
+            seqs = [row['seq'] for row in room_rows if row['seq'] is not None]
+            archives.append(MessageArchive(
+                room_uuid=room_uuid,
+                month=month,
+                first_seq=min(seqs, default=None),
+                last_seq=max(seqs, default=None),
+                count=len(room_rows),
+                path=path,
+            ))
+        return archives, ids
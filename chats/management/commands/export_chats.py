@@ -0,0 +1,42 @@
+from chats.export import open_export, user_records, room_records, message_records, Throughput
+from chats.archive import read_archive
+from django.core.management.base import BaseCommand
+from chats.models import MessageArchive
+import json
+import os
+
+
+class Command(BaseCommand):
+    help = 'Stream the users, rooms and messages to an NDJSON file in constant memory.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='file to write, compressed with gzip if the name ends with .gz')
+        parser.add_argument('--gzip', action='store_true', help='compress the file with gzip')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='rows fetched per cursor round trip')
+        parser.add_argument('--archived', action='store_true',
+                            help='also export the archived messages, read from their files')
+
+    def handle(self, *args, **options):
+        throughput = Throughput(self.stdout.write)
+        chunk_size = options['chunk_size']
+        records = [user_records(chunk_size), room_records(chunk_size), message_records(chunk_size)]
+        if options['archived']:
+            records.append(self.archived_records())
+
+        # Written next to the target and moved in place when complete, an interrupted export leaves no partial file
+        tmp_path = f"{options['path']}.tmp"
+        with open_export(tmp_path, options['gzip'] or options['path'].endswith('.gz')) as file:
+            for model_records in records:
+                for record in model_records:
+                    file.write(json.dumps(record) + '\n')
+                    throughput.add(record['model'])
+        os.replace(tmp_path, options['path'])
+        throughput.report('Exported ')
+
+    def archived_records(self):
+        """
+        Yield the messages of the archive files, one file is read at a time.
+        """
+        for path in MessageArchive.objects.order_by('room_uuid', 'month').values_list('path', flat=True).iterator():
+            for row in read_archive(path):
+                yield {'model': 'message', **row}
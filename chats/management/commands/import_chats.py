@@ -0,0 +1,205 @@
+from chats.models import User, Status, Room, Message, ReadCursor
+from chats.export import open_import, Throughput
+from chats.summaries import refresh_members, update_last_message
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+from django.core.management.color import no_style
+from contextlib import contextmanager
+from django.db import connection, transaction
+from django.utils import timezone
+import json
+import os
+
+# Fields set on creation, kept from the export while importing
+CREATION_FIELDS = ((User, 'created_at'), (Room, 'created_at'), (Message, 'timestamp'))
+
+
+@contextmanager
+def keep_creation_times():
+    """
+    Let `bulk_create` write the exported creation times instead of the current time.
+    """
+    fields = [model._meta.get_field(name) for model, name in CREATION_FIELDS]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+def parse_time(value: str | None):
+    return parse_datetime(value) if value else timezone.now()
+
+
+class Command(BaseCommand):
+    help = 'Import an NDJSON file of export_chats in batches, records already in the database are skipped.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='file written by export_chats, gzip compressed or not')
+        parser.add_argument('--batch-size', type=int, default=1000, help='records per bulk insert and transaction')
+        parser.add_argument('--resume', action='store_true',
+                            help='continue after the last batch of an interrupted import of the same file')
+
+    def handle(self, *args, **options):
+        if not os.path.exists(options['path']):
+            raise CommandError(f"No such file: {options['path']}")
+        self.batch_size = options['batch_size']
+        self.progress_path = f"{options['path']}.progress"
+        self.throughput = Throughput(self.stdout.write)
+        # username -> id, filled by the imported users and looked up for the others
+        self.user_ids = {}
+
+        skip = self.read_progress() if options['resume'] else 0
+        if skip:
+            self.stdout.write(f'Resuming after line {skip}')
+
+        batch, model, line_number = [], None, 0
+        with open_import(options['path']) as file, keep_creation_times():
+            for line_number, line in enumerate(file, 1):
+                if line_number <= skip or not line.strip():
+                    continue
+                record = json.loads(line)
+                if batch and (record['model'] != model or len(batch) >= self.batch_size):
+                    self.flush(model, batch, line_number - 1)
+                    batch = []
+                model = record['model']
+                batch.append(record)
+            if batch:
+                self.flush(model, batch, line_number)
+
+        self.reset_message_ids()
+        if os.path.exists(self.progress_path):
+            os.remove(self.progress_path)
+        self.throughput.report('Imported ')
+
+    def read_progress(self) -> int:
+        try:
+            with open(self.progress_path) as file:
+                return int(file.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def write_progress(self, line_number: int) -> None:
+        with open(f'{self.progress_path}.tmp', 'w') as file:
+            file.write(str(line_number))
+        os.replace(f'{self.progress_path}.tmp', self.progress_path)
+
+    def flush(self, model: str, records: list, line_number: int) -> None:
+        """
+        Insert the batch in one transaction and remember the last line it contains.
+        """
+        import_batch = {
+            'user': self.import_users,
+            'room': self.import_rooms,
+            'message': self.import_messages,
+        }.get(model)
+        if import_batch is None:
+            raise CommandError(f'Unknown model {model!r} before line {line_number}')
+        with transaction.atomic():
+            count = import_batch(records)
+        self.write_progress(line_number)
+        self.throughput.add(model, count)
+        if count < len(records):
+            self.throughput.add(f'skipped {model}', len(records) - count)
+
+    def reset_message_ids(self) -> None:
+        """
+        Move the message id sequence past the imported ids.
+        """
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [Message]):
+                cursor.execute(sql)
+
+    def get_user_ids(self, usernames: set) -> dict:
+        missing = usernames - self.user_ids.keys()
+        if missing:
+            self.user_ids.update(User.objects.filter(username__in=missing).values_list('username', 'id'))
+        return {username: self.user_ids[username] for username in usernames if username in self.user_ids}
+
+    def import_users(self, records: list) -> int:
+        users = []
+        for record in records:
+            user = User(
+                username=record['username'],
+                email=record['email'],
+                bio=record.get('bio'),
+                avatar=record.get('avatar') or None,
+                created_at=parse_time(record.get('created_at')),
+                is_superuser=record.get('is_superuser', False),
+            )
+            # Users sign in through the AUTH-backend
+            user.set_unusable_password()
+            users.append(user)
+        existing = set(User.objects.filter(username__in=[user.username for user in users]).values_list(
+            'username', flat=True,
+        ))
+        User.objects.bulk_create([user for user in users if user.username not in existing], ignore_conflicts=True)
+        user_ids = self.get_user_ids({user.username for user in users})
+        Status.objects.bulk_create([Status(user_id=user_id) for user_id in user_ids.values()], ignore_conflicts=True)
+        return len(set(user_ids) - existing)
+
+    def import_rooms(self, records: list) -> int:
+        uuids = [record['uuid'] for record in records]
+        existing = {str(uuid) for uuid in Room.objects.filter(uuid__in=uuids).values_list('uuid', flat=True)}
+        Room.objects.bulk_create([
+            Room(uuid=record['uuid'], description=record['description'], created_at=parse_time(record['created_at']))
+            for record in records if record['uuid'] not in existing
+        ], ignore_conflicts=True)
+        room_ids = {str(uuid): room_id for uuid, room_id in
+                    Room.objects.filter(uuid__in=uuids).values_list('uuid', 'id')}
+
+        user_ids = self.get_user_ids({username for record in records for username in record['members']})
+        memberships = [(room_ids[record['uuid']], user_ids[username])
+                       for record in records for username in record['members'] if username in user_ids]
+        Room.users.through.objects.bulk_create([
+            Room.users.through(room_id=room_id, user_id=user_id) for room_id, user_id in memberships
+        ], ignore_conflicts=True)
+        ReadCursor.objects.bulk_create([
+            ReadCursor(room_id=room_id, user_id=user_id) for room_id, user_id in memberships
+        ], ignore_conflicts=True)
+        refresh_members(list(room_ids.values()))
+        return len(room_ids) - len(existing)
+
+    def import_messages(self, records: list) -> int:
+        """
+        Insert the messages with their exported ids, unless the id is taken by a message of another room.
+        Messages are matched by room and sequence number, messages without one by their id and room,
+        so a batch imported before an interruption is skipped.
+        """
+        user_ids = self.get_user_ids({record['sender'] for record in records})
+        existing = {(str(room_uuid), seq) for room_uuid, seq in Message.objects.filter(
+            room_uuid__in={record['room_uuid'] for record in records},
+            seq__in={record['seq'] for record in records if record['seq'] is not None},
+        ).values_list('room_uuid', 'seq')}
+        existing_ids = {message_id: str(room_uuid) for message_id, room_uuid in Message.objects.filter(
+            id__in=[record['id'] for record in records if record.get('id') is not None],
+        ).values_list('id', 'room_uuid')}
+
+        def imported(record: dict) -> bool:
+            if record['seq'] is not None:
+                return (record['room_uuid'], record['seq']) in existing
+            return existing_ids.get(record.get('id')) == record['room_uuid']
+
+        messages = Message.objects.bulk_create([
+            Message(
+                id=record.get('id') if record.get('id') not in existing_ids else None,
+                room_uuid=record['room_uuid'],
+                seq=record['seq'],
+                file=record['file'] or None,
+                timestamp=parse_time(record['timestamp']),
+                sender_id=user_ids[record['sender']],
+                content=record['content'],
+            ) for record in records
+            if record['sender'] in user_ids and not imported(record)
+        ])
+
+        # The last message of every room in the batch becomes the last one of its summary, if it is later
+        last_messages = {}
+        for message in messages:
+            if message.seq is not None:
+                last_messages[str(message.room_uuid)] = message
+        for room_uuid, message in last_messages.items():
+            update_last_message(room_uuid, message)
+        return len(messages)
@@ -0,0 +1,147 @@
+"""
+Serving of the avatars and attachments under `MEDIA_URL`.
+Files are streamed in chunks read in a thread, with single byte ranges, validators and conditional responses, so
+downloads can be resumed and revalidated. With `MEDIA_SENDFILE` the transfer is left to the web server in front,
+the response only carries the headers and the internal location of the file.
+"""
+from django.http import HttpResponse, StreamingHttpResponse, Http404
+from django.core.exceptions import SuspiciousFileOperation
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+from django.utils._os import safe_join
+from asgiref.sync import sync_to_async
+from urllib.parse import quote
+from django.conf import settings
+import mimetypes
+import stat
+import os
+import re
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+COMPRESSED_TYPES = {'bzip2': 'application/x-bzip', 'gzip': 'application/gzip', 'xz': 'application/x-xz'}
+
+
+def file_etag(stats: os.stat_result) -> str:
+    """
+    Get the strong ETag of the file from its modification time and size.
+    """
+    return quote_etag(f'{stats.st_mtime_ns:x}-{stats.st_size:x}')
+
+
+def parse_range(header: str | None, size: int) -> tuple | None:
+    """
+    Get the first and last byte of a single range, `None` serves the whole file.
+    Several ranges are not supported and also serve the whole file.
+    Raises `ValueError` if the range is outside of the file.
+    """
+    match = RANGE_RE.match(header.replace(' ', '')) if header else None
+    if match is None:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # Suffix range, the last bytes of the file
+        length = int(end)
+        if length == 0 or size == 0:
+            raise ValueError('Empty suffix range')
+        return max(0, size - length), size - 1
+    start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError('Range not satisfiable')
+    return start, end
+
+
+def range_applies(request, etag: str, mtime: int) -> bool:
+    """
+    Check the `If-Range` validator, a changed file is sent whole.
+    """
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == mtime
+
+
+async def stream(path: str, start: int, length: int):
+    """
+    Yield the bytes of the file range in chunks of `MEDIA_CHUNK_SIZE`, read in a thread.
+    """
+    file = await sync_to_async(open, thread_sensitive=False)(path, 'rb')
+    try:
+        await sync_to_async(file.seek, thread_sensitive=False)(start)
+        while length > 0:
+            chunk = await sync_to_async(file.read, thread_sensitive=False)(min(settings.MEDIA_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        await sync_to_async(file.close, thread_sensitive=False)()
+
+
+def offload(name: str, path: str, response: HttpResponse) -> HttpResponse:
+    """
+    Leave the transfer to the web server, which also handles the ranges.
+    """
+    if settings.MEDIA_SENDFILE == 'x-accel-redirect':
+        response.headers['X-Accel-Redirect'] = settings.MEDIA_ACCEL_PREFIX + quote(name)
+    else:
+        response.headers['X-Sendfile'] = path
+    # The web server sets the type of the file
+    del response.headers['Content-Type']
+    return response
+
+
+async def serve(request, name: str) -> HttpResponse:
+    """
+    Serve the stored file with the given name.
+    """
+    try:
+        path = safe_join(settings.MEDIA_ROOT, name)
+        stats = await sync_to_async(os.stat, thread_sensitive=False)(path)
+    except (SuspiciousFileOperation, OSError, ValueError):
+        raise Http404('File not found')
+    if not stat.S_ISREG(stats.st_mode):
+        raise Http404('File not found')
+
+    etag, mtime = file_etag(stats), int(stats.st_mtime)
+    content_type, encoding = mimetypes.guess_type(path)
+    # Compressed files are sent as they are stored, like `FileResponse` does
+    content_type = COMPRESSED_TYPES.get(encoding, content_type)
+    response = HttpResponse(content_type=content_type or 'application/octet-stream')
+    response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = http_date(mtime)
+    response.headers['Cache-Control'] = f'public, max-age={settings.MEDIA_CACHE_MAX_AGE}'
+    response.headers['Accept-Ranges'] = 'bytes'
+    # Uploads are served as their type only, never sniffed as HTML
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+
+    conditional = get_conditional_response(request, etag=etag, last_modified=mtime, response=response)
+    if conditional is not response:
+        return conditional
+    if settings.MEDIA_SENDFILE:
+        return offload(name, path, response)
+
+    size = stats.st_size
+    try:
+        byte_range = parse_range(request.headers.get('Range'), size) if range_applies(request, etag, mtime) else None
+    except ValueError:
+        response.status_code = 416
+        response.headers['Content-Range'] = f'bytes */{size}'
+        return response
+
+    start, end = byte_range or (0, size - 1)
+    length = end - start + 1 if size else 0
+    if request.method == 'HEAD':
+        streaming = HttpResponse(status=206 if byte_range else 200)
+    else:
+        streaming = StreamingHttpResponse(stream(path, start, length), status=206 if byte_range else 200)
+    for header, value in response.headers.items():
+        streaming.headers[header] = value
+    streaming.headers['Content-Length'] = str(length)
+    if byte_range:
+        streaming.headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    return streaming
@@ -0,0 +1,56 @@
+from django.core.exceptions import ValidationError
+from collections import OrderedDict
+from django.conf import settings
+from chats.models import Room
+import time
+
+# room uuid -> (expires at, {user id: username}), least recently used first
+_members = OrderedDict()
+
+
+async def get_members_from_db(room_name: str) -> dict:
+    """
+    Get the members of the room from the database.
+    """
+    members = Room.users.through.objects.filter(room__uuid=room_name).values_list('user_id', 'user__username')
+    try:
+        return {user_id: username async for user_id, username in members}
+    except ValidationError:
+        return {}
+
+
+async def get_members(room_name: str) -> dict:
+    """
+    Get the members of the room from the cache, load them from the database on a miss.
+    Entries are dropped when the members change and expire after `MEMBERSHIP_CACHE_TTL`
+    to pick up changes made by other workers.
+    """
+    entry = _members.get(room_name)
+    if entry is not None and entry[0] > time.monotonic():
+        _members.move_to_end(room_name)
+        return entry[1]
+
+    members = await get_members_from_db(room_name)
+    _members[room_name] = (time.monotonic() + settings.MEMBERSHIP_CACHE_TTL, members)
+    _members.move_to_end(room_name)
+    while len(_members) > settings.MEMBERSHIP_CACHE_SIZE:
+        _members.popitem(last=False)
+    return members
+
+
+async def is_member(user, room_name: str) -> bool:
+    """
+    Check if the user is a member of the room.
+    """
+    user_id = getattr(user, 'id', None)
+    return user_id is not None and user_id in await get_members(room_name)
+
+
+def invalidate(room_name: str | None = None) -> None:
+    """
+    Drop the cached members of the room, or of all rooms.
+    """
+    if room_name is None:
+        _members.clear()
+    else:
+        _members.pop(str(room_name), None)
@@ -0,0 +1,201 @@
+"""
+Per-worker metrics in the Prometheus text format.
+Values are plain Python numbers updated from the event loop thread, so recording takes no locks.
+The metrics view runs on the event loop too, rendering takes a copy of the values all the same.
+Every worker exposes its own values, Prometheus scrapes the workers separately and aggregates them.
+"""
+from contextlib import contextmanager
+from collections import defaultdict
+from bisect import bisect_left
+import time
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REGISTRY = []
+
+
+def format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    """
+    Format the labels of a sample.
+    """
+    labels = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class Metric:
+    """
+    Base metric with label values as tuples.
+    """
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        REGISTRY.append(self)
+
+    def samples(self) -> list:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(f'{name}{labels} {value}' for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing counter.
+    """
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values = defaultdict(int)
+
+    def inc(self, *labels, amount: int = 1) -> None:
+        self.values[labels] += amount
+
+    def samples(self) -> list:
+        return [(self.name, format_labels(self.labelnames, labels), value)
+                for labels, value in list(self.values.items())]
+
+
+class Gauge(Counter):
+    """
+    Value that goes up and down.
+    """
+    type = 'gauge'
+
+    def dec(self, *labels, amount: int = 1) -> None:
+        self.values[labels] -= amount
+
+    def set(self, *labels, value: float) -> None:
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    """
+    Histogram of durations in seconds.
+    """
+    type = 'histogram'
+
+    def __init__(self, *args, buckets: tuple = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = buckets
+        # labels -> [count per bucket, +Inf last], sum
+        self.counts = defaultdict(lambda: [0] * (len(self.buckets) + 1))
+        self.sums = defaultdict(float)
+
+    def observe(self, value: float, *labels) -> None:
+        self.counts[labels][bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """
+        Observe the duration of the block.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self) -> list:
+        samples = []
+        for labels, counts in list(self.counts.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), list(counts)):
+                total += count
+                samples.append((f'{self.name}_bucket', format_labels(self.labelnames, labels, f'le="{bound}"'), total))
+            samples.append((f'{self.name}_sum', format_labels(self.labelnames, labels), self.sums.get(labels, 0.0)))
+            samples.append((f'{self.name}_count', format_labels(self.labelnames, labels), total))
+        return samples
+
+
+def render() -> str:
+    """
+    Render all metrics in the Prometheus text format.
+    """
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+HANDSHAKE_AUTH_SECONDS = Histogram(
+    'ws_handshake_auth_seconds', 'Time to authenticate the websocket handshake.',
+)
+HANDSHAKE_QUEUE_SECONDS = Histogram(
+    'ws_handshake_queue_seconds', 'Time websocket handshakes wait for an admission slot.',
+)
+HANDSHAKES_WAITING = Gauge(
+    'ws_handshakes_waiting', 'Websocket handshakes waiting for an admission slot.',
+)
+HANDSHAKES_REJECTED = Counter(
+    'ws_handshakes_rejected_total', 'Websocket handshakes told to retry later.', ('reason',),
+)
+QUERY_SECONDS = Histogram(
+    'ws_query_seconds', 'Time to load data for the consumers.', ('query',),
+)
+SAVE_MESSAGE_SECONDS = Histogram(
+    'ws_save_message_seconds', 'Time to save a chat message.',
+)
+GROUP_SEND_SECONDS = Histogram(
+    'ws_group_send_seconds', 'Time to publish an event to a group.', ('type',),
+)
+DB_EXECUTOR_WAIT_SECONDS = Histogram(
+    'ws_db_executor_wait_seconds', 'Time database calls wait for a free executor thread and its connection.',
+)
+ACTIVE_CONNECTIONS = Gauge(
+    'ws_active_connections', 'Open websocket connections.', ('consumer',),
+)
+DRAINED_CONNECTIONS = Counter(
+    'ws_drained_connections_total', 'Websocket connections closed by the drain.',
+)
+TOKEN_REFRESHES = Counter(
+    'ws_token_refreshes_total', 'In-band token refreshes by result.', ('result',),
+)
+REAPED_CONNECTIONS = Counter(
+    'ws_reaped_connections_total', 'Websocket connections closed after missing the heartbeats.', ('consumer',),
+)
+FRAMES_IN = Counter(
+    'ws_frames_in_total', 'Frames received from the frontend.', ('consumer', 'type'),
+)
+FRAMES_OUT = Counter(
+    'ws_frames_out_total', 'Frames sent to the frontend.', ('consumer', 'type'),
+)
+MESSAGE_TRACES_DROPPED = Counter(
+    'ws_message_traces_dropped_total', 'Message trace records dropped by the file exporter.', ('reason',),
+)
+
+
+def frame_type(content: dict) -> str:
+    """
+    Get the type of the frame, frames without a type are named by their first key.
+    """
+    return content.get('type') or next(iter(content), 'empty')
+
+
+class MetricsMixin:
+    """
+    Count the open connections and the frames of the consumer.
+    Received frames are counted by the types in `frame_types`, so the frontend can not add label values.
+    """
+    frame_types = ()
+
+    async def websocket_connect(self, message) -> None:
+        ACTIVE_CONNECTIONS.inc(type(self).__name__)
+        await super().websocket_connect(message)
+
+    async def websocket_disconnect(self, message) -> None:
+        ACTIVE_CONNECTIONS.dec(type(self).__name__)
+        await super().websocket_disconnect(message)
+
+    async def send_json(self, content: dict, close: bool = False) -> None:
+        FRAMES_OUT.inc(type(self).__name__, frame_type(content))
+        await super().send_json(content, close)
+
+    def count_frame_in(self, content: dict) -> None:
+        content_type = frame_type(content)
+        FRAMES_IN.inc(type(self).__name__, content_type if content_type in self.frame_types else 'other')
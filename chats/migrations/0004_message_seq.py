@@ -0,0 +1,36 @@
+# Generated by Django 5.0.14 on 2026-10-19 12:14
+
+from django.db import migrations, models
+
+
+def fill_seq(apps, schema_editor):
+    """
+    Number the existing messages of every room in the order they were saved.
+    """
+    Message = apps.get_model('chats', 'Message')
+    rooms = Message.objects.values_list('room_uuid', flat=True).distinct()
+    for room_uuid in list(rooms):
+        messages = list(Message.objects.filter(room_uuid=room_uuid).order_by('id').only('id'))
+        for seq, message in enumerate(messages, start=1):
+            message.seq = seq
+        Message.objects.bulk_update(messages, ['seq'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0003_remove_room_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room_uuid', 'seq'], name='chats_messa_room_uu_d567bc_idx'),
+        ),
+        migrations.RunPython(fill_seq, migrations.RunPython.noop),
+    ]
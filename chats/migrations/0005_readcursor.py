@@ -0,0 +1,47 @@
+# Generated by Django 5.0.14 on 2026-10-19 12:15
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def create_cursors(apps, schema_editor):
+    """
+    Create read cursors for the existing room members, the existing history counts as read.
+    """
+    Room = apps.get_model('chats', 'Room')
+    Message = apps.get_model('chats', 'Message')
+    ReadCursor = apps.get_model('chats', 'ReadCursor')
+    for room in Room.objects.all():
+        last_seq = Message.objects.filter(room_uuid=room.uuid).aggregate(Max('seq'))['seq__max'] or 0
+        ReadCursor.objects.bulk_create(
+            [ReadCursor(user_id=user_id, room=room, last_read_seq=last_seq) for user_id in
+             room.users.values_list('id', flat=True)],
+            ignore_conflicts=True,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0004_message_seq'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_seq', models.BigIntegerField(default=0)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to='chats.room')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='readcursor',
+            constraint=models.UniqueConstraint(fields=('user', 'room'), name='unique_read_cursor'),
+        ),
+        migrations.RunPython(create_cursors, migrations.RunPython.noop),
+    ]
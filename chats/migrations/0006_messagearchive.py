@@ -0,0 +1,33 @@
+# Generated by Django 5.0.14 on 2026-10-19 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0005_readcursor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_uuid', models.UUIDField()),
+                ('month', models.DateTimeField()),
+                ('first_seq', models.BigIntegerField(blank=True, null=True)),
+                ('last_seq', models.BigIntegerField(blank=True, null=True)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('path', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room_uuid', 'last_seq'], name='chats_messa_room_uu_71e52e_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='messagearchive',
+            constraint=models.UniqueConstraint(fields=('room_uuid', 'month'), name='unique_message_archive'),
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 5.0.14 on 2026-10-19 12:40
+
+from chats.partitions import DEFAULT_PARTITION, TABLE, create_partitions, is_partitioned
+from django.db import migrations
+from django.db.migrations.exceptions import IrreversibleError
+from django.conf import settings
+from django.utils import timezone
+
+
+def partition_messages(apps, schema_editor):
+    """
+    Replace the message table with one partitioned by month of `timestamp`, Postgres only.
+    The primary key has to contain the partition key, so it becomes (id, timestamp) and ids come from a sequence,
+    identity columns are not supported on partitioned tables.
+    The sequence, indexes and foreign key get the names Django gives them, so later operations find them.
+    """
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+
+    Message = apps.get_model('chats', 'Message')
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT min("timestamp") FROM {TABLE}')
+        first = cursor.fetchone()[0] or timezone.now()
+        cursor.execute(f'ALTER TABLE {TABLE} RENAME TO {TABLE}_unpartitioned')
+        cursor.execute(
+            f'ALTER TABLE {TABLE}_unpartitioned RENAME CONSTRAINT {TABLE}_pkey TO {TABLE}_unpartitioned_pkey'
+        )
+        cursor.execute(
+            f'CREATE TABLE {TABLE} (LIKE {TABLE}_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE ("timestamp")'
+        )
+        cursor.execute(f'ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_pkey PRIMARY KEY (id, "timestamp")')
+        # Catches the rows of months without a partition, the archive command creates the upcoming ones
+        cursor.execute(f'CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT')
+
+    create_partitions(connection, first, settings.MESSAGE_PARTITIONS_AHEAD)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f'INSERT INTO {TABLE} SELECT * FROM {TABLE}_unpartitioned')
+        cursor.execute(f'SELECT coalesce(max(id), 0) FROM {TABLE}')
+        last_id = cursor.fetchone()[0]
+        # Drops the identity sequence and the indexes of the old table, so their names can be reused
+        cursor.execute(f'DROP TABLE {TABLE}_unpartitioned')
+        cursor.execute(f'CREATE SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id')
+        cursor.execute(f"SELECT setval('{TABLE}_id_seq', %s, false)", [last_id + 1])
+        cursor.execute(f"ALTER TABLE {TABLE} ALTER COLUMN id SET DEFAULT nextval('{TABLE}_id_seq')")
+
+    sender = Message._meta.get_field('sender')
+    schema_editor.execute(schema_editor._create_index_sql(Message, fields=[sender]))
+    schema_editor.execute(schema_editor._create_fk_sql(Message, sender, '_fk_%(to_table)s_%(to_column)s'))
+    for index in Message._meta.indexes:
+        schema_editor.add_index(Message, index)
+
+
+def unpartition_messages(apps, schema_editor):
+    if is_partitioned(schema_editor.connection):
+        raise IrreversibleError('The partitioned message table can not be turned back into a plain table')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0006_messagearchive'),
+    ]
+
+    operations = [
+        # The fields, indexes and constraints of the model are unchanged, only the table is partitioned
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(partition_messages, unpartition_messages),
+            ],
+            state_operations=[],
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.0.14 on 2026-10-19 12:32
+
+import django.contrib.postgres.search
+from django.db import migrations
+from django.conf import settings
+
+
+def create_search_trigger(apps, schema_editor):
+    """
+    Fill the search vector of the messages on insert and content updates with a trigger, and index it, Postgres only.
+    """
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+
+    config = connection.ops.quote_name(settings.MESSAGE_SEARCH_CONFIG)
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            CREATE FUNCTION chats_message_search_vector() RETURNS trigger AS $$
+            BEGIN
+                NEW.search_vector := to_tsvector('{config}'::regconfig, coalesce(NEW.content, ''));
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql
+        """)
+        cursor.execute("""
+            CREATE TRIGGER chats_message_search_vector BEFORE INSERT OR UPDATE OF content ON chats_message
+            FOR EACH ROW EXECUTE FUNCTION chats_message_search_vector()
+        """)
+        cursor.execute(
+            f"UPDATE chats_message SET search_vector = to_tsvector('{config}'::regconfig, coalesce(content, ''))"
+        )
+        cursor.execute('CREATE INDEX chats_message_search_vector_idx ON chats_message USING gin (search_vector)')
+
+
+def drop_search_trigger(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute('DROP INDEX IF EXISTS chats_message_search_vector_idx')
+        cursor.execute('DROP TRIGGER IF EXISTS chats_message_search_vector ON chats_message')
+        cursor.execute('DROP FUNCTION IF EXISTS chats_message_search_vector()')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0007_message_partitions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_trigger, drop_search_trigger),
+    ]
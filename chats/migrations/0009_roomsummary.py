@@ -0,0 +1,55 @@
+# Generated by Django 5.0.14 on 2026-10-19 12:36
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.conf import settings
+
+
+def create_summaries(apps, schema_editor):
+    """
+    Create the summaries of the existing rooms.
+    """
+    Room = apps.get_model('chats', 'Room')
+    Message = apps.get_model('chats', 'Message')
+    RoomSummary = apps.get_model('chats', 'RoomSummary')
+    summaries = []
+    for room in Room.objects.prefetch_related('users'):
+        members = [{
+            'id': user.id,
+            'username': user.username,
+            'avatar': user.avatar.name if user.avatar else None,
+        } for user in room.users.all()]
+        summary = RoomSummary(room=room, last_activity=room.created_at, member_count=len(members), members=members)
+        message = Message.objects.filter(room_uuid=room.uuid).order_by('seq', 'id').last()
+        if message:
+            summary.last_message = (message.content or message.file.name or '')[:settings.SUMMARY_PREVIEW_LENGTH]
+            summary.last_seq = message.seq
+            summary.last_activity = message.timestamp
+        summaries.append(summary)
+    RoomSummary.objects.bulk_create(summaries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0008_message_search_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_message', models.TextField(blank=True, default='')),
+                ('last_seq', models.BigIntegerField(blank=True, null=True)),
+                ('last_activity', models.DateTimeField()),
+                ('member_count', models.PositiveIntegerField(default=0)),
+                ('members', models.JSONField(default=list)),
+                ('room', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='summary', to='chats.room')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-last_activity'], name='chats_rooms_last_ac_59ac07_idx')],
+            },
+        ),
+        migrations.RunPython(create_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,99 @@
+# Generated by Django 5.0.14 on 2026-10-19 14:05
+
+from chats.partitions import SEQ_LOCK, TABLE, is_partitioned
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def renumber_duplicates(apps, schema_editor):
+    """
+    Move the messages sharing a sequence number with an earlier message of the room after the last one.
+    """
+    Message = apps.get_model('chats', 'Message')
+    RoomSummary = apps.get_model('chats', 'RoomSummary')
+    duplicates = Message.objects.filter(seq__isnull=False).values('room_uuid', 'seq').annotate(
+        count=Count('id'),
+    ).filter(count__gt=1).order_by('room_uuid', 'seq')
+    rooms = {}
+    for duplicate in duplicates:
+        rooms.setdefault(duplicate['room_uuid'], []).append(duplicate['seq'])
+
+    for room_uuid, seqs in rooms.items():
+        last_seq = Message.objects.filter(room_uuid=room_uuid).aggregate(Max('seq'))['seq__max']
+        for seq in seqs:
+            for message_id in Message.objects.filter(room_uuid=room_uuid, seq=seq).order_by('id').values_list(
+                'id', flat=True,
+            )[1:]:
+                last_seq += 1
+                Message.objects.filter(id=message_id).update(seq=last_seq)
+        RoomSummary.objects.filter(room__uuid=room_uuid).update(last_seq=last_seq)
+
+
+def create_unique_seq_trigger(connection):
+    """
+    Check the sequence numbers in a trigger under the advisory lock of the room, which also serializes
+    `allocate_seq`. Unique indexes of a partitioned table have to contain the partition key,
+    a unique constraint would only cover the messages of one month.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            CREATE FUNCTION chats_message_unique_seq() RETURNS trigger AS $$
+            BEGIN
+                IF NEW.seq IS NULL THEN
+                    RETURN NEW;
+                END IF;
+                PERFORM pg_advisory_xact_lock({SEQ_LOCK}, hashtext(NEW.room_uuid::text));
+                IF EXISTS (
+                    SELECT 1 FROM {TABLE} WHERE room_uuid = NEW.room_uuid AND seq = NEW.seq AND id <> NEW.id
+                ) THEN
+                    RAISE unique_violation USING
+                        MESSAGE = format('Sequence number %s of room %s is taken', NEW.seq, NEW.room_uuid),
+                        CONSTRAINT = 'unique_message_seq';
+                END IF;
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER chats_message_unique_seq BEFORE INSERT OR UPDATE OF room_uuid, seq ON {TABLE}
+            FOR EACH ROW EXECUTE FUNCTION chats_message_unique_seq()
+        """)
+
+
+def drop_unique_seq_trigger(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP TRIGGER IF EXISTS chats_message_unique_seq ON {TABLE}')
+        cursor.execute('DROP FUNCTION IF EXISTS chats_message_unique_seq()')
+
+
+class AddUniqueSeq(migrations.AddConstraint):
+    """
+    Add the unique constraint of the sequence numbers, a trigger on the partitioned table on Postgres.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if is_partitioned(schema_editor.connection):
+            create_unique_seq_trigger(schema_editor.connection)
+        else:
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if is_partitioned(schema_editor.connection):
+            drop_unique_seq_trigger(schema_editor.connection)
+        else:
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0009_roomsummary'),
+    ]
+
+    operations = [
+        migrations.RunPython(renumber_duplicates, migrations.RunPython.noop),
+        AddUniqueSeq(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=['room_uuid', 'seq'], name='unique_message_seq'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.0.14 on 2026-10-20 09:10
+
+from django.db import migrations, models
+
+
+def count_own_messages(apps, schema_editor):
+    """
+    Count the messages of every user after their read cursor.
+    """
+    ReadCursor = apps.get_model('chats', 'ReadCursor')
+    Message = apps.get_model('chats', 'Message')
+    for cursor in ReadCursor.objects.select_related('room').iterator(chunk_size=2000):
+        cursor.own_count = Message.objects.filter(
+            room_uuid=cursor.room.uuid, seq__gt=cursor.last_read_seq, sender_id=cursor.user_id,
+        ).count()
+        cursor.save(update_fields=['own_count'])
+
+
+def count_unread_messages(apps, schema_editor):
+    """
+    Count the unread messages of every user after their read cursor.
+    """
+    ReadCursor = apps.get_model('chats', 'ReadCursor')
+    Message = apps.get_model('chats', 'Message')
+    for cursor in ReadCursor.objects.select_related('room').iterator(chunk_size=2000):
+        cursor.unread_count = Message.objects.filter(
+            room_uuid=cursor.room.uuid, seq__gt=cursor.last_read_seq,
+        ).exclude(sender_id=cursor.user_id).count()
+        cursor.save(update_fields=['unread_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0010_message_unique_seq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='readcursor',
+            name='own_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_own_messages, count_unread_messages),
+        migrations.RemoveField(
+            model_name='readcursor',
+            name='unread_count',
+        ),
+    ]
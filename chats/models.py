@@ -1,4 +1,5 @@
 from django.contrib.auth.base_user import AbstractBaseUser
+from django.contrib.postgres.search import SearchVectorField
 from django.contrib.auth.models import PermissionsMixin
 from django.db import models
 import uuid
@@ -43,15 +44,104 @@ class Room(models.Model):
     users = models.ManyToManyField(User, related_name='rooms')
 
 
+class MessageManager(models.Manager):
+    """
+    Manager of messages without the search vector, only the search needs it.
+    """
+
+    def get_queryset(self):
+        return super().get_queryset().defer('search_vector')
+
+
 class Message(models.Model):
     """
     Model message.
     """
     room_uuid = models.UUIDField()
+    seq = models.BigIntegerField(null=True, blank=True)
     file = models.FileField(upload_to='files/', null=True, blank=True)
     timestamp = models.DateTimeField(auto_now_add=True)
     sender = models.ForeignKey(User, on_delete=models.CASCADE)
     content = models.TextField()
+    # Maintained by a database trigger on Postgres, see migration 0008
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = MessageManager()
+
+    class Meta:
+        # Enforced by a trigger on the partitioned table on Postgres, see migration 0010
+        constraints = [
+            models.UniqueConstraint(fields=['room_uuid', 'seq'], name='unique_message_seq'),
+        ]
+        indexes = [
+            models.Index(fields=['room_uuid', 'seq']),
+        ]
 
     def __str__(self):
         return f'Message from {self.sender} in room {self.room_uuid}'
+
+
+class MessageArchive(models.Model):
+    """
+    Model archived messages of a room in a month, moved to a compressed file by `archive_messages`.
+    """
+    room_uuid = models.UUIDField()
+    month = models.DateTimeField()
+    first_seq = models.BigIntegerField(null=True, blank=True)
+    last_seq = models.BigIntegerField(null=True, blank=True)
+    count = models.PositiveIntegerField(default=0)
+    path = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room_uuid', 'month'], name='unique_message_archive'),
+        ]
+        indexes = [
+            models.Index(fields=['room_uuid', 'last_seq']),
+        ]
+
+    def __str__(self):
+        return f'Archive of room {self.room_uuid} for {self.month:%Y-%m}'
+
+
+class RoomSummary(models.Model):
+    """
+    Model summary of the room for the chat list, kept up to date by `chats.summaries`.
+    """
+    room = models.OneToOneField(Room, on_delete=models.CASCADE, related_name='summary')
+    last_message = models.TextField(blank=True, default='')
+    last_seq = models.BigIntegerField(null=True, blank=True)
+    last_activity = models.DateTimeField()
+    member_count = models.PositiveIntegerField(default=0)
+    # [{'id': user id, 'username': username, 'avatar': avatar file name}]
+    members = models.JSONField(default=list)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-last_activity']),
+        ]
+
+    def __str__(self):
+        return f'Summary of room {self.room.uuid}'
+
+
+class ReadCursor(models.Model):
+    """
+    Model read cursor of the user in the room.
+    The unread count is the last sequence number of the room summary after `last_read_seq`, without the messages
+    of the user, so the chat list does not count messages and a new message only updates the cursor of its sender.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_cursors')
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='read_cursors')
+    last_read_seq = models.BigIntegerField(default=0)
+    # Messages of the user after `last_read_seq`
+    own_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'room'], name='unique_read_cursor'),
+        ]
+
+    def __str__(self):
+        return f'Read cursor of {self.user} in room {self.room.uuid}'
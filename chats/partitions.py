@@ -0,0 +1,103 @@
+"""
+Monthly range partitions of the message table by `timestamp`, Postgres only.
+Months past `MESSAGE_ARCHIVE_AFTER_DAYS` are moved to compressed files by the `archive_messages` command.
+"""
+from django.db import transaction
+from django.utils import timezone
+from datetime import datetime, timezone as dt_timezone
+
+TABLE = 'chats_message'
+# Catches the rows of months without a partition
+DEFAULT_PARTITION = f'{TABLE}_default'
+
+# Class of the advisory locks serializing the sequence numbers of a room on Postgres
+SEQ_LOCK = 7301
+
+
+def month_start(value: datetime) -> datetime:
+    """
+    Get the start of the month of the value, in UTC.
+    """
+    value = value.astimezone(dt_timezone.utc)
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month: datetime, months: int) -> datetime:
+    """
+    Move the start of the month by the number of months.
+    """
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def lock_room_seq(connection, room_name: str) -> None:
+    """
+    Take the advisory lock of the sequence numbers of the room until the end of the transaction.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s, hashtext(%s))', [SEQ_LOCK, str(room_name)])
+
+
+def partition_name(month: datetime) -> str:
+    return f'{TABLE}_p{month:%Y_%m}'
+
+
+def is_partitioned(connection) -> bool:
+    """
+    Check if the message table is partitioned, only Postgres tables are.
+    """
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass', [TABLE])
+        return cursor.fetchone() is not None
+
+
+def create_partition(connection, month: datetime) -> None:
+    """
+    Create the partition of the month if it does not exist.
+    Postgres refuses a partition while the default partition holds rows of its month, so they are moved
+    to the new table before it is attached, in one transaction.
+    """
+    name, bounds = partition_name(month), [month, add_months(month, 1)]
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        # Serializes the workers creating partitions, inserts into the other partitions go on
+        cursor.execute(f'LOCK TABLE ONLY {TABLE} IN SHARE UPDATE EXCLUSIVE MODE')
+        if partition_exists(connection, month):
+            return
+        cursor.execute(f'LOCK TABLE {DEFAULT_PARTITION} IN ACCESS EXCLUSIVE MODE')
+        cursor.execute(f'CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)')
+        cursor.execute(
+            f'WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE "timestamp" >= %s AND "timestamp" < %s '
+            f'RETURNING *) INSERT INTO {name} SELECT * FROM moved',
+            bounds,
+        )
+        cursor.execute(f'ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)', bounds)
+
+
+def create_partitions(connection, first: datetime, ahead: int) -> list:
+    """
+    Create the partitions from the month of `first` until `ahead` months after the current one.
+    """
+    month, last = month_start(first), add_months(month_start(timezone.now()), ahead)
+    months = []
+    while month <= last:
+        create_partition(connection, month)
+        months.append(month)
+        month = add_months(month, 1)
+    return months
+
+
+def drop_partition(connection, month: datetime) -> None:
+    """
+    Detach and drop the partition of the month.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {TABLE} DETACH PARTITION {partition_name(month)}')
+        cursor.execute(f'DROP TABLE {partition_name(month)}')
+
+
+def partition_exists(connection, month: datetime) -> bool:
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT to_regclass(%s)', [partition_name(month)])
+        return cursor.fetchone()[0] is not None
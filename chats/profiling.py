@@ -0,0 +1,134 @@
+from contextlib import contextmanager
+from django.conf import settings
+import contextvars
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Profile of the consumer event being handled, visible in the database threads through the copied context
+_profile = contextvars.ContextVar('event_profile', default=None)
+
+# Budgets of the running tests, global because applications under test start with an empty context
+_budgets = []
+
+
+class EventProfile:
+    """
+    Queries and SQL time of one consumer event.
+    """
+
+    def __init__(self, consumer: str, event: str):
+        self.consumer = consumer
+        self.event = event
+        self.room = None
+        self.user = None
+        self.queries = 0
+        self.sql_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_sql = None
+        self.duration = 0.0
+
+    def record(self, sql: str, elapsed: float) -> None:
+        self.queries += 1
+        self.sql_time += elapsed
+        if elapsed >= self.slowest_time:
+            self.slowest_time = elapsed
+            self.slowest_sql = sql
+
+    def as_dict(self) -> dict:
+        return {
+            'consumer': self.consumer,
+            'event': self.event,
+            'room': self.room,
+            'user': self.user,
+            'duration_ms': round(self.duration * 1000, 3),
+            'queries': self.queries,
+            'sql_ms': round(self.sql_time * 1000, 3),
+            'slowest_sql_ms': round(self.slowest_time * 1000, 3),
+            'slowest_sql': self.slowest_sql,
+        }
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    Execute wrapper recording the query into the profile of the current event.
+    """
+    profile = _profile.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.record(sql, time.perf_counter() - started)
+
+
+def install(connection, **kwargs) -> None:
+    """
+    Add the query recorder to the database connection, connected to `connection_created`.
+    """
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class QueryBudget:
+    """
+    Maximum number of queries a single consumer event may run.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.violations = []
+
+    def check(self, profile: EventProfile) -> None:
+        if profile.queries > self.limit:
+            self.violations.append(profile)
+
+
+@contextmanager
+def query_budget(limit: int):
+    """
+    Fail the test if a consumer event handled inside the block runs more than `limit` queries.
+    """
+    budget = QueryBudget(limit)
+    _budgets.append(budget)
+    try:
+        yield budget
+    finally:
+        _budgets.remove(budget)
+    if budget.violations:
+        raise AssertionError('Query budget of {} exceeded:\n{}'.format(
+            limit, '\n'.join(str(profile.as_dict()) for profile in budget.violations),
+        ))
+
+
+class ProfilingMixin:
+    """
+    Profile the queries of every event of the consumer: connect, receive, disconnect and group events.
+    Enabled with `EVENT_PROFILING` or inside `query_budget`, events over the thresholds are logged.
+    """
+
+    async def dispatch(self, message) -> None:
+        budget = _budgets[-1] if _budgets else None
+        if not settings.EVENT_PROFILING and budget is None:
+            return await super().dispatch(message)
+
+        profile = EventProfile(type(self).__name__, message['type'])
+        token = _profile.set(profile)
+        started = time.perf_counter()
+        try:
+            await super().dispatch(message)
+        finally:
+            _profile.reset(token)
+            profile.duration = time.perf_counter() - started
+            profile.room = getattr(self, 'room_group_name', None)
+            profile.user = getattr(self.scope.get('user'), 'username', None)
+            if budget is not None:
+                budget.check(profile)
+            if profile.duration >= settings.EVENT_SLOW_SECONDS or profile.queries >= settings.EVENT_SLOW_QUERIES:
+                logger.warning(
+                    'Slow event %s.%s: %.1f ms, %d queries, %.1f ms SQL',
+                    profile.consumer, profile.event, profile.duration * 1000, profile.queries,
+                    profile.sql_time * 1000, extra={'event_profile': profile.as_dict()},
+                )
@@ -0,0 +1,40 @@
+from redis.exceptions import RedisError
+from django.conf import settings
+import redis.asyncio as aioredis
+import asyncio
+import weakref
+import time
+
+__all__ = ['get_redis', 'mark_down', 'RedisError']
+
+# Clients are bound to the event loop they were created on
+_clients = weakref.WeakKeyDictionary()
+_down_until = 0.0
+
+
+def get_redis() -> aioredis.Redis | None:
+    """
+    Get the Redis client for the running event loop.
+    Returns None if Redis is not configured or was unreachable recently, callers fall back to the database.
+    """
+    if not settings.REDIS_URL or time.monotonic() < _down_until:
+        return None
+
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = aioredis.Redis.from_url(
+            settings.REDIS_URL,
+            socket_connect_timeout=settings.REDIS_TIMEOUT,
+            socket_timeout=settings.REDIS_TIMEOUT,
+        )
+        _clients[loop] = client
+    return client
+
+
+def mark_down() -> None:
+    """
+    Stop using Redis for a while after a failed call.
+    """
+    global _down_until
+    _down_until = time.monotonic() + settings.REDIS_RETRY_INTERVAL
@@ -0,0 +1,113 @@
+"""
+Read replica routing.
+Reads go to the replica only inside `read_from_replica`, everything else, including all writes, uses the primary.
+A connection which just wrote is pinned to the primary for `REPLICA_PIN_SECONDS` to read its own writes,
+and a replica lagging more than `REPLICA_MAX_LAG` seconds is skipped until it catches up.
+"""
+from django.db import connections, DatabaseError, DEFAULT_DB_ALIAS
+from contextlib import contextmanager
+from django.conf import settings
+import contextvars
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# The context is copied into the database threads, so the flags set by the consumer are visible to the router
+_replica_reads = contextvars.ContextVar('replica_reads', default=False)
+_pinned_until = contextvars.ContextVar('pinned_until', default=0.0)
+
+REPLICA_LAG_SQL = """
+SELECT CASE
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END
+"""
+
+_lag_lock = threading.Lock()
+# replica alias -> (checked at, lag in seconds or None if the replica is unavailable)
+_lag = {}
+
+
+def get_replica_lag(alias: str) -> float | None:
+    """
+    Get the replication lag of the replica in seconds, None if it can not be checked.
+    """
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        return 0.0
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(REPLICA_LAG_SQL)
+            lag = cursor.fetchone()[0]
+    except DatabaseError:
+        logger.warning('Could not check the lag of the %s database', alias, exc_info=True)
+        return None
+    return float(lag or 0)
+
+
+def replica_is_fresh(alias: str) -> bool:
+    """
+    Check if the replica lags less than `REPLICA_MAX_LAG`, the lag is checked at most every `REPLICA_LAG_INTERVAL`.
+    """
+    now = time.monotonic()
+    with _lag_lock:
+        checked, lag = _lag.get(alias, (None, None))
+        if checked is not None and now - checked < settings.REPLICA_LAG_INTERVAL:
+            return lag is not None and lag <= settings.REPLICA_MAX_LAG
+        # Other threads keep using the previous result while the lag is checked
+        _lag[alias] = (now, lag)
+    lag = get_replica_lag(alias)
+    with _lag_lock:
+        _lag[alias] = (now, lag)
+    return lag is not None and lag <= settings.REPLICA_MAX_LAG
+
+
+def replica_enabled() -> bool:
+    """
+    Check if reads inside `read_from_replica` may go to the replica.
+    """
+    return settings.DATABASE_REPLICA is not None and _pinned_until.get() <= time.monotonic()
+
+
+@contextmanager
+def read_from_replica():
+    """
+    Send the reads of the block to the replica.
+    """
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def pin_primary() -> None:
+    """
+    Read from the primary for `REPLICA_PIN_SECONDS`, call it in the consumer after a write.
+    """
+    _pinned_until.set(time.monotonic() + settings.REPLICA_PIN_SECONDS)
+
+
+class ReplicaRouter:
+    """
+    Route the reads inside `read_from_replica` to `DATABASE_REPLICA` if it is fresh.
+    """
+
+    def db_for_read(self, model, **hints) -> str:
+        if not _replica_reads.get() or not replica_enabled():
+            return DEFAULT_DB_ALIAS
+        if not replica_is_fresh(settings.DATABASE_REPLICA):
+            return DEFAULT_DB_ALIAS
+        return settings.DATABASE_REPLICA
+
+    def db_for_write(self, model, **hints) -> str:
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints) -> bool:
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints) -> bool:
+        # The replica gets the schema from the primary
+        return db == DEFAULT_DB_ALIAS
@@ -0,0 +1,71 @@
+"""
+Full-text search of messages in the rooms of the user.
+On Postgres the results are ranked by the indexed search vector, other databases match the content and rank by age.
+"""
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db.models import F, Q, FloatField, Value
+from django.db.models.functions import Cast
+from chats.models import Message, Room
+from django.db import connections
+from django.conf import settings
+
+
+def parse_cursor(cursor) -> tuple | None:
+    """
+    Parse the cursor of the next page, `<rank>:<message id>`.
+    """
+    try:
+        rank, message_id = str(cursor).split(':')
+        return float(rank), int(message_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def search_queryset(user, text: str, room_name: str | None = None):
+    """
+    Get the messages matching the text with their rank, best first.
+    Only rooms of the user are searched, a single one if `room_name` is given.
+    """
+    queryset = Message.objects.filter(room_uuid__in=Room.objects.filter(users=user.id).values('uuid'))
+    if room_name is not None:
+        queryset = queryset.filter(room_uuid=room_name)
+
+    if connections[queryset.db].vendor == 'postgresql':
+        query = SearchQuery(text, config=settings.MESSAGE_SEARCH_CONFIG, search_type='websearch')
+        # Ranks are real, cast to double so the cursor compares them exactly
+        queryset = queryset.filter(search_vector=query).annotate(
+            rank=Cast(SearchRank(F('search_vector'), query), FloatField()),
+        )
+    else:
+        queryset = queryset.filter(content__icontains=text).annotate(rank=Value(0.0, output_field=FloatField()))
+    return queryset.select_related('sender').order_by('-rank', '-id')
+
+
+async def search_messages(user, text: str, room_name: str | None = None, cursor: str | None = None):
+    """
+    Search a page of `MESSAGE_SEARCH_PAGE_SIZE` messages after the cursor and yield them in chunks
+    of `MESSAGE_SEARCH_CHUNK_SIZE` as they are read. Every result has the cursor of the page after it.
+    """
+    queryset = search_queryset(user, text, room_name)
+    position = parse_cursor(cursor)
+    if position is not None:
+        rank, message_id = position
+        queryset = queryset.filter(Q(rank__lt=rank) | Q(rank=rank, id__lt=message_id))
+
+    chunk = []
+    async for message in queryset[:settings.MESSAGE_SEARCH_PAGE_SIZE].aiterator(
+            chunk_size=settings.MESSAGE_SEARCH_CHUNK_SIZE):
+        chunk.append({
+            'room': str(message.room_uuid),
+            'seq': message.seq,
+            'content': message.content,
+            'timestamp': message.timestamp.astimezone().strftime('%Y-%m-%d %H:%M:%S'),
+            'sender': message.sender.username,
+            'rank': message.rank,
+            'cursor': f'{message.rank!r}:{message.id}',
+        })
+        if len(chunk) == settings.MESSAGE_SEARCH_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
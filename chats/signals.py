@@ -0,0 +1,46 @@
+from django.db.models.signals import m2m_changed, post_save
+from chats.models import Room, ReadCursor, User
+from django.dispatch import receiver
+from chats import membership, summaries
+
+
+@receiver(m2m_changed, sender=Room.users.through)
+def room_users_changed(sender, instance, action: str, reverse: bool, pk_set: set, **kwargs) -> None:
+    """
+    Drop the cached members of the changed rooms and store the new members in the room summaries.
+    Create read cursors for the users added to a room.
+    """
+    if action == 'pre_clear' and reverse:
+        instance._cleared_rooms = list(instance.rooms.values_list('id', flat=True))
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        membership.invalidate(None if reverse else str(instance.uuid))
+        if not reverse:
+            summaries.refresh_members([instance.id])
+        else:
+            summaries.refresh_members(pk_set if action != 'post_clear' else getattr(instance, '_cleared_rooms', []))
+    if action != 'post_add' or not pk_set:
+        return
+    if reverse:
+        cursors = [ReadCursor(user=instance, room_id=room_id) for room_id in pk_set]
+    else:
+        cursors = [ReadCursor(user_id=user_id, room=instance) for user_id in pk_set]
+    ReadCursor.objects.bulk_create(cursors, ignore_conflicts=True)
+
+
+@receiver(post_save, sender=Room)
+def room_saved(sender, instance: Room, created: bool, **kwargs) -> None:
+    """
+    Create the summary of a new room.
+    """
+    if created:
+        summaries.create_summary(instance)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance: User, created: bool, update_fields=None, **kwargs) -> None:
+    """
+    Store the changed username or avatar in the summaries of the rooms of the user.
+    """
+    if created or (update_fields is not None and not {'username', 'avatar'} & set(update_fields)):
+        return
+    summaries.refresh_user(instance)
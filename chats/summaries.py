@@ -0,0 +1,64 @@
+"""
+Room summaries of the chat list, updated in the transaction of the change they follow.
+"""
+from chats.models import Room, RoomSummary, Message
+from django.db import transaction
+from django.db.models import Q
+from django.conf import settings
+from django.utils import timezone
+
+
+def member_data(user) -> dict:
+    return {
+        'id': user.id,
+        'username': user.username,
+        'avatar': user.avatar.name if user.avatar else None,
+    }
+
+
+def preview(message: Message) -> str:
+    """
+    Get the preview of the message shown in the chat list.
+    """
+    return (message.content or message.file.name or '')[:settings.SUMMARY_PREVIEW_LENGTH]
+
+
+def create_summary(room: Room) -> None:
+    RoomSummary.objects.get_or_create(room=room, defaults={'last_activity': room.created_at or timezone.now()})
+
+
+def update_last_message(room_name: str, message: Message) -> None:
+    """
+    Set the message as the last one of the room, unless a later one was saved first.
+    """
+    RoomSummary.objects.filter(
+        Q(last_seq__isnull=True) | Q(last_seq__lt=message.seq), room__uuid=room_name,
+    ).update(last_message=preview(message), last_seq=message.seq, last_activity=message.timestamp)
+
+
+def refresh_members(rooms) -> None:
+    """
+    Store the current members of the rooms in their summaries.
+    The summaries are locked first, so concurrent changes of the members are written in order.
+    """
+    with transaction.atomic():
+        summaries = {summary.room_id: summary for summary in RoomSummary.objects.select_for_update().filter(
+            room__in=rooms,
+        )}
+        for room in Room.objects.filter(id__in=rooms).prefetch_related('users'):
+            members = [member_data(user) for user in room.users.all()]
+            summary = summaries.get(room.id)
+            if summary is None:
+                RoomSummary.objects.create(
+                    room=room, last_activity=room.created_at, member_count=len(members), members=members,
+                )
+            else:
+                summary.member_count, summary.members = len(members), members
+                summary.save(update_fields=['member_count', 'members'])
+
+
+def refresh_user(user) -> None:
+    """
+    Store the changed username or avatar of the user in the summaries of the rooms.
+    """
+    refresh_members(user.rooms.values('id'))
@@ -1,17 +1,65 @@
 from middlewares.middleware_helpers import create_user_async, get_user_async, receive_user, check_response, \
     get_user
 from channels.testing import WebsocketCommunicator, ChannelsLiveServerTestCase
+from channels.layers import get_channel_layer
+from chats.images import render_thumbnail, thumbnail_url
+from chats.layers import ShardedRedisChannelLayer
+from chats.metrics import Counter, Histogram, render, REGISTRY, DB_EXECUTOR_WAIT_SECONDS, HANDSHAKES_REJECTED, \
+    MESSAGE_TRACES_DROPPED, REAPED_CONNECTIONS
+from chats.db import db_sync_to_async, executor
+from chats.profiling import query_budget
+from chats import drain, fanout, images, inbox, tracing, utils
+from chats.tokens import token_expiry
+from chats.routers import ReplicaRouter, read_from_replica, pin_primary, _lag
+from chats.models import ReadCursor, Message, MessageArchive, Room, RoomSummary
+from django.core.management import call_command
+from chats.archive import read_archive
+from chats.partitions import DEFAULT_PARTITION, add_months, create_partition, month_start, partition_name
+from django.db import connection, DatabaseError, IntegrityError
+from asgiref.sync import sync_to_async
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
 from .utils import create_or_get_room, save_message, get_status
 from middlewares.websocket_auth import TokenAuthMiddleware
+from middlewares.admission import AdmissionMiddleware
 from .consumers import ConnectionConsumer, ChatConsumer
 from unittest.mock import patch, Mock, AsyncMock
 from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, override_settings
+from django.conf import settings
 from django.utils import timezone
-from datetime import datetime
+from PIL import Image
+import contextvars
+import io
+import gzip
+import time
+import base64
+import json
+import asyncio
+import unittest
+import tempfile
+import queue
+import threading
+import uuid
+import shutil
+import socket
+import os
 
 User = get_user_model()
 
 
+def redis_available() -> bool:
+    """
+    Check if the first channel layer host accepts connections.
+    """
+    host, _, port = settings.CHANNEL_HOSTS[0].partition(':')
+    try:
+        socket.create_connection((host, int(port or 6379)), timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+
 class TestsMiddlewareHelpers(ChannelsLiveServerTestCase):
     def setUp(self):
         # Set up common variables for test cases
@@ -72,6 +120,7 @@ class TestsMiddlewareHelpers(ChannelsLiveServerTestCase):
         self.assertEqual(user.username, self.username)
         self.assertEqual(user.email, self.email)
         self.assertTrue(user.is_active)
+        self.assertTrue((await get_status(user)).online)
 
     async def test_get_user_async(self) -> None:
         """
@@ -84,6 +133,9 @@ class TestsMiddlewareHelpers(ChannelsLiveServerTestCase):
         self.assertEqual(user.email, self.email)
         self.assertTrue(user.is_active)
 
+        with self.assertRaises(User.DoesNotExist):
+            await get_user_async('missing@test.com')
+
     async def test_valid_response(self) -> None:
         """
         Test the check_response function with a valid response (status code 200)
@@ -442,6 +494,7 @@ class TestsChatConsumer(ChannelsLiveServerTestCase):
 
         # Connect to the chat room WebSocket endpoint
         communicator_chat = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room_uuid}')
+        communicator_chat.scope['user'] = self.user
         await communicator_chat.connect()
 
         # Receive message from the chat room
@@ -482,6 +535,7 @@ class TestsChatConsumer(ChannelsLiveServerTestCase):
 
         # Connect to the chat room WebSocket endpoint
         communicator_chat = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room_uuid}')
+        communicator_chat.scope['user'] = self.user
         connected, _ = await communicator_chat.connect()
         self.assertTrue(connected)
 
@@ -494,3 +548,1170 @@ class TestsChatConsumer(ChannelsLiveServerTestCase):
         self.assertEqual(response_data['content'], self.content)
         self.assertEqual(response_data['sender'], self.username)
         self.check_timestamp(response_data)
+
+    async def test_resume_since_seq(self) -> None:
+        """
+        Test reconnecting to a chat room with the last received sequence number.
+        """
+        # Initialize the user for testing
+        await self.initialize_user()
+        room = await create_or_get_room(self.username)
+
+        # Save messages, they get increasing sequence numbers
+        for content in ('first', 'second', 'third'):
+            message, _ = await save_message(room.uuid, {'content': content, 'sender': self.username})
+        self.assertEqual(message.seq, 3)
+
+        # Reconnect after the first message
+        communicator_chat = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.uuid}?since_seq=1')
+        communicator_chat.scope['user'] = self.user
+        connected, _ = await communicator_chat.connect()
+        self.assertTrue(connected)
+
+        # Only the missing messages are sent
+        response = await communicator_chat.receive_json_from()
+        self.assertEqual([message['seq'] for message in response['messages']], [2, 3])
+        self.assertEqual(response['messages'][0]['content'], 'second')
+
+        # New messages continue the sequence
+        await communicator_chat.send_json_to({'type': 'chat.content', 'content': 'fourth', 'sender': self.username})
+        response = await communicator_chat.receive_json_from()
+        self.assertEqual(response['seq'], 4)
+        await communicator_chat.disconnect()
+
+    async def test_taken_seq(self) -> None:
+        """
+        Test sequence numbers are allocated in the transaction of the message and can not be taken twice.
+        """
+        await self.initialize_user()
+        room = await create_or_get_room(self.username)
+        await save_message(room.uuid, {'content': 'first', 'sender': self.username})
+
+        # A sequence number sent by the frontend is ignored
+        message, created = await save_message(room.uuid, {'content': 'second', 'sender': self.username, 'seq': 1})
+        self.assertTrue(created)
+        self.assertEqual(message.seq, 2)
+        with self.assertRaises(IntegrityError):
+            await Message.objects.acreate(room_uuid=room.uuid, seq=2, sender=self.user, content='duplicate')
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', 'SQLite does not write concurrently')
+    async def test_concurrent_seq(self) -> None:
+        """
+        Test concurrent messages of a room get consecutive sequence numbers, committed in order.
+        """
+        await self.initialize_user()
+        room = await create_or_get_room(self.username)
+        messages = await asyncio.gather(*(
+            save_message(room.uuid, {'content': f'message {index}', 'sender': self.username}) for index in range(10)
+        ))
+        self.assertEqual(sorted(message.seq for message, _ in messages), list(range(1, 11)))
+        # Ids come from a sequence in insert order, so the messages were inserted in sequence order
+        ids = [message.id for message, _ in sorted(messages, key=lambda result: result[0].seq)]
+        self.assertEqual(ids, sorted(ids))
+
+    async def test_unread_count(self) -> None:
+        """
+        Test the unread count after new messages and a read marker.
+        """
+        # Initialize both users in the same room
+        await self.initialize_user()
+        room = await create_or_get_room(self.username)
+        await create_or_get_room(self.username2)
+
+        async def get_unread(user) -> int:
+            return (await ConnectionConsumer().get_chats_from_db(user))[0]['unread']
+
+        # Messages from the second user are unread for the first one only, only the cursor of the sender is written
+        await save_message(room.uuid, {'content': 'first', 'sender': self.username2})
+        await save_message(room.uuid, {'content': 'second', 'sender': self.username2})
+        self.assertEqual(await get_unread(self.user), 2)
+        self.assertEqual(await get_unread(self.user2), 0)
+        cursor = await ReadCursor.objects.aget(user=self.user2, room=room)
+        self.assertEqual(cursor.own_count, 2)
+
+        # The read marker is written on disconnect at the latest
+        communicator_chat = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.uuid}')
+        communicator_chat.scope['user'] = self.user
+        await communicator_chat.connect()
+        await communicator_chat.receive_json_from()
+        await communicator_chat.send_json_to({'type': 'chat.read', 'seq': 1})
+        await communicator_chat.disconnect()
+
+        cursor = await ReadCursor.objects.aget(user=self.user, room=room)
+        self.assertEqual(cursor.last_read_seq, 1)
+        self.assertEqual(await get_unread(self.user), 1)
+
+        # Own messages after the read marker are not unread
+        await save_message(room.uuid, {'content': 'own', 'sender': self.username})
+        self.assertEqual(await get_unread(self.user), 1)
+        self.assertEqual(await get_unread(self.user2), 1)
+
+        # A failed write of the delayed read marker is logged
+        with override_settings(READ_MARKER_DELAY=0), \
+                patch('chats.consumers.mark_read', AsyncMock(side_effect=DatabaseError)), \
+                self.assertLogs('chats.consumers', 'ERROR'):
+            communicator_chat = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.uuid}')
+            communicator_chat.scope['user'] = self.user
+            await communicator_chat.connect()
+            await communicator_chat.receive_json_from()
+            await communicator_chat.send_json_to({'type': 'chat.read', 'seq': 2})
+            await asyncio.sleep(0.1)
+            await communicator_chat.disconnect()
+
+    async def test_chat_list(self) -> None:
+        """
+        Test the chat list is read from the room summaries in one query, the last active room first.
+        """
+        await self.initialize_user()
+        room = await create_or_get_room(self.username)
+        await create_or_get_room(self.username2)
+        other_room = await Room.objects.acreate(description='other')
+        await other_room.users.aadd(self.user)
+        await save_message(room.uuid, {'content': 'first', 'sender': self.username2})
+        await save_message(other_room.uuid, {'content': 'latest', 'sender': self.username})
+
+        summary = await RoomSummary.objects.aget(room=room)
+        self.assertEqual((summary.last_message, summary.last_seq, summary.member_count), ('first', 1, 2))
+
+        # Connecting writes the status and reads the chat list
+        with query_budget(2):
+            communicator = await self.simulate_connection()
+            for _ in range(3):
+                await communicator.receive_json_from()
+            chats = (await communicator.receive_json_from())['chats']
+        await communicator.disconnect()
+
+        self.assertEqual([chat['uuid'] for chat in chats], [str(other_room.uuid), str(room.uuid)])
+        self.assertEqual(chats[0]['last_message'], 'latest')
+        self.assertEqual(chats[1]['unread'], 1)
+        self.assertEqual([user['username'] for user in chats[1]['users']], [self.username2])
+
+        # Username changes are stored in the summaries
+        self.user2.username = 'renamed'
+        await self.user2.asave(update_fields=['username'])
+        summary = await RoomSummary.objects.aget(room=room)
+        self.assertIn('renamed', [member['username'] for member in summary.members])
+
+    @override_settings(INBOX_ACTIVITY_DELAY=0)
+    async def test_inbox(self) -> None:
+        """
+        Test the messages of a room without an open chat are sent as activity and drained on connect.
+        """
+        await self.initialize_user()
+        room = await create_or_get_room(self.username)
+        await create_or_get_room(self.username2)
+        communicator = await self.simulate_connection()
+        for _ in range(4):
+            await communicator.receive_json_from()
+        communicator_chat = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.uuid}')
+        communicator_chat.scope['user'] = self.user2
+        await communicator_chat.connect()
+        await communicator_chat.receive_json_from()
+
+        try:
+            for content in ('first', 'second'):
+                await communicator_chat.send_json_to({'type': 'chat.content', 'content': content})
+                await communicator_chat.receive_json_from()
+
+            # The connected user gets the activity of the room, the sender with the open chat gets none
+            rooms = {}
+            while sum(activity['count'] for activity in rooms.values()) < 2:
+                response = await communicator.receive_json_from()
+                self.assertEqual(response['type'], 'chat.activity')
+                for room_name, activity in response['rooms'].items():
+                    rooms.setdefault(room_name, {'count': 0})['count'] += activity['count']
+                    rooms[room_name]['last_seq'] = activity['last_seq']
+            self.assertEqual(rooms, {str(room.uuid): {'count': 2, 'last_seq': 2}})
+            self.assertEqual(await inbox.drain(self.username2), [])
+            await communicator.disconnect()
+
+            # The inbox is sent in one frame on the next connect, without the messages read on another device
+            await save_message(room.uuid, {'content': 'third', 'sender': self.username2})
+            await inbox.push([self.username], {'room': str(room.uuid), 'seq': 3, 'sender': self.username2,
+                                               'preview': 'third', 'timestamp': None})
+            await ReadCursor.objects.filter(user=self.user, room=room).aupdate(last_read_seq=1)
+            communicator = await self.simulate_connection()
+            for _ in range(4):
+                await communicator.receive_json_from()
+            response = await communicator.receive_json_from()
+            self.assertEqual(response['type'], 'inbox')
+            self.assertEqual([(entry['seq'], entry['preview'], entry['sender']) for entry in response['messages']],
+                             [(2, 'second', self.username2), (3, 'third', self.username2)])
+            self.assertEqual(await inbox.drain(self.username), [])
+        finally:
+            await communicator.disconnect()
+            await communicator_chat.disconnect()
+        self.assertNotIn(str(room.uuid), inbox._local_in_room)
+
+    async def test_release_handshake(self) -> None:
+        """
+        Test the consumers do not keep the tokens and headers in the scope after connecting.
+        """
+        await self.initialize_user()
+        room = await create_or_get_room(self.username)
+        communicator = await self.simulate_connection()
+        tokens = (await communicator.receive_json_from(), await communicator.receive_json_from())[1]
+        self.assertEqual(tokens['access'], 'access_token_value')
+        self.assertNotIn('cookies', communicator.scope)
+        self.assertNotIn('headers', communicator.scope)
+        await communicator.disconnect()
+
+        communicator_chat = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.uuid}')
+        communicator_chat.scope['user'] = self.user
+        await communicator_chat.connect()
+        self.assertNotIn('headers', communicator_chat.scope)
+        await communicator_chat.disconnect()
+
+    @override_settings(TOKEN_REFRESH_BEFORE=0, TOKEN_REFRESH_JITTER=0)
+    @patch('middlewares.middleware_helpers.requests.post')
+    async def test_token_refresh(self, mock_requests_post) -> None:
+        """
+        Test the tokens are refreshed once for all connections of the user before the access token expires.
+        """
+        def jwt(exp: float) -> str:
+            payload = base64.urlsafe_b64encode(json.dumps({'exp': exp}).encode()).decode().rstrip('=')
+            return f'header.{payload}.signature'
+
+        access, new_access = jwt(time.time() + 0.2), jwt(time.time() + 3600)
+        self.assertAlmostEqual(token_expiry(new_access), time.time() + 3600, delta=5)
+        self.assertIsNone(token_expiry('access_token_value'))
+        mock_requests_post.return_value.status_code = 200
+        mock_requests_post.return_value.json.return_value = {'access': new_access}
+
+        await self.initialize_user()
+        communicators = []
+        for _ in range(2):
+            communicator = WebsocketCommunicator(ConnectionConsumer.as_asgi(), self.url)
+            communicator.scope['cookies'] = {'access': access, 'refresh': 'refresh_token_value'}
+            communicator.scope['user'] = self.user
+            await communicator.connect()
+            for _ in range(4):
+                await communicator.receive_json_from()
+            communicators.append(communicator)
+
+        # Both connections get the new access token with the old refresh token, refreshed once
+        for communicator in communicators:
+            tokens = await communicator.receive_json_from(timeout=5)
+            self.assertEqual(tokens, {'access': new_access, 'refresh': 'refresh_token_value'})
+        mock_requests_post.assert_called_once()
+        self.assertEqual(mock_requests_post.call_args.kwargs['data'], {'refresh': 'refresh_token_value'})
+        for communicator in communicators:
+            await communicator.disconnect()
+
+    @override_settings(MESSAGE_TRACE_SAMPLE_RATE=1)
+    async def test_message_trace(self) -> None:
+        """
+        Test a traced message is exported when published and when delivered to every member.
+        """
+        records = []
+        exporter = Mock(export=records.append)
+        await self.initialize_user()
+        room = await create_or_get_room(self.username)
+        await create_or_get_room(self.username2)
+        communicators = []
+        for user in (self.user, self.user2):
+            communicator_chat = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.uuid}')
+            communicator_chat.scope['user'] = user
+            await communicator_chat.connect()
+            await communicator_chat.receive_json_from()
+            communicators.append(communicator_chat)
+
+        with patch.object(tracing, '_exporter', exporter):
+            await communicators[0].send_json_to({'type': 'chat.content', 'content': self.content})
+            for communicator_chat in communicators:
+                self.assertNotIn('trace', await communicator_chat.receive_json_from())
+        for communicator_chat in communicators:
+            await communicator_chat.disconnect()
+
+        self.assertEqual(len({record['trace_id'] for record in records}), 1)
+        self.assertEqual([record['stage'] for record in records], ['publish', 'deliver', 'deliver'])
+        self.assertEqual({record['recipient'] for record in records[1:]}, {self.username, self.username2})
+        for record in records:
+            self.assertEqual((record['room'], record['seq']), (str(room.uuid), 1))
+            self.assertTrue(record['received'] <= record['persisted'] <= record['published'] <= record['at'])
+            self.assertGreaterEqual(record['total_ms'], record['persist_ms'])
+
+    def test_trace_file_exporter(self) -> None:
+        """
+        Test the file exporter appends the records as JSON lines.
+        """
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'traces.jsonl')
+            exporter = tracing.JsonFileExporter(path)
+            for seq in (1, 2):
+                exporter.export({'trace_id': 'trace', 'seq': seq})
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline:
+                with open(path) as file:
+                    lines = file.read().splitlines()
+                if len(lines) == 2:
+                    break
+                time.sleep(0.01)
+            self.assertEqual([json.loads(line)['seq'] for line in lines], [1, 2])
+
+            # A failed write does not stop the thread, records beyond the queue are dropped
+            with patch.object(exporter, 'file', Mock(write=Mock(side_effect=OSError))), \
+                    self.assertLogs('chats.tracing', 'ERROR'):
+                exporter.export({'trace_id': 'trace', 'seq': 3})
+                deadline = time.monotonic() + 5
+                while exporter.file is not None and time.monotonic() < deadline:
+                    time.sleep(0.01)
+            exporter.export({'trace_id': 'trace', 'seq': 4})
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline:
+                with open(path) as file:
+                    lines = file.read().splitlines()
+                if len(lines) == 3:
+                    break
+                time.sleep(0.01)
+            self.assertEqual([json.loads(line)['seq'] for line in lines], [1, 2, 4])
+            exporter.close()
+
+        dropped = MESSAGE_TRACES_DROPPED.values[('queue_full',)]
+        exporter = tracing.JsonFileExporter(os.devnull)
+        with patch.object(exporter.records, 'put_nowait', Mock(side_effect=queue.Full)):
+            exporter.export({'trace_id': 'trace', 'seq': 5})
+        self.assertEqual(MESSAGE_TRACES_DROPPED.values[('queue_full',)], dropped + 1)
+
+    async def test_not_member(self) -> None:
+        """
+        Test connecting to a chat room of other users.
+        """
+        # Initialize a room without the first user
+        await self.initialize_user()
+        room = await create_or_get_room(self.username2)
+
+        # The connection is rejected
+        communicator_chat = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.uuid}')
+        communicator_chat.scope['user'] = self.user
+        connected, code = await communicator_chat.connect()
+        self.assertFalse(connected)
+        self.assertEqual(code, 4403)
+
+        # Adding the user to the room drops the cached members
+        await room.users.aadd(self.user)
+        communicator_chat = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.uuid}')
+        communicator_chat.scope['user'] = self.user
+        connected, _ = await communicator_chat.connect()
+        self.assertTrue(connected)
+        await communicator_chat.disconnect()
+
+    @override_settings(FANOUT_LARGE_ROOM_SIZE=2)
+    async def test_large_room(self) -> None:
+        """
+        Test sending a message in a room fanned out through the worker node.
+        """
+        # Initialize both users in the same room
+        await self.initialize_user()
+        room = await create_or_get_room(self.username)
+        await create_or_get_room(self.username2)
+
+        # Connect both users to the chat room
+        communicators = []
+        for user in (self.user, self.user2):
+            communicator_chat = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.uuid}')
+            communicator_chat.scope['user'] = user
+            connected, _ = await communicator_chat.connect()
+            self.assertTrue(connected)
+            await communicator_chat.receive_json_from()
+            communicators.append(communicator_chat)
+
+        # Both users receive the message once
+        await communicators[1].send_json_to({'type': 'chat.content', 'content': self.content})
+        for communicator_chat in communicators:
+            response = await communicator_chat.receive_json_from()
+            self.assertEqual((response['content'], response['sender']), (self.content, self.username2))
+            self.assertTrue(await communicator_chat.receive_nothing())
+            await communicator_chat.disconnect()
+
+    @override_settings(FANOUT_SWITCH_GRACE=0.2)
+    async def test_fanout_switch(self) -> None:
+        """
+        Test a consumer connected before the room switched to the worker nodes keeps getting every message once.
+        """
+        await self.initialize_user()
+        room = await create_or_get_room(self.username)
+        await create_or_get_room(self.username2)
+        self.addCleanup(fanout._large_rooms.clear)
+
+        with patch('chats.fanout.room_mode', AsyncMock(return_value=fanout.SMALL)) as room_mode:
+            communicators = []
+            for user in (self.user, self.user2):
+                communicator_chat = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.uuid}')
+                communicator_chat.scope['user'] = user
+                await communicator_chat.connect()
+                await communicator_chat.receive_json_from()
+                communicators.append(communicator_chat)
+
+            # Another worker switched the room, the consumers move to the node and stay in the room group for a while
+            await get_channel_layer().group_send(str(room.uuid), {
+                'type': 'fanout_switch', 'room': str(room.uuid), 'at': time.time(),
+            })
+            await communicators[0].receive_nothing()
+            for mode in (fanout.SMALL, fanout.SWITCHING):
+                room_mode.return_value = mode
+                await communicators[1].send_json_to({'type': 'chat.content', 'content': mode})
+                for communicator_chat in communicators:
+                    self.assertEqual((await communicator_chat.receive_json_from())['content'], mode)
+                    self.assertTrue(await communicator_chat.receive_nothing())
+
+            # After the switch the messages only go to the nodes
+            await asyncio.sleep(0.2)
+            room_mode.return_value = fanout.LARGE
+            await communicators[1].send_json_to({'type': 'chat.content', 'content': fanout.LARGE})
+            for communicator_chat in communicators:
+                self.assertEqual((await communicator_chat.receive_json_from())['content'], fanout.LARGE)
+                self.assertTrue(await communicator_chat.receive_nothing())
+                await communicator_chat.disconnect()
+
+    async def test_query_budget(self) -> None:
+        """
+        Test the query budget of the chat consumer events.
+        """
+        # Initialize a room with history
+        await self.initialize_user()
+        room = await create_or_get_room(self.username)
+        for _ in range(5):
+            await save_message(room.uuid, {'content': self.content, 'sender': self.username})
+
+        # Loading the history does not query the sender of every message
+        with query_budget(3):
+            communicator_chat = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.uuid}')
+            communicator_chat.scope['user'] = self.user
+            await communicator_chat.connect()
+            response = await communicator_chat.receive_json_from()
+            self.assertEqual(len(response['messages']), 5)
+            await communicator_chat.disconnect()
+
+        # Saving a message does not fit into a single query
+        with self.assertRaises(AssertionError):
+            with query_budget(1):
+                communicator_chat = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.uuid}')
+                communicator_chat.scope['user'] = self.user
+                await communicator_chat.connect()
+                await communicator_chat.receive_json_from()
+                await communicator_chat.send_json_to({'type': 'chat.content', 'content': self.content})
+                await communicator_chat.receive_json_from()
+                await communicator_chat.disconnect()
+
+    async def test_db_executor(self) -> None:
+        """
+        Test the database executor starts all threads with their connections and records the wait time.
+        """
+        await self.initialize_user()
+        waits = sum(DB_EXECUTOR_WAIT_SECONDS.counts[()])
+
+        @db_sync_to_async
+        def count_users() -> int:
+            return User.objects.count()
+
+        self.assertEqual(await count_users(), 2)
+        self.assertEqual(len(executor._threads), settings.DB_EXECUTOR_WORKERS)
+        self.assertEqual(sum(DB_EXECUTOR_WAIT_SECONDS.counts[()]), waits + 1)
+
+    async def test_db_sync_to_async(self) -> None:
+        """
+        Test the function runs in an executor thread with the connections checked around it and raises its errors.
+        """
+        @db_sync_to_async
+        def get_thread_name() -> str:
+            return threading.current_thread().name
+
+        @db_sync_to_async
+        def fail() -> None:
+            raise ValueError('failed')
+
+        with patch('chats.db.close_old_connections') as close_old_connections:
+            self.assertTrue((await get_thread_name()).startswith('db'))
+        self.assertEqual(close_old_connections.call_count, 2)
+        with self.assertRaises(ValueError):
+            await fail()
+
+    async def test_async_helpers(self) -> None:
+        """
+        Test the helpers using the async ORM.
+        """
+        await self.initialize_user()
+
+        # The status is updated in place and created for users without one
+        await utils.set_status_async(self.username, False)
+        status = await get_status(self.user)
+        self.assertFalse(status.online)
+        self.assertIsNotNone(status.last_seen)
+        await status.adelete()
+        await utils.set_status_async(self.username, True)
+        self.assertTrue((await get_status(self.user)).online)
+
+        self.assertEqual(await utils.filter_users('user2'), [{'id': self.user2.id, 'username': self.username2}])
+        await utils.set_username_async('renamed', self.user2)
+        self.assertEqual(await utils.filter_users('renamed'), [{'id': self.user2.id, 'username': 'renamed'}])
+
+        room = await create_or_get_room(self.username)
+        self.assertEqual([user.username async for user in room.users.all()], [self.username])
+        self.assertEqual(await utils.get_last_seq_async(room.uuid), 0)
+        await save_message(room.uuid, {'content': self.content, 'sender': self.username})
+        self.assertEqual(await utils.get_last_seq_async(room.uuid), 1)
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', 'Partitions need Postgres')
+    def test_create_partition(self) -> None:
+        """
+        Test the rows of a month in the default partition are moved to its new partition.
+        """
+        user = User.objects.create(username=self.username, email=self.email)
+        message = Message.objects.create(room_uuid=uuid.uuid4(), seq=1, sender=user, content=self.content)
+        month = add_months(month_start(timezone.now()), settings.MESSAGE_PARTITIONS_AHEAD + 2)
+        Message.objects.filter(id=message.id).update(timestamp=month + timedelta(days=1))
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM {DEFAULT_PARTITION}')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+            create_partition(connection, month)
+            create_partition(connection, month)
+            cursor.execute(f'SELECT count(*) FROM {DEFAULT_PARTITION}')
+            self.assertEqual(cursor.fetchone()[0], 0)
+            cursor.execute(f'SELECT id FROM {partition_name(month)}')
+            self.assertEqual(cursor.fetchall(), [(message.id,)])
+
+    async def test_archive_messages(self) -> None:
+        """
+        Test old messages are moved to the archive and older pages of history are read from it.
+        """
+        await self.initialize_user()
+        room = await create_or_get_room(self.username)
+        for _ in range(5):
+            await save_message(room.uuid, {'content': self.content, 'sender': self.username})
+        await Message.objects.filter(seq__lte=3).aupdate(timestamp=timezone.now() - timedelta(days=400))
+
+        with tempfile.TemporaryDirectory() as archive_dir, override_settings(
+                MESSAGE_ARCHIVE_DIR=archive_dir, MESSAGE_ARCHIVE_AFTER_DAYS=180, MESSAGE_PAGE_SIZE=2):
+            await sync_to_async(call_command)('archive_messages', stdout=open(os.devnull, 'w'))
+            self.assertEqual(await Message.objects.filter(room_uuid=room.uuid).acount(), 2)
+            archive = await MessageArchive.objects.aget(room_uuid=room.uuid)
+            self.assertEqual((archive.first_seq, archive.last_seq, archive.count), (1, 3, 3))
+
+            # The connection gets the messages left in the database
+            communicator_chat = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.uuid}')
+            communicator_chat.scope['user'] = self.user
+            await communicator_chat.connect()
+            response = await communicator_chat.receive_json_from()
+            self.assertEqual([message['seq'] for message in response['messages']], [4, 5])
+
+            # Older pages are read from the archive
+            await communicator_chat.send_json_to({'type': 'chat.history', 'before_seq': 4})
+            response = await communicator_chat.receive_json_from()
+            self.assertEqual([message['seq'] for message in response['messages']], [2, 3])
+            self.assertEqual(response['messages'][0]['sender'], self.username)
+            await communicator_chat.send_json_to({'type': 'chat.history', 'before_seq': 2})
+            response = await communicator_chat.receive_json_from()
+            self.assertEqual([message['seq'] for message in response['messages']], [1])
+            await communicator_chat.disconnect()
+
+            # Messages added to an archived month are merged into its archive
+            message, _ = await save_message(room.uuid, {'content': self.content, 'sender': self.username})
+            await Message.objects.filter(id=message.id).aupdate(timestamp=timezone.now() - timedelta(days=400))
+            await sync_to_async(call_command)('archive_messages', stdout=open(os.devnull, 'w'))
+            archive = await MessageArchive.objects.aget(room_uuid=room.uuid)
+            self.assertEqual((archive.first_seq, archive.last_seq, archive.count), (1, 6, 4))
+            self.assertEqual([row['seq'] for row in read_archive(archive.path)], [1, 2, 3, 6])
+            self.assertEqual(await Message.objects.filter(room_uuid=room.uuid).acount(), 2)
+
+    async def test_export_import(self) -> None:
+        """
+        Test exporting the chat data to a compressed file and importing it again, resuming after a batch.
+        """
+        await self.initialize_user()
+        room = await create_or_get_room(self.username)
+        await create_or_get_room(self.username2)
+        for index in range(5):
+            await save_message(room.uuid, {'content': f'message {index}', 'sender': self.username2})
+        old = timezone.now() - timedelta(days=400)
+        await Message.objects.filter(seq=1).aupdate(timestamp=old)
+        # Messages saved before sequence numbers
+        await Message.objects.acreate(room_uuid=room.uuid, sender=self.user, content='legacy')
+
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'chats.ndjson.gz')
+            output = io.StringIO()
+            await sync_to_async(call_command)('export_chats', path, '--chunk-size', '2', stdout=output)
+            self.assertIn('6 messages', output.getvalue())
+            self.assertIn('rows/s', output.getvalue())
+            with open(path, 'rb') as file:
+                self.assertEqual(file.read(2), b'\x1f\x8b')
+
+            await Room.objects.all().adelete()
+            await Message.objects.all().adelete()
+            await User.objects.filter(username=self.username2).adelete()
+            await sync_to_async(call_command)('import_chats', path, '--batch-size', '2', stdout=open(os.devnull, 'w'))
+            self.assertEqual((await Message.objects.aget(room_uuid=room.uuid, seq=1)).timestamp, old)
+
+            # The import was interrupted after the second message, the batch with it was not recorded
+            await Message.objects.filter(seq__gt=2).adelete()
+            with gzip.open(path, 'rt') as file:
+                rooms_end = sum(1 for line in file if json.loads(line)['model'] != 'message')
+            with open(f'{path}.progress', 'w') as file:
+                file.write(str(rooms_end))
+            await sync_to_async(call_command)('import_chats', path, '--batch-size', '2', '--resume',
+                                              stdout=open(os.devnull, 'w'))
+            self.assertFalse(os.path.exists(f'{path}.progress'))
+
+        imported = await Room.objects.aget(uuid=room.uuid)
+        self.assertEqual({user.username async for user in imported.users.all()}, {self.username, self.username2})
+        self.assertEqual([message.seq async for message in Message.objects.filter(
+            room_uuid=room.uuid, seq__isnull=False,
+        ).order_by('seq')], [1, 2, 3, 4, 5])
+        self.assertEqual(await Message.objects.filter(room_uuid=room.uuid, seq__isnull=True).acount(), 1)
+        sender = await Message.objects.select_related('sender').aget(room_uuid=room.uuid, seq=5)
+        self.assertEqual(sender.sender.username, self.username2)
+        self.assertEqual(await ReadCursor.objects.filter(room=imported).acount(), 2)
+        summary = await RoomSummary.objects.aget(room=imported)
+        self.assertEqual((summary.last_seq, summary.last_message, summary.member_count), (5, 'message 4', 2))
+
+    @override_settings(MESSAGE_SEARCH_PAGE_SIZE=2, MESSAGE_SEARCH_CHUNK_SIZE=1)
+    async def test_search(self) -> None:
+        """
+        Test searching the messages of the rooms of the user page by page.
+        """
+        await self.initialize_user()
+        room = await create_or_get_room(self.username)
+        for content in ('hello world', 'something else', 'hello again', 'hello there'):
+            await save_message(room.uuid, {'content': content, 'sender': self.username})
+        other_room = await Room.objects.acreate(description='other')
+        await other_room.users.aadd(self.user2)
+        await save_message(other_room.uuid, {'content': 'hello from another room', 'sender': self.username2})
+
+        communicator_chat = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.uuid}')
+        communicator_chat.scope['user'] = self.user
+        await communicator_chat.connect()
+        await communicator_chat.receive_json_from()
+
+        # The first page comes in one frame per chunk, the last one with the cursor of the next page
+        await communicator_chat.send_json_to({'type': 'chat.search', 'query': 'hello', 'all_rooms': True})
+        first = await communicator_chat.receive_json_from()
+        second = await communicator_chat.receive_json_from()
+        self.assertFalse(first['done'])
+        self.assertTrue(second['done'])
+        self.assertIsNotNone(second['cursor'])
+        results = first['results'] + second['results']
+
+        await communicator_chat.send_json_to({'type': 'chat.search', 'query': 'hello', 'cursor': second['cursor']})
+        last = await communicator_chat.receive_json_from()
+        self.assertTrue(last['done'])
+        self.assertIsNone(last['cursor'])
+        results += last['results']
+
+        # Rooms of other users are not searched
+        self.assertEqual(sorted(result['seq'] for result in results), [1, 3, 4])
+        self.assertEqual({result['room'] for result in results}, {str(room.uuid)})
+        await communicator_chat.disconnect()
+
+    @override_settings(DRAIN_RECONNECT_SPREAD=2)
+    async def test_drain(self) -> None:
+        """
+        Test the drain saves the presence, tells the clients to reconnect and turns new sockets away.
+        """
+        await self.initialize_user()
+        room = await create_or_get_room(self.username)
+        communicator = await self.simulate_connection()
+        for _ in range(4):
+            await communicator.receive_json_from()
+        communicator_chat = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.uuid}')
+        communicator_chat.scope['user'] = self.user
+        await communicator_chat.connect()
+        await communicator_chat.receive_json_from()
+
+        try:
+            await drain.drain()
+            for open_communicator in (communicator, communicator_chat):
+                frame = await open_communicator.receive_json_from()
+                self.assertEqual(frame['type'], 'reconnect')
+                self.assertTrue(0 <= frame['retry_after'] <= 2)
+                self.assertEqual(await open_communicator.receive_output(), {'type': 'websocket.close', 'code': 1012})
+            self.assertFalse((await get_status(self.user)).online)
+
+            new_communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.uuid}')
+            new_communicator.scope['user'] = self.user
+            self.assertTrue((await new_communicator.connect())[0])
+            self.assertEqual((await new_communicator.receive_json_from())['type'], 'reconnect')
+            self.assertEqual(await new_communicator.receive_output(), {'type': 'websocket.close', 'code': 1012})
+
+            for closed_communicator in (communicator, communicator_chat, new_communicator):
+                await closed_communicator.disconnect()
+        finally:
+            drain._draining = False
+
+    @override_settings(HEARTBEAT_INTERVAL=0.05, HEARTBEAT_MISSES=3)
+    async def test_heartbeat(self) -> None:
+        """
+        Test the consumers are pinged, kept open while they answer and reaped when they stop.
+        """
+        await self.initialize_user()
+        room = await create_or_get_room(self.username)
+        communicator = await self.simulate_connection()
+        for _ in range(4):
+            await communicator.receive_json_from()
+        communicator_chat = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.uuid}')
+        communicator_chat.scope['user'] = self.user
+        await communicator_chat.connect()
+        await communicator_chat.receive_json_from()
+        reaped = REAPED_CONNECTIONS.values[('ConnectionConsumer',)]
+
+        # Answering the pings keeps the connection open
+        for _ in range(6):
+            self.assertEqual(await communicator.receive_json_from(), {'type': 'ping'})
+            await communicator.send_json_to({'type': 'pong'})
+        self.assertTrue((await get_status(self.user)).online)
+
+        # Without answers both are closed, the disconnect from the server runs the disconnect handlers
+        for open_communicator in (communicator, communicator_chat):
+            while (frame := await open_communicator.receive_output()).get('type') == 'websocket.send':
+                self.assertEqual(json.loads(frame['text']), {'type': 'ping'})
+            self.assertEqual(frame, {'type': 'websocket.close', 'code': 4408})
+        self.assertFalse((await get_status(self.user)).online)
+        self.assertEqual(REAPED_CONNECTIONS.values[('ConnectionConsumer',)], reaped + 1)
+
+        for closed_communicator in (communicator, communicator_chat):
+            await closed_communicator.disconnect()
+        self.assertNotIn(str(room.uuid), inbox._local_in_room)
+
+    @override_settings(HEARTBEAT_INTERVAL=0)
+    async def test_heartbeat_off(self) -> None:
+        """
+        Test the consumers are neither pinged nor reaped without a heartbeat interval.
+        """
+        await self.initialize_user()
+        room = await create_or_get_room(self.username)
+        communicator_chat = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.uuid}')
+        communicator_chat.scope['user'] = self.user
+        await communicator_chat.connect()
+        await communicator_chat.receive_json_from()
+        self.assertTrue(await communicator_chat.receive_nothing(0.2))
+        await communicator_chat.disconnect()
+
+
+class TestsImages(SimpleTestCase):
+    def test_render_thumbnail(self) -> None:
+        """
+        Test rendering a thumbnail next to the original and reusing it.
+        """
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'avatar.png')
+            Image.new('RGB', (640, 480), 'red').save(path)
+
+            variant = render_thumbnail(path, 64)
+            self.assertEqual(os.path.dirname(variant), root)
+            with Image.open(variant) as image:
+                self.assertEqual(image.size, (64, 64))
+
+            # The same content maps to the same variant, which is not rendered again
+            modified = os.path.getmtime(variant)
+            self.assertEqual(render_thumbnail(path, 64), variant)
+            self.assertEqual(os.path.getmtime(variant), modified)
+
+    async def test_thumbnail_url_fallback(self) -> None:
+        """
+        Test the thumbnail url without an image and with a missing file.
+        """
+        self.assertIsNone(await thumbnail_url(None, 'small'))
+        self.assertTrue((await thumbnail_url('avatars/missing.png', 'small')).endswith('avatars/missing.png'))
+
+    async def test_thumbnail_url_broken_pool(self) -> None:
+        """
+        Test a broken process pool falls back to the original url and is replaced for the next render.
+        """
+        with tempfile.TemporaryDirectory() as root, override_settings(MEDIA_ROOT=root):
+            os.makedirs(os.path.join(root, 'avatars'))
+            Image.new('RGB', (640, 480), 'red').save(os.path.join(root, 'avatars', 'avatar.png'))
+            broken = Mock(submit=Mock(side_effect=BrokenProcessPool()))
+            with patch.object(images, '_executor', broken):
+                self.assertTrue((await thumbnail_url('avatars/avatar.png', 'small')).endswith('avatars/avatar.png'))
+                self.assertIsNone(images._executor)
+            broken.shutdown.assert_called_once()
+
+            # Renders in flight are bounded, the original is used past the bound
+            with override_settings(THUMBNAIL_MAX_PENDING=0):
+                self.assertTrue((await thumbnail_url('avatars/avatar.png', 'small')).endswith('avatars/avatar.png'))
+            self.assertTrue((await thumbnail_url('avatars/avatar.png', 'small')).endswith('.webp'))
+            images._variants.clear()
+
+
+class TestsMedia(SimpleTestCase):
+    def setUp(self) -> None:
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.makedirs(os.path.join(self.root, 'files'))
+        self.content = bytes(range(256)) * 1000
+        with open(os.path.join(self.root, 'files', 'report.pdf'), 'wb') as file:
+            file.write(self.content)
+        self.url = f'{settings.MEDIA_URL}files/report.pdf'
+        settings_override = override_settings(MEDIA_ROOT=self.root, MEDIA_CHUNK_SIZE=4096)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    async def get_content(self, response) -> bytes:
+        return b''.join([chunk async for chunk in response.streaming_content])
+
+    async def test_serve(self) -> None:
+        """
+        Test serving a whole file with its validators and revalidating it.
+        """
+        response = await self.async_client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(await self.get_content(response), self.content)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('max-age', response['Cache-Control'])
+
+        not_modified = await self.async_client.get(self.url, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+        not_modified = await self.async_client.get(self.url, headers={'If-Modified-Since': response['Last-Modified']})
+        self.assertEqual(not_modified.status_code, 304)
+
+        head = await self.async_client.head(self.url)
+        self.assertEqual((head.status_code, head['Content-Length']), (200, str(len(self.content))))
+
+        for name in ('../secret', 'files', 'missing.png'):
+            self.assertEqual((await self.async_client.get(f'{settings.MEDIA_URL}{name}')).status_code, 404)
+
+    async def test_range(self) -> None:
+        """
+        Test serving byte ranges, a changed file is sent whole.
+        """
+        response = await self.async_client.get(self.url, headers={'Range': 'bytes=1000-9999'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 1000-9999/{len(self.content)}')
+        self.assertEqual(await self.get_content(response), self.content[1000:10000])
+
+        response = await self.async_client.get(self.url, headers={'Range': 'bytes=-100'})
+        self.assertEqual(await self.get_content(response), self.content[-100:])
+
+        response = await self.async_client.get(self.url, headers={'Range': f'bytes={len(self.content)}-'})
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.content)}')
+
+        open(os.path.join(self.root, 'files', 'empty.txt'), 'w').close()
+        response = await self.async_client.get(f'{settings.MEDIA_URL}files/empty.txt', headers={'Range': 'bytes=-100'})
+        self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */0'))
+
+        response = await self.async_client.get(self.url, headers={'Range': 'bytes=0-9', 'If-Range': '"changed"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(await self.get_content(response)), len(self.content))
+
+    @override_settings(MEDIA_SENDFILE='x-accel-redirect', MEDIA_ACCEL_PREFIX='/internal/')
+    async def test_offload(self) -> None:
+        """
+        Test leaving the transfer to the web server.
+        """
+        response = await self.async_client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], '/internal/files/report.pdf')
+        self.assertEqual(response.content, b'')
+        self.assertIn('ETag', response)
+
+
+class TestsFanout(SimpleTestCase):
+    @override_settings(FANOUT_GROUP_REFRESH=0.01)
+    async def test_node(self) -> None:
+        """
+        Test the node receives again after a failure of the channel layer and renews its group membership.
+        """
+        messages = asyncio.Queue()
+        failures = [ConnectionError('Connection lost')]
+
+        async def receive(channel_name: str) -> dict:
+            if failures:
+                raise failures.pop()
+            return await messages.get()
+
+        layer = Mock(new_channel=AsyncMock(return_value='node.1'), group_add=AsyncMock(), receive=receive)
+        consumer = Mock(dispatch=AsyncMock())
+        node = fanout.Node(layer)
+        self.addCleanup(node.stop)
+        with patch.object(fanout, 'RESTART_DELAY', 0), self.assertLogs('chats.fanout', 'ERROR'):
+            await node.join('room', consumer)
+            message = {'type': 'chat_content', 'room': 'room'}
+            await messages.put(message)
+            await asyncio.sleep(0.05)
+        consumer.dispatch.assert_awaited_once_with(message)
+        self.assertGreater(layer.group_add.await_count, 1)
+
+    @override_settings(FANOUT_LARGE_ROOM_SIZE=10, FANOUT_SWITCH_GRACE=30, FANOUT_MODE_TTL=60)
+    async def test_room_mode(self) -> None:
+        """
+        Test the first worker seeing enough members switches the room for all workers, only once and for good.
+        """
+        store = {}
+
+        class Pipeline:
+            def __init__(self):
+                self.commands = []
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *exc_info):
+                return False
+
+            def set(self, key, value, nx=False):
+                def command():
+                    if nx and key in store:
+                        return None
+                    store[key] = value
+                    return True
+                self.commands.append(command)
+
+            def get(self, key):
+                self.commands.append(lambda: store.get(key))
+
+            async def execute(self):
+                return [command() for command in self.commands]
+
+        layer = Mock(group_send=AsyncMock())
+        redis = Mock(pipeline=lambda transaction: Pipeline())
+        self.addCleanup(fanout._large_rooms.clear)
+        self.addCleanup(fanout._small_rooms.clear)
+        with patch.object(fanout, 'get_redis', return_value=redis):
+            self.assertEqual(await fanout.room_mode(layer, 'room', 2), fanout.SMALL)
+            small_rooms = dict(fanout._small_rooms)
+            # Another worker counts enough members
+            self.assertEqual(await fanout.room_mode(layer, 'room', 10), fanout.SWITCHING)
+            layer.group_send.assert_awaited_once()
+            self.assertEqual(layer.group_send.await_args.args[1]['type'], 'fanout_switch')
+            # Workers which cached the small mode read it again without the cache, a shrunk room stays large
+            fanout._large_rooms.clear()
+            fanout._small_rooms.update(small_rooms)
+            self.assertEqual(await fanout.room_mode(layer, 'room', 2), fanout.SMALL)
+            self.assertEqual(await fanout.room_mode(layer, 'room', 2, cached=False), fanout.SWITCHING)
+            self.assertEqual(await fanout.room_mode(layer, 'room', 10), fanout.SWITCHING)
+            layer.group_send.assert_awaited_once()
+        with override_settings(FANOUT_SWITCH_GRACE=0):
+            self.assertEqual(await fanout.room_mode(layer, 'room', 2), fanout.LARGE)
+        self.assertEqual(fanout.publish_groups('room', fanout.LARGE, 2), ('room.nodes',))
+        self.assertEqual(fanout.publish_groups('room', fanout.UNKNOWN, 2), ('room',))
+        self.assertEqual(fanout.publish_groups('room', fanout.UNKNOWN, 10), ('room', 'room.nodes'))
+
+
+class TestsChannelLayers(SimpleTestCase):
+    def test_sharding(self) -> None:
+        """
+        Test that adding a host moves only a small part of the groups.
+        """
+        hosts = [{'address': f'redis://localhost:{6379 + index}'} for index in range(5)]
+        groups = [f'group-{index}' for index in range(1000)]
+
+        self.assertEqual(ShardedRedisChannelLayer(hosts=hosts[:1]).consistent_hash(groups[0]), 0)
+
+        four = ShardedRedisChannelLayer(hosts=hosts[:4])
+        five = ShardedRedisChannelLayer(hosts=hosts)
+        shards = [four.consistent_hash(group) for group in groups]
+        self.assertEqual(set(shards), {0, 1, 2, 3})
+
+        moved = sum(shard != five.consistent_hash(group) for shard, group in zip(shards, groups))
+        self.assertLess(moved, 300)
+
+
+@unittest.skipUnless(redis_available(), 'Redis is not available')
+class TestsChannelLayerBackends(ChannelsLiveServerTestCase):
+    async def check_backend(self, backend: str) -> None:
+        """
+        Helper method to run both consumers on the channel layer backend.
+        """
+        config = {
+            'BACKEND': settings.CHANNEL_LAYER_BACKENDS[backend],
+            'CONFIG': {'hosts': settings.CHANNEL_LAYERS['default']['CONFIG']['hosts']},
+        }
+        with override_settings(CHANNEL_LAYERS={'default': config}):
+            user = await create_user_async(f'{backend}user', f'{backend}@test.com')
+            user2 = await create_user_async(f'{backend}user2', f'{backend}2@test.com')
+            room = await create_or_get_room(user.username)
+            await create_or_get_room(user2.username)
+
+            # The connection consumer joins the own group and sends the chats
+            communicator = WebsocketCommunicator(ConnectionConsumer.as_asgi(), f'/ws/{user.username}')
+            communicator.scope['cookies'] = {'access': 'access_token', 'refresh': 'refresh_token'}
+            communicator.scope['user'] = user
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            frames = [await communicator.receive_json_from() for _ in range(4)]
+            self.assertIn('chats', frames[-1])
+
+            # A message is fanned out to every chat consumer of the room
+            communicators = []
+            for member in (user, user2):
+                communicator_chat = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.uuid}')
+                communicator_chat.scope['user'] = member
+                connected, _ = await communicator_chat.connect()
+                self.assertTrue(connected)
+                await communicator_chat.receive_json_from()
+                communicators.append(communicator_chat)
+
+            await communicators[0].send_json_to({'type': 'chat.content', 'content': self.id()})
+            for communicator_chat in communicators:
+                response = await communicator_chat.receive_json_from()
+                self.assertEqual((response['content'], response['sender']), (self.id(), user.username))
+                await communicator_chat.disconnect()
+            await communicator.disconnect()
+
+    async def test_core(self) -> None:
+        """
+        Test the consumers on the Redis channel layer.
+        """
+        await self.check_backend('core')
+
+    async def test_pubsub(self) -> None:
+        """
+        Test the consumers on the Redis pub/sub channel layer.
+        """
+        await self.check_backend('pubsub')
+
+
+class TestsMetrics(SimpleTestCase):
+    def test_render(self) -> None:
+        """
+        Test rendering counters and histograms in the Prometheus text format.
+        """
+        counter = Counter('test_frames_total', 'Test frames.', ('type',))
+        histogram = Histogram('test_seconds', 'Test durations.', buckets=(0.1, 1))
+        # The test metrics are not exposed to the other tests
+        self.addCleanup(REGISTRY.remove, counter)
+        self.addCleanup(REGISTRY.remove, histogram)
+        counter.inc('chat.content')
+        counter.inc('chat.content')
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        text = render()
+        self.assertIn('test_frames_total{type="chat.content"} 2', text)
+        self.assertIn('test_seconds_bucket{le="0.1"} 0', text)
+        self.assertIn('test_seconds_bucket{le="1"} 1', text)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 2', text)
+        self.assertIn('test_seconds_count 2', text)
+
+    def test_endpoint(self) -> None:
+        """
+        Test the metrics endpoint.
+        """
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE ws_active_connections gauge', response.content)
+        self.assertNotIn(b'test_frames_total', response.content)
+
+
+@override_settings(DATABASE_REPLICA='replica', REPLICA_MAX_LAG=2, REPLICA_LAG_INTERVAL=60, REPLICA_PIN_SECONDS=5)
+class TestsReplicaRouter(SimpleTestCase):
+    def setUp(self):
+        self.router = ReplicaRouter()
+        _lag.clear()
+
+    def read(self) -> str:
+        with read_from_replica():
+            return self.router.db_for_read(Message)
+
+    @patch('chats.routers.get_replica_lag', return_value=0.5)
+    def test_routing(self, get_replica_lag) -> None:
+        """
+        Test only the marked reads go to the replica and writes go to the primary.
+        """
+        self.assertEqual(self.router.db_for_read(Message), 'default')
+        self.assertEqual(self.read(), 'replica')
+        with read_from_replica():
+            self.assertEqual(self.router.db_for_write(Message), 'default')
+        with override_settings(DATABASE_REPLICA=None):
+            self.assertEqual(self.read(), 'default')
+
+    @patch('chats.routers.get_replica_lag', return_value=0.5)
+    def test_pin_primary(self, get_replica_lag) -> None:
+        """
+        Test reads after a write go to the primary in the same context only.
+        """
+        def write_and_read() -> str:
+            pin_primary()
+            return self.read()
+
+        self.assertEqual(contextvars.copy_context().run(write_and_read), 'default')
+        self.assertEqual(self.read(), 'replica')
+
+    def test_replica_lag(self) -> None:
+        """
+        Test a lagging or unavailable replica falls back to the primary and the lag check is cached.
+        """
+        with patch('chats.routers.get_replica_lag', return_value=10) as get_replica_lag:
+            self.assertEqual(self.read(), 'default')
+            self.assertEqual(self.read(), 'default')
+            self.assertEqual(get_replica_lag.call_count, 1)
+
+        _lag.clear()
+        with patch('chats.routers.get_replica_lag', return_value=None):
+            self.assertEqual(self.read(), 'default')
+
+
+@override_settings(HANDSHAKE_CONCURRENCY=1, HANDSHAKE_QUEUE_SIZE=1, HANDSHAKE_QUEUE_TIMEOUT=5, HANDSHAKE_RETRY_AFTER=1)
+class TestsAdmission(SimpleTestCase):
+    def slow_application(self, gate: asyncio.Event):
+        """
+        Application accepting the handshake and finishing the connect handler when the gate opens.
+        """
+        async def application(scope, receive, send):
+            await receive()
+            await send({'type': 'websocket.accept'})
+            await gate.wait()
+            await receive()
+
+        return AdmissionMiddleware(application)
+
+    async def assert_rejected(self, communicator: WebsocketCommunicator) -> None:
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame['type'], 'retry')
+        self.assertTrue(1 <= frame['retry_after'] <= 2)
+        self.assertEqual(await communicator.receive_output(), {'type': 'websocket.close', 'code': 1013})
+
+    async def test_queue(self) -> None:
+        """
+        Test handshakes wait for a slot until the connect handler is done and are rejected when the queue is full.
+        """
+        gate = asyncio.Event()
+        application = self.slow_application(gate)
+        first = WebsocketCommunicator(application, '/ws/first')
+        self.assertTrue((await first.connect())[0])
+
+        second = WebsocketCommunicator(application, '/ws/second')
+        second_connect = asyncio.create_task(second.connect())
+        await asyncio.sleep(0.1)
+        self.assertFalse(second_connect.done())
+
+        rejected = HANDSHAKES_REJECTED.values[('queue_full',)]
+        await self.assert_rejected(WebsocketCommunicator(application, '/ws/third'))
+        self.assertEqual(HANDSHAKES_REJECTED.values[('queue_full',)], rejected + 1)
+
+        gate.set()
+        self.assertTrue((await second_connect)[0])
+        await first.disconnect()
+        await second.disconnect()
+
+    async def test_draining(self) -> None:
+        """
+        Test a draining worker rejects handshakes before they are authenticated.
+        """
+        inner = AsyncMock()
+        drain._draining = True
+        self.addCleanup(setattr, drain, '_draining', False)
+        rejected = HANDSHAKES_REJECTED.values[('draining',)]
+        await self.assert_rejected(WebsocketCommunicator(AdmissionMiddleware(inner), '/ws/draining'))
+        self.assertEqual(HANDSHAKES_REJECTED.values[('draining',)], rejected + 1)
+        inner.assert_not_called()
+
+    @override_settings(HANDSHAKE_QUEUE_TIMEOUT=0.1)
+    async def test_timeout(self) -> None:
+        """
+        Test handshakes waiting too long for a slot are rejected.
+        """
+        gate = asyncio.Event()
+        application = self.slow_application(gate)
+        first = WebsocketCommunicator(application, '/ws/first')
+        self.assertTrue((await first.connect())[0])
+
+        await self.assert_rejected(WebsocketCommunicator(application, '/ws/second'))
+        gate.set()
+        await first.disconnect()
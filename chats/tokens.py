@@ -0,0 +1,125 @@
+"""
+In-band refresh of the tokens of long-lived sockets.
+The expiry of the access token is read from its JWT payload, shortly before it the tokens are refreshed through the
+AUTH-backend in a thread, once per user in the worker, and sent to every connection of the user through their group,
+so the frontend gets new tokens without reconnecting. Failed refreshes leave the old tokens, the frontend reconnects
+when they expire as before.
+"""
+from middlewares.middleware_helpers import refresh_tokens
+from middlewares.websocket_auth import backend_auth
+from chats.metrics import TOKEN_REFRESHES
+from asgiref.sync import sync_to_async
+from django.conf import settings
+import requests
+import binascii
+import logging
+import weakref
+import asyncio
+import base64
+import random
+import json
+import time
+
+logger = logging.getLogger(__name__)
+
+# Refreshes in flight per event loop: username -> task
+_refreshes = weakref.WeakKeyDictionary()
+
+
+def token_expiry(token: str | None) -> float | None:
+    """
+    Get the `exp` claim of the JWT as a timestamp, the signature is not checked, the token is only passed back.
+    """
+    try:
+        payload = token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return float(claims['exp'])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError, binascii.Error):
+        return None
+
+
+async def request_refresh(refresh: str) -> dict | None:
+    """
+    Refresh the tokens in a thread, the AUTH-backend may not return a new refresh token.
+    """
+    try:
+        response = await sync_to_async(refresh_tokens, thread_sensitive=False)(
+            backend_auth, refresh, settings.TOKEN_REFRESH_TIMEOUT,
+        )
+        if response.status_code != 200:
+            raise ValueError(f'Status code {response.status_code}')
+        data = response.json()
+        tokens = {'access': data['access'], 'refresh': data.get('refresh', refresh)}
+    except (requests.RequestException, ValueError, KeyError, TypeError) as error:
+        TOKEN_REFRESHES.inc('failed')
+        logger.warning('Could not refresh the tokens: %s', error)
+        return None
+    TOKEN_REFRESHES.inc('refreshed')
+    return tokens
+
+
+async def refresh(username: str, refresh_token: str) -> dict | None:
+    """
+    Refresh the tokens of the user, joining the refresh already running for another connection of the user.
+    """
+    refreshes = _refreshes.setdefault(asyncio.get_running_loop(), {})
+    task = refreshes.get(username)
+    if task is None:
+        task = refreshes[username] = asyncio.create_task(request_refresh(refresh_token))
+        task.add_done_callback(lambda _: refreshes.pop(username, None))
+    else:
+        TOKEN_REFRESHES.inc('coalesced')
+    # A connection closing while waiting does not cancel the refresh of the others
+    return await asyncio.shield(task)
+
+
+class TokenRefreshMixin:
+    """
+    Refresh the tokens of the connection before the access token expires and send them to the frontend.
+    The consumer calls `schedule_refresh` with the tokens it sent and `cancel_refresh` on disconnect,
+    it has to be in the group of its `username`.
+    """
+    refresh_token = None
+    refresh_timer = None
+    refresh_task = None
+
+    def schedule_refresh(self, tokens: dict) -> None:
+        """
+        Start the refresh `TOKEN_REFRESH_BEFORE` seconds before the access token expires, with jitter,
+        so the connections of the user in other workers usually get the tokens of the first refresh.
+        """
+        self.cancel_refresh()
+        self.refresh_token = tokens.get('refresh')
+        expiry = token_expiry(tokens.get('access'))
+        if expiry is None or not self.refresh_token:
+            return
+        delay = expiry - time.time() - settings.TOKEN_REFRESH_BEFORE - random.uniform(0, settings.TOKEN_REFRESH_JITTER)
+        self.refresh_timer = asyncio.get_running_loop().call_later(max(0.0, delay), self.start_refresh)
+
+    def start_refresh(self) -> None:
+        self.refresh_timer = None
+        self.refresh_task = asyncio.create_task(self.refresh_tokens())
+
+    def cancel_refresh(self) -> None:
+        if self.refresh_timer is not None:
+            self.refresh_timer.cancel()
+            self.refresh_timer = None
+
+    async def refresh_tokens(self) -> None:
+        """
+        Refresh the tokens and send them to all connections of the user.
+        """
+        try:
+            tokens = await refresh(self.username, self.refresh_token)
+            if tokens is not None:
+                await self.channel_layer.group_send(self.username, {'type': 'user_tokens', **tokens})
+        finally:
+            self.refresh_task = None
+
+    async def user_tokens(self, event) -> None:
+        """
+        Send the refreshed tokens to the frontend and schedule the next refresh.
+        """
+        tokens = {'access': event['access'], 'refresh': event['refresh']}
+        await self.send_json(tokens)
+        self.schedule_refresh(tokens)
@@ -0,0 +1,130 @@
+"""
+Latency tracing of chat messages.
+A sample of `MESSAGE_TRACE_SAMPLE_RATE` of the `chat.content` frames gets a trace with the wall clock time it was
+received, persisted and published, which travels in the group event. The sender exports a `publish` record after
+the group send, every recipient a `deliver` record after sending the frame, joined by the trace id.
+Records go to the exporter in `MESSAGE_TRACE_EXPORTER`: `log`, `json` (lines appended to `MESSAGE_TRACE_FILE`
+from a thread) or the dotted path of a class with an `export(record)` method.
+"""
+from django.utils.module_loading import import_string
+from chats.metrics import MESSAGE_TRACES_DROPPED
+from django.conf import settings
+import threading
+import logging
+import random
+import queue
+import json
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+_exporter = None
+
+
+class LogExporter:
+    """
+    Log the records as JSON.
+    """
+
+    def export(self, record: dict) -> None:
+        logger.info('Message trace %s', json.dumps(record))
+
+
+class JsonFileExporter:
+    """
+    Append the records as JSON lines to the file, written from a thread so the event loop never waits for the disk.
+    At most `MESSAGE_TRACE_QUEUE_SIZE` records wait for the thread, more are dropped and counted.
+    A failed write is logged and the file opened again for the next record.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'a', buffering=1)
+        self.records = queue.Queue(maxsize=settings.MESSAGE_TRACE_QUEUE_SIZE)
+        threading.Thread(target=self.write, name='message-trace', daemon=True).start()
+
+    def export(self, record: dict) -> None:
+        try:
+            self.records.put_nowait(record)
+        except queue.Full:
+            MESSAGE_TRACES_DROPPED.inc('queue_full')
+
+    def write(self) -> None:
+        while True:
+            record = self.records.get()
+            try:
+                if self.file is None:
+                    self.file = open(self.path, 'a', buffering=1)
+                self.file.write(json.dumps(record) + '\n')
+            except Exception:
+                logger.exception('Could not write the message trace to %s', self.path)
+                self.close()
+
+    def close(self) -> None:
+        try:
+            if self.file is not None:
+                self.file.close()
+        except OSError:
+            pass
+        self.file = None
+
+
+EXPORTERS = {
+    'log': LogExporter,
+    'json': lambda: JsonFileExporter(settings.MESSAGE_TRACE_FILE),
+}
+
+
+def get_exporter():
+    global _exporter
+    if _exporter is None:
+        name = settings.MESSAGE_TRACE_EXPORTER
+        _exporter = EXPORTERS[name]() if name in EXPORTERS else import_string(name)()
+    return _exporter
+
+
+def start_trace() -> dict | None:
+    """
+    Start the trace of a received message, for a sample of the messages.
+    """
+    if random.random() >= settings.MESSAGE_TRACE_SAMPLE_RATE:
+        return None
+    return {'id': uuid.uuid4().hex, 'received': time.time()}
+
+
+def mark(trace: dict | None, stage: str) -> None:
+    """
+    Record the time the traced message reached the stage.
+    """
+    if trace is not None:
+        trace[stage] = time.time()
+
+
+def milliseconds(start: float | None, end: float | None) -> float | None:
+    if start is None or end is None:
+        return None
+    return round((end - start) * 1000, 3)
+
+
+def export(trace: dict, stage: str, event: dict, **fields) -> None:
+    """
+    Export the record of the stage with the durations between the timestamps of the trace.
+    """
+    now = time.time()
+    record = {
+        'trace_id': trace['id'],
+        'stage': stage,
+        'room': event.get('room'),
+        'seq': event.get('seq'),
+        **{key: value for key, value in trace.items() if key != 'id'},
+        'at': now,
+        'persist_ms': milliseconds(trace.get('received'), trace.get('persisted')),
+        f'{stage}_ms': milliseconds(trace.get('published'), now),
+        'total_ms': milliseconds(trace.get('received'), now),
+        **fields,
+    }
+    try:
+        get_exporter().export(record)
+    except Exception:
+        logger.exception('Could not export the message trace')
@@ -1,75 +1,126 @@
-from channels.db import database_sync_to_async
 from django.contrib.auth import get_user_model
-from chats.models import Status, Room, Message
+from chats.models import Status, Room, Message, ReadCursor
+from chats.db import db_sync_to_async
+from chats.summaries import update_last_message, refresh_user
+from chats.partitions import lock_room_seq
+from django.db import transaction
+from django.db.models import Max, F
 from django.utils import timezone
 
 User = get_user_model()
 
 
-@database_sync_to_async
-def set_username_async(username: str, user: User):
+async def set_username_async(username: str, user: User):
     """
     Set the status of the user to online or offline.
     """
-    user = User.objects.get(email=user.email)
-    user.username = username
-    user.save()
+    await User.objects.filter(email=user.email).aupdate(username=username)
+    await db_sync_to_async(refresh_user)(user)
 
-@database_sync_to_async
-def set_status_async(username: str, online: bool):
+
+async def set_status_async(username: str, online: bool):
     """
     Set the status of the user to online or offline.
+    Updates the existing status in one query, the status is only created for users without one.
     """
-    user = User.objects.get(username=username)
-    status, created = Status.objects.get_or_create(user=user)
+    fields = {'online': online}
     if not online:
-        status.last_seen = timezone.now()
-    status.online = online
-    status.save()
+        fields['last_seen'] = timezone.now()
+    if not await Status.objects.filter(user__username=username).aupdate(**fields):
+        user = await User.objects.aget(username=username)
+        await Status.objects.aupdate_or_create(user=user, defaults=fields)
 
 
-@database_sync_to_async
-def filter_users(search_query: str) -> list:
+async def filter_users(search_query: str) -> list:
     """
     Filter users by search query.
     """
-    users = User.objects.filter(username__icontains=search_query)
     return [{
         'id': user.id,
         'username': user.username
-    } for user in users]
+    } async for user in User.objects.filter(username__icontains=search_query)]
 
 
-@database_sync_to_async
-def create_or_get_room(user: str) -> Room:
+async def create_or_get_room(user: str) -> Room:
     """
     Create a new chat room or get the existing one.
     """
-    user = User.objects.get(username=user)
-    room, _ = Room.objects.get_or_create()
-    room.users.add(user)
-    room.save()
+    user = await User.objects.aget(username=user)
+    room, _ = await Room.objects.aget_or_create()
+    await room.users.aadd(user)
     return room
 
 
+def get_last_seq(room_name: str) -> int:
+    """
+    Get the last sequence number saved in the room.
+    """
+    return Message.objects.filter(room_uuid=room_name).aggregate(Max('seq'))['seq__max'] or 0
+
+
+async def get_last_seq_async(room_name: str) -> int:
+    """
+    Get the last sequence number saved in the room.
+    """
+    return (await Message.objects.filter(room_uuid=room_name).aaggregate(Max('seq')))['seq__max'] or 0
+
+
+def allocate_seq(room_name: str) -> int:
+    """
+    Allocate the next sequence number of the room from the database.
+    Must be called inside a transaction, a lock serializes concurrent writers until the commit, so the messages
+    of a room commit in sequence order: the advisory lock of the room on Postgres, which also exists for messages
+    without a room row, the room row lock elsewhere.
+    """
+    connection = transaction.get_connection()
+    if connection.vendor == 'postgresql':
+        lock_room_seq(connection, room_name)
+    else:
+        list(Room.objects.select_for_update().filter(uuid=room_name).values_list('id'))
+    return get_last_seq(room_name) + 1
+
+
 # TODO: Implement this method. now hardcoded timestamp from frontend
-@database_sync_to_async
+@db_sync_to_async
 def save_message(room_name: str, message: dict) -> Message:
     """
     Save the message to the database.
+    Allocate the sequence number in the transaction, a message is only broadcast after the earlier ones committed.
+    Count the message on the read cursor of the sender and update the room summary in the same transaction,
+    the other members get it as unread from the last sequence number of the summary.
+    """
+    with transaction.atomic():
+        sender = User.objects.get(username=message['sender'])
+        message, created = Message.objects.get_or_create(
+            room_uuid=room_name,
+            seq=allocate_seq(room_name),
+            sender=sender,
+            timestamp=message.get('timestamp', None),
+            content=message.get('content'),
+            file=message.get('file', None),
+        )
+        if created:
+            ReadCursor.objects.filter(room__uuid=room_name, user=sender).update(own_count=F('own_count') + 1)
+            update_last_message(room_name, message)
+        return message, created
+
+
+@db_sync_to_async
+def mark_read(user: User, room_name: str, seq: int) -> None:
+    """
+    Move the read cursor of the user in the room forward and recount the messages of the user after it.
     """
-    return Message.objects.get_or_create(
-        room_uuid=room_name,
-        sender=User.objects.get(username=message['sender']),
-        timestamp=message.get('timestamp', None),
-        content=message.get('content'),
-        file=message.get('file', None),
-    )
+    with transaction.atomic():
+        cursor = ReadCursor.objects.select_for_update().filter(user=user, room__uuid=room_name).first()
+        if cursor is None or seq <= cursor.last_read_seq:
+            return
+        cursor.last_read_seq = seq
+        cursor.own_count = Message.objects.filter(room_uuid=room_name, seq__gt=seq, sender=user).count()
+        cursor.save(update_fields=['last_read_seq', 'own_count'])
 
 
-@database_sync_to_async
-def get_status(user: User) -> Status:
+async def get_status(user: User) -> Status:
     """
     Helper method to get the status of the user.
     """
-    return Status.objects.get(user=user)
+    return await Status.objects.aget(user=user)
@@ -0,0 +1,26 @@
+from django.views.decorators.http import require_GET, require_safe
+from django.http import HttpResponse
+from django.db import transaction
+from chats.metrics import render
+from chats import media as media_files
+
+
+# Scrapes never touch the database
+@transaction.non_atomic_requests
+@require_GET
+async def metrics(request) -> HttpResponse:
+    """
+    Expose the metrics of this worker in the Prometheus text format.
+    Async, so the values are read on the event loop thread which updates them.
+    """
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# Async views cannot run in the transaction of `ATOMIC_REQUESTS`
+@transaction.non_atomic_requests
+@require_safe
+async def media(request, path: str) -> HttpResponse:
+    """
+    Serve the avatars and attachments with ranges and caching headers, see `chats.media`.
+    """
+    return await media_files.serve(request, path)
@@ -9,8 +9,9 @@ https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 from chats.consumers import ConnectionConsumer, ChatConsumer
 from channels.routing import ProtocolTypeRouter, URLRouter
 from middlewares.websocket_auth import TokenAuthMiddleware
+from middlewares.admission import AdmissionMiddleware
 from django.core.asgi import get_asgi_application
-from channels.auth import AuthMiddlewareStack
+from channels.sessions import CookieMiddleware
 from django.urls import path, re_path
 from dotenv import load_dotenv
 import os
@@ -19,13 +20,13 @@ load_dotenv()
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', os.getenv('DJANGO_SETTINGS_MODULE'))
 
-# urls for the websocket
+# urls for the websocket, the user is authenticated from the token cookies, without a Django session
 application = ProtocolTypeRouter({
     'http': get_asgi_application(),
-    'websocket': AuthMiddlewareStack(TokenAuthMiddleware(
+    'websocket': AdmissionMiddleware(CookieMiddleware(TokenAuthMiddleware(
         URLRouter([
             re_path(r'^ws/(?P<username>[a-zA-Z0-9]*)/?$', ConnectionConsumer.as_asgi(), name='user'),
             path('ws/chat/<str:room_name>', ChatConsumer.as_asgi(), name='chat'),
         ])
-    ))
+    )))
 })
@@ -40,6 +40,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 
     'channels',
 
@@ -88,10 +89,35 @@ DATABASES = {
         'PASSWORD': os.environ.get('POSTGRES_PASSWORD'),
         'HOST': os.environ.get('DB_HOST'),
         'PORT': os.environ.get('DB_PORT', '5432'),
-        'ATOMIC_REQUESTS': True
+        'ATOMIC_REQUESTS': True,
+        # Persistent connections, one per database thread, see `chats.db`
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 600)),
+        'CONN_HEALTH_CHECKS': os.getenv('DB_CONN_HEALTH_CHECKS', 'True') == 'True',
     }
 }
 
+# Optional read replica for the chat list, history and user search, see `chats.routers`
+DATABASE_REPLICA = None
+
+if os.getenv('DB_REPLICA_HOST'):
+    DATABASE_REPLICA = 'replica'
+    DATABASES[DATABASE_REPLICA] = {
+        **DATABASES['default'],
+        'HOST': os.getenv('DB_REPLICA_HOST'),
+        'PORT': os.getenv('DB_REPLICA_PORT', DATABASES['default']['PORT']),
+        'ATOMIC_REQUESTS': False,
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['chats.routers.ReplicaRouter']
+
+REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', 2))
+
+REPLICA_LAG_INTERVAL = float(os.getenv('REPLICA_LAG_INTERVAL', 1))
+
+# Seconds a connection reads from the primary after writing
+REPLICA_PIN_SECONDS = float(os.getenv('REPLICA_PIN_SECONDS', 5))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -137,6 +163,19 @@ MEDIA_URL = '/static/media/'
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media_cdn')
 
+# Thumbnails for avatars and image attachments, rendered in a process pool
+THUMBNAIL_SIZES = {
+    'small': int(os.getenv('THUMBNAIL_SMALL', 64)),
+    'medium': int(os.getenv('THUMBNAIL_MEDIUM', 320)),
+}
+
+THUMBNAIL_WORKERS = int(os.getenv('THUMBNAIL_WORKERS', 2))
+
+# Variant names kept per worker, and renders in flight before new ones fall back to the original image
+THUMBNAIL_CACHE_SIZE = int(os.getenv('THUMBNAIL_CACHE_SIZE', 10000))
+
+THUMBNAIL_MAX_PENDING = int(os.getenv('THUMBNAIL_MAX_PENDING', 100))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
@@ -147,15 +186,165 @@ AUTH_USER_MODEL = 'chats.User'
 CORS_ORIGIN_ALLOW_ALL = False
 CORS_ALLOWED_ORIGINS = os.environ.get('CORS_ALLOWED_ORIGINS', '').split(',')
 
-# Redis setting for sockets
+# Redis setting for sockets, channels and groups are sharded over all hosts
+CHANNEL_HOSTS = os.getenv('CHANNEL_HOSTS', os.getenv('CHANNEL_HOST', 'localhost:6379')).split(',')
+
+# Connections per host and process
+CHANNEL_POOL_SIZE = int(os.getenv('CHANNEL_POOL_SIZE', 100))
+
+# 'core' stores messages in Redis sorted sets and sends to every group member,
+# 'pubsub' publishes once per group and does not keep messages for disconnected channels
+CHANNEL_LAYER_BACKEND = os.getenv('CHANNEL_LAYER_BACKEND', 'core')
+
+CHANNEL_LAYER_BACKENDS = {
+    'core': 'chats.layers.ShardedRedisChannelLayer',
+    'pubsub': 'channels_redis.pubsub.RedisPubSubChannelLayer',
+}
+
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': CHANNEL_LAYER_BACKENDS[CHANNEL_LAYER_BACKEND],
         'CONFIG': {
-            'hosts': [os.getenv('CHANNEL_HOST').split(':')],
+            'hosts': [{
+                'address': f'redis://{host}',
+                'max_connections': CHANNEL_POOL_SIZE,
+            } for host in CHANNEL_HOSTS],
             'symmetric_encryption_keys': [os.getenv('CHANNEL_SECRET_KEY')],
         },
     },
 }
 
+# Rooms with at least this many members are published once per worker and fanned out locally
+FANOUT_LARGE_ROOM_SIZE = int(os.getenv('FANOUT_LARGE_ROOM_SIZE', 1000))
+
+# Seconds after which a worker renews its membership in a large room group
+FANOUT_GROUP_REFRESH = int(os.getenv('FANOUT_GROUP_REFRESH', 3600))
+
+# Seconds a room is published to both groups after it switched to the worker nodes, longer than FANOUT_MODE_TTL
+FANOUT_SWITCH_GRACE = float(os.getenv('FANOUT_SWITCH_GRACE', 30))
+
+# Seconds a worker keeps the small mode of a room before reading it from Redis again
+FANOUT_MODE_TTL = float(os.getenv('FANOUT_MODE_TTL', 5))
+
+if CHANNEL_LAYER_BACKEND == 'core':
+    CHANNEL_LAYERS['default']['CONFIG'].update({
+        'capacity': int(os.getenv('CHANNEL_CAPACITY', 100)),
+        # Node channels receive the messages of all large rooms of the worker
+        'channel_capacity': {'node.*': int(os.getenv('FANOUT_NODE_CAPACITY', 10000))},
+        'expiry': int(os.getenv('CHANNEL_EXPIRY', 60)),
+        'group_expiry': int(os.getenv('CHANNEL_GROUP_EXPIRY', 86400)),
+    })
+
 ASGI_APPLICATION = 'config.asgi.application'
+
+# Redis used directly by the chat, e.g. for room sequence numbers
+REDIS_URL = os.getenv('REDIS_URL', f'redis://{CHANNEL_HOSTS[0]}')
+
+REDIS_TIMEOUT = float(os.getenv('REDIS_TIMEOUT', 0.5))
+
+REDIS_RETRY_INTERVAL = float(os.getenv('REDIS_RETRY_INTERVAL', 5))
+
+# Cached room members used to authorize chat connections
+MEMBERSHIP_CACHE_TTL = float(os.getenv('MEMBERSHIP_CACHE_TTL', 30))
+
+MEMBERSHIP_CACHE_SIZE = int(os.getenv('MEMBERSHIP_CACHE_SIZE', 10000))
+
+# Profile the queries of every consumer event and log the slow ones
+EVENT_PROFILING = os.getenv('EVENT_PROFILING', 'False') == 'True'
+
+EVENT_SLOW_SECONDS = float(os.getenv('EVENT_SLOW_SECONDS', 0.25))
+
+EVENT_SLOW_QUERIES = int(os.getenv('EVENT_SLOW_QUERIES', 20))
+
+# Seconds to coalesce read markers from the frontend before writing them
+READ_MARKER_DELAY = float(os.getenv('READ_MARKER_DELAY', 2))
+
+# Threads running the transactional database work that can not use the async ORM,
+# every thread keeps a connection, keep the workers of all processes under the Postgres `max_connections`
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', 10))
+
+# Monthly message partitions created ahead by `archive_messages`, Postgres only
+MESSAGE_PARTITIONS_AHEAD = int(os.getenv('MESSAGE_PARTITIONS_AHEAD', 3))
+
+# Months of messages ended more than this many days ago are moved to compressed files by `archive_messages`
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.getenv('MESSAGE_ARCHIVE_AFTER_DAYS', 180))
+
+MESSAGE_ARCHIVE_DIR = os.getenv('MESSAGE_ARCHIVE_DIR', os.path.join(BASE_DIR, 'archive'))
+
+# Messages in a page of older history
+MESSAGE_PAGE_SIZE = int(os.getenv('MESSAGE_PAGE_SIZE', 50))
+
+# Text search configuration of the message search vectors, changing it needs a new migration
+MESSAGE_SEARCH_CONFIG = os.getenv('MESSAGE_SEARCH_CONFIG', 'simple')
+
+# Results in a page of message search, sent to the frontend in frames of `MESSAGE_SEARCH_CHUNK_SIZE`
+MESSAGE_SEARCH_PAGE_SIZE = int(os.getenv('MESSAGE_SEARCH_PAGE_SIZE', 50))
+
+MESSAGE_SEARCH_CHUNK_SIZE = int(os.getenv('MESSAGE_SEARCH_CHUNK_SIZE', 10))
+
+# Concurrent websocket handshakes per worker, the others wait in a bounded queue or are told to retry later
+HANDSHAKE_CONCURRENCY = int(os.getenv('HANDSHAKE_CONCURRENCY', 100))
+
+HANDSHAKE_QUEUE_SIZE = int(os.getenv('HANDSHAKE_QUEUE_SIZE', 1000))
+
+HANDSHAKE_QUEUE_TIMEOUT = float(os.getenv('HANDSHAKE_QUEUE_TIMEOUT', 10))
+
+# Seconds rejected clients wait before reconnecting, plus up to as much again of jitter
+HANDSHAKE_RETRY_AFTER = float(os.getenv('HANDSHAKE_RETRY_AFTER', 5))
+
+# Signal starting the drain of the worker before a restart, see `chats.drain`
+DRAIN_SIGNAL = os.getenv('DRAIN_SIGNAL', 'SIGUSR1')
+
+DRAIN_SAVE_TIMEOUT = float(os.getenv('DRAIN_SAVE_TIMEOUT', 10))
+
+# Seconds over which the drained clients are told to reconnect
+DRAIN_RECONNECT_SPREAD = float(os.getenv('DRAIN_RECONNECT_SPREAD', 30))
+
+# Characters of the last message shown in the chat list
+SUMMARY_PREVIEW_LENGTH = int(os.getenv('SUMMARY_PREVIEW_LENGTH', 200))
+
+# Offline inbox of the users, see `chats.inbox`
+INBOX_SIZE = int(os.getenv('INBOX_SIZE', 100))
+
+INBOX_TTL = int(os.getenv('INBOX_TTL', 7 * 24 * 3600))
+
+# Seconds an open chat is counted without a renewal by the heartbeat, longer than HEARTBEAT_INTERVAL
+INBOX_IN_ROOM_TTL = int(os.getenv('INBOX_IN_ROOM_TTL', 300))
+
+# Seconds to coalesce the new messages into one activity event per user
+INBOX_ACTIVITY_DELAY = float(os.getenv('INBOX_ACTIVITY_DELAY', 1))
+
+# Seconds between the pings of the websockets, connections without a frame for `HEARTBEAT_MISSES` pings are closed,
+# 0 turns the heartbeat off
+HEARTBEAT_INTERVAL = float(os.getenv('HEARTBEAT_INTERVAL', 30))
+
+HEARTBEAT_MISSES = int(os.getenv('HEARTBEAT_MISSES', 3))
+
+# Seconds before the expiry of the access token to refresh the tokens of a websocket, plus up to the jitter
+TOKEN_REFRESH_BEFORE = float(os.getenv('TOKEN_REFRESH_BEFORE', 60))
+
+TOKEN_REFRESH_JITTER = float(os.getenv('TOKEN_REFRESH_JITTER', 10))
+
+TOKEN_REFRESH_TIMEOUT = float(os.getenv('TOKEN_REFRESH_TIMEOUT', 10))
+
+# Media served by `chats.views.media`: chunk size of the streamed files and max-age of the responses
+MEDIA_CHUNK_SIZE = int(os.getenv('MEDIA_CHUNK_SIZE', 64 * 1024))
+
+MEDIA_CACHE_MAX_AGE = int(os.getenv('MEDIA_CACHE_MAX_AGE', 24 * 3600))
+
+# Leave the transfer to the web server: 'x-accel-redirect' (nginx, internal location `MEDIA_ACCEL_PREFIX`)
+# or 'x-sendfile' (Apache, lighttpd), empty streams the files from the worker
+MEDIA_SENDFILE = os.getenv('MEDIA_SENDFILE', '')
+
+MEDIA_ACCEL_PREFIX = os.getenv('MEDIA_ACCEL_PREFIX', '/protected-media/')
+
+# Share of the chat messages traced from receive to delivery, see `chats.tracing`
+MESSAGE_TRACE_SAMPLE_RATE = float(os.getenv('MESSAGE_TRACE_SAMPLE_RATE', 0))
+
+# 'log', 'json' or the dotted path of an exporter class
+MESSAGE_TRACE_EXPORTER = os.getenv('MESSAGE_TRACE_EXPORTER', 'log')
+
+MESSAGE_TRACE_FILE = os.getenv('MESSAGE_TRACE_FILE', os.path.join(BASE_DIR, 'message_traces.jsonl'))
+
+# Records waiting for the file exporter, more are dropped
+MESSAGE_TRACE_QUEUE_SIZE = int(os.getenv('MESSAGE_TRACE_QUEUE_SIZE', 10000))
@@ -15,10 +15,15 @@ Including another URLconf
 """
 from rest_framework import routers
 from django.contrib import admin
-from django.urls import path
+from django.urls import path, re_path
+from django.conf import settings
+from chats import views
+import re
 
 router = routers.DefaultRouter(trailing_slash=False)
 
 urlpatterns = [
     path('admin-ws', admin.site.urls),
+    path('metrics', views.metrics, name='metrics'),
+    re_path(rf'^{re.escape(settings.MEDIA_URL.lstrip("/"))}(?P<path>.+)$', views.media, name='media'),
 ]
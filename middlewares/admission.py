@@ -0,0 +1,122 @@
+from chats.metrics import HANDSHAKE_QUEUE_SECONDS, HANDSHAKES_WAITING, HANDSHAKES_REJECTED
+from chats.drain import is_draining
+from channels.middleware import BaseMiddleware
+from django.conf import settings
+import asyncio
+import weakref
+import random
+import json
+import time
+
+# Close code asking the client to try again later
+TRY_AGAIN_LATER = 1013
+
+
+class Admission:
+    """
+    Handshake slots of the worker and the handshakes waiting for one.
+    """
+
+    def __init__(self):
+        self.slots = asyncio.Semaphore(settings.HANDSHAKE_CONCURRENCY)
+        self.waiting = 0
+
+
+# Semaphores are bound to the event loop they are used on
+_admissions = weakref.WeakKeyDictionary()
+
+
+def get_admission() -> Admission:
+    loop = asyncio.get_running_loop()
+    admission = _admissions.get(loop)
+    if admission is None:
+        admission = _admissions[loop] = Admission()
+    return admission
+
+
+def retry_after() -> float:
+    """
+    Get the seconds the rejected client waits before reconnecting, with jitter so the clients do not come back at once.
+    """
+    return round(settings.HANDSHAKE_RETRY_AFTER * (1 + random.random()), 1)
+
+
+class AdmittedReceive:
+    """
+    Receive callable of an admitted handshake, releasing its slot when the consumer asks for the second message,
+    which is when its connect handler is done.
+    Kept for the lifetime of the connection, so it is a slotted object instead of closures.
+    """
+    __slots__ = ('receive', 'slots', 'receives')
+
+    def __init__(self, receive, slots: asyncio.Semaphore):
+        self.receive = receive
+        self.slots = slots
+        self.receives = 0
+
+    def release(self) -> None:
+        if self.slots is not None:
+            self.slots.release()
+            self.slots = None
+
+    async def __call__(self):
+        self.receives += 1
+        # The first message is the connect, the consumer asks for the second one after handling it
+        if self.receives > 1:
+            self.release()
+        return await self.receive()
+
+
+class AdmissionMiddleware(BaseMiddleware):
+    """
+    Middleware to limit the concurrent websocket handshakes of the worker.
+    A handshake holds a slot from the authentication until the consumer's connect handler is done,
+    which is when the consumer asks for the next message.
+    At most `HANDSHAKE_QUEUE_SIZE` handshakes wait for a slot, for up to `HANDSHAKE_QUEUE_TIMEOUT` seconds,
+    the others are told to retry later and closed with code 1013.
+    A draining worker closes every handshake that way before it takes a slot or authenticates.
+    """
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] != 'websocket':
+            return await super().__call__(scope, receive, send)
+
+        if is_draining():
+            HANDSHAKES_REJECTED.inc('draining')
+            return await self.reject(receive, send)
+
+        admission = get_admission()
+        if admission.slots.locked() and admission.waiting >= settings.HANDSHAKE_QUEUE_SIZE:
+            HANDSHAKES_REJECTED.inc('queue_full')
+            return await self.reject(receive, send)
+
+        admission.waiting += 1
+        HANDSHAKES_WAITING.inc()
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(admission.slots.acquire(), settings.HANDSHAKE_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            HANDSHAKES_REJECTED.inc('timeout')
+            return await self.reject(receive, send)
+        finally:
+            admission.waiting -= 1
+            HANDSHAKES_WAITING.dec()
+            HANDSHAKE_QUEUE_SECONDS.observe(time.perf_counter() - started)
+
+        admitted_receive = AdmittedReceive(receive, admission.slots)
+        try:
+            # The scope is not changed, so it is passed on without the copy of `BaseMiddleware`
+            return await self.inner(scope, admitted_receive, send)
+        finally:
+            admitted_receive.release()
+
+    async def reject(self, receive, send) -> None:
+        """
+        Accept the handshake only to send the retry delay, then close it.
+        """
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+        await send({'type': 'websocket.accept'})
+        await send({'type': 'websocket.send', 'text': json.dumps({'type': 'retry', 'retry_after': retry_after()})})
+        await send({'type': 'websocket.close', 'code': TRY_AGAIN_LATER})
@@ -1,5 +1,4 @@
 from django.contrib.auth import get_user_model
-from channels.db import database_sync_to_async
 from chats.models import Status
 import requests
 
@@ -16,26 +15,35 @@ def receive_user(host: str, token: dict) -> requests.Response:
     )
 
 
-@database_sync_to_async
-def create_user_async(username: str, email: str) -> User:
+def refresh_tokens(host: str, refresh: str, timeout: float | None = None) -> requests.Response:
+    """
+    Get new tokens for the refresh token from the AUTH-backend.
+    """
+    return requests.post(
+        f'{host}/token/refresh',
+        data={'refresh': refresh},
+        timeout=timeout,
+    )
+
+
+async def create_user_async(username: str, email: str) -> User:
     """
     Create a new user.
     Create a new status for the user.
     """
-    user = User.objects.create(
+    user = await User.objects.acreate(
         username=username,
         email=email
     )
-    Status.objects.create(user=user, online=True)
+    await Status.objects.acreate(user=user, online=True)
     return user
 
 
-@database_sync_to_async
-def get_user_async(email: str) -> User:
+async def get_user_async(email: str) -> User:
     """
     Get the user by email.
     """
-    return User.objects.get(email=email)
+    return await User.objects.aget(email=email)
 
 
 async def check_response(response: requests.Response) -> dict:
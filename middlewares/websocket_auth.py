@@ -1,4 +1,5 @@
 from middlewares.middleware_helpers import receive_user, check_response, get_user
+from chats.metrics import HANDSHAKE_AUTH_SECONDS
 from channels.middleware import BaseMiddleware
 from django.contrib.auth import get_user_model
 from dotenv import load_dotenv
@@ -17,6 +18,15 @@ class TokenAuthMiddleware(BaseMiddleware):
     for websocket connections
     """
     async def __call__(self, scope, receive, send) -> None:
+        with HANDSHAKE_AUTH_SECONDS.time():
+            scope = await self.authenticate(scope)
+        # The user is set on the scope of the cookie middleware, a copy would be kept for every connection
+        return await self.inner(scope, receive, send)
+
+    async def authenticate(self, scope) -> dict:
+        """
+        Authenticate the user with the tokens from the cookies.
+        """
         cookies = dict(scope['cookies'])
         if not 'access' in cookies and not 'refresh' in cookies:
             raise Exception('No tokens in cookies')
@@ -32,5 +42,4 @@ class TokenAuthMiddleware(BaseMiddleware):
                 raise Exception('Invalid credentials')
         response = receive_user(backend_auth, cookies)
         response = await check_response(response)
-        scope = await get_user(response, scope)
-        return await super().__call__(scope, receive, send)
+        return await get_user(response, scope)